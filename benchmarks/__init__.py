@@ -0,0 +1,8 @@
+"""Micro-benchmarks for the agent's hot paths.
+
+Run them from the top of the tree, e.g.: python -m benchmarks.line_framing
+
+benchmarks.collectors replays the builtin collectors against generated or
+recorded /proc fixtures and stub HTTP servers, and can compare a run with a
+saved baseline.
+"""
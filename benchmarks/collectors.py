@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Replays builtin collectors against a fixture tree and stub servers (see
+benchmarks.fixtures) instead of the live system, and reports per collector
+the time, allocations and lines of a run.
+
+    python -m benchmarks.collectors --save-baseline baseline.json
+    python -m benchmarks.collectors --baseline baseline.json
+
+Allocations are the gc-tracked objects a run leaves allocated with the
+cyclic collector off, python 2 has no tracemalloc.  With --baseline, runs
+which got slower or allocate more than --threshold, or emit a different
+number of lines, are flagged and the exit status is 1."""
+
+from __future__ import absolute_import
+
+import ConfigParser
+import gc
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import runner
+from benchmarks import fixtures
+from collectors.lib import procfs
+
+
+class CountingQueue(object):
+    """Stands in for the runner's readq, counts the lines and drops them."""
+
+    def __init__(self):
+        self.lines = 0
+
+    def nput(self, line):
+        self.lines += 1
+        return True
+
+    def nput_batch(self, lines):
+        self.lines += len(lines)
+        return True
+
+
+class Benchmark(object):
+    """A builtin collector, the conf it's constructed with and what has to
+       be set on it to talk to the stub servers."""
+
+    def __init__(self, name, class_name, conf=None, setup=None):
+        self.name = name
+        self.class_name = class_name
+        self.conf = conf or (lambda stubs: {})
+        self.setup = setup or (lambda collector, stubs: None)
+
+    def make(self, stubs, logger, readq):
+        config = ConfigParser.SafeConfigParser(runner.default_config())
+        config.add_section(runner.SECTION_BASE)
+        for key, value in self.conf(stubs).iteritems():
+            config.set(runner.SECTION_BASE, key, str(value))
+        collector_class = runner.load_collector_module(self.name, 'collectors/builtin', self.class_name)
+        collector = collector_class(config, logger, readq)
+        self.setup(collector, stubs)
+        return collector
+
+
+def use_docker_stub(collector, stubs):
+    collector.cgroup_path = '/sys/fs/cgroup'
+    collector.socket_path = stubs.docker.server_address
+
+
+BENCHMARKS = [
+    Benchmark('procstats', 'Procstats'),
+    Benchmark('cpus_pctusage', 'CpusPctusage'),
+    Benchmark('iostat', 'Iostat'),
+    Benchmark('ifstat', 'Ifstat'),
+    Benchmark('netstat', 'Netstat'),
+    Benchmark('procnettcp', 'Procnettcp', conf=lambda stubs: {'backend': 'procfs'}),
+    Benchmark('docker', 'Docker', setup=use_docker_stub),
+    Benchmark('hadoop_name_node', 'HadoopNameNode', conf=lambda stubs: {'host': '127.0.0.1', 'port': stubs.port}),
+    Benchmark('top_n', 'TopN'),
+    Benchmark('tomcat', 'Tomcat', conf=lambda stubs: {'ports': stubs.port}),
+]
+
+
+def measure(collector, readq, rounds):
+    """Runs the collector once to warm it up, then rounds times.  Returns
+       the median time in ms, allocations and lines of the runs."""
+    times = []
+    allocations = []
+    lines = []
+    for round in xrange(rounds + 1):
+        # let /proc/uptime tick, iostat divides by its delta
+        time.sleep(0.02)
+        gc.collect()
+        gc.disable()
+        try:
+            readq.lines = 0
+            objects = len(gc.get_objects())
+            start = time.time()
+            collector()
+            collector.flush()
+            elapsed = time.time() - start
+            allocated = len(gc.get_objects()) - objects
+        finally:
+            gc.enable()
+        if round:
+            times.append(elapsed * 1000)
+            allocations.append(allocated)
+            lines.append(readq.lines)
+    median = lambda values: sorted(values)[len(values) / 2]
+    return {'ms': median(times), 'allocations': median(allocations), 'lines': median(lines)}
+
+
+def regressions(name, result, baseline, threshold):
+    """The ways result is worse than baseline."""
+    found = []
+    if name not in baseline:
+        return found
+    base = baseline[name]
+    for key in ('ms', 'allocations'):
+        if result[key] > base[key] * (1 + threshold) and result[key] - base[key] > 1:
+            found.append('%s %s -> %s' % (key, base[key], result[key]))
+    if result['lines'] != base['lines']:
+        found.append('lines %d -> %d' % (base['lines'], result['lines']))
+    return found
+
+
+def main(argv):
+    parser = OptionParser(description='Benchmarks builtin collectors on fixtures.')
+    parser.add_option('--fixtures', metavar='DIR',
+                      help='Replay a recorded fixture tree instead of generating one.')
+    parser.add_option('--record', metavar='DIR',
+                      help='Record a fixture tree of this host into DIR and exit.')
+    parser.add_option('--only', metavar='NAMES',
+                      help='Comma separated collectors to run, all by default.')
+    parser.add_option('--rounds', type='int', default=5,
+                      help='Number of measured runs per collector, the median is '
+                           'reported. default=%default')
+    parser.add_option('--sockets', type='int', default=100000,
+                      help='Sockets in the generated /proc/net/tcp. default=%default')
+    parser.add_option('--containers', type='int', default=500,
+                      help='Containers in the generated cgroup tree. default=%default')
+    parser.add_option('--processes', type='int', default=20000,
+                      help='Processes in the generated /proc. default=%default')
+    parser.add_option('--cpus', type='int', default=64,
+                      help='CPUs in the generated /proc/stat. default=%default')
+    parser.add_option('--baseline', metavar='FILE',
+                      help='Compare with the results saved in FILE.')
+    parser.add_option('--save-baseline', metavar='FILE',
+                      help='Save the results to FILE.')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='Relative slowdown or allocation growth flagged as a '
+                           'regression. default=%default')
+    options, args = parser.parse_args(args=argv[1:])
+
+    if options.record:
+        for path in fixtures.record_tree(options.record):
+            print 'not recorded, missing: %s' % path
+        return 0
+
+    root = options.fixtures
+    if root is None:
+        root = tempfile.mkdtemp(prefix='collector-fixtures-')
+        start = time.time()
+        missing = fixtures.build_tree(root, cpus=options.cpus, sockets=options.sockets,
+                                      containers=options.containers, processes=options.processes)
+        print 'generated fixtures in %s in %.1fs%s' % (root, time.time() - start, missing and
+                                                      ', missing on this host: %s' % ' '.join(missing) or '')
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    only = options.only and options.only.split(',')
+
+    # every run reads its files, instead of the snapshot of the previous one
+    procfs.SNAPSHOT_AGE = 0
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.ERROR)
+    stubs = fixtures.StubServers(root)
+    results = {}
+    flagged = 0
+    try:
+        with fixtures.FixtureRoot(root):
+            print '%-18s %10s %12s %8s' % ('collector', 'ms/run', 'allocations', 'lines')
+            for benchmark in BENCHMARKS:
+                if only and benchmark.name not in only:
+                    continue
+                readq = CountingQueue()
+                try:
+                    collector = benchmark.make(stubs, logger, readq)
+                    result = measure(collector, readq, options.rounds)
+                    collector.cleanup()
+                except Exception, e:
+                    print '%-18s failed: %s' % (benchmark.name, e)
+                    continue
+                results[benchmark.name] = result
+                found = regressions(benchmark.name, result, baseline, options.threshold)
+                flagged += len(found)
+                print '%-18s %10.2f %12d %8d%s' % (benchmark.name, result['ms'], result['allocations'],
+                                                   result['lines'], found and '  REGRESSION: ' + ', '.join(found) or '')
+    finally:
+        stubs.close()
+        if options.fixtures is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 1 if flagged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
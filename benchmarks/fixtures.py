@@ -0,0 +1,336 @@
+"""Fixture trees and stub servers the builtin collectors are replayed
+against by benchmarks.collectors.
+
+A fixture tree mirrors the parts of / the collectors read: proc/, sys/ and,
+for the HTTP collectors, the JSON dumps their stub servers answer with.
+build_tree() generates one, with the big files sized from the options and
+the small ones recorded from the running host.  record_tree() records one
+from the running host, to replay a production box somewhere else."""
+
+import BaseHTTPServer
+import SocketServer
+import __builtin__
+import glob
+import json
+import os
+import random
+import threading
+
+# the paths collectors read that FixtureRoot redirects into the tree
+REDIRECTED = ('/proc/', '/sys/')
+
+# but these are read live, rates are taken over their deltas
+LIVE = ('/proc/uptime',)
+
+# small files copied from the running host into generated trees
+RECORDED = ('/proc/meminfo', '/proc/vmstat', '/proc/loadavg',
+            '/proc/sys/kernel/random/entropy_avail', '/proc/interrupts', '/proc/softirqs',
+            '/proc/net/dev', '/proc/net/sockstat', '/proc/net/netstat', '/proc/net/snmp')
+
+# and the big ones, which generated trees make up
+GENERATED = ('/proc/stat', '/proc/diskstats', '/proc/net/tcp', '/proc/net/tcp6')
+
+CGROUP_CONTROLLERS = ('cpuacct', 'memory', 'blkio')
+
+# the Jolokia dump has the stub's port in its mbean names
+PORT_PLACEHOLDER = '@PORT@'
+
+
+def write(root, path, content):
+    filename = os.path.join(root, path.lstrip('/'))
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        f.write(content)
+
+
+def record_tree(root, paths=RECORDED + GENERATED):
+    """Copies the files of the running host the collectors read into root.
+       Returns the ones which aren't there."""
+    missing = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                write(root, path, f.read())
+        except IOError:
+            missing.append(path)
+    return missing
+
+
+def build_tree(root, cpus=64, disks=32, sockets=100000, containers=500, servlets=200, beans=500,
+               processes=20000):
+    """Generates a fixture tree in root, returns the recorded files which
+       the running host doesn't have."""
+    rand = random.Random(42)
+    missing = record_tree(root, RECORDED)
+    write(root, '/proc/stat', proc_stat(rand, cpus))
+    for cpu in xrange(cpus):
+        for name in ('cpuinfo_min_freq', 'cpuinfo_max_freq', 'scaling_cur_freq'):
+            write(root, '/sys/devices/system/cpu/cpu%d/cpufreq/%s' % (cpu, name),
+                  '%d\n' % rand.randint(1200000, 3600000))
+    write(root, '/proc/diskstats', proc_diskstats(rand, disks))
+    for disk in xrange(disks):
+        os.makedirs(os.path.join(root, 'sys/block/%s/device' % disk_name(disk)))
+    write(root, '/proc/net/tcp', proc_net_tcp(rand, sockets))
+    write(root, '/proc/net/tcp6', proc_net_tcp(rand, 0))
+    build_cgroups(root, rand, containers)
+    build_processes(root, rand, processes)
+    write(root, 'jmx.json', json.dumps(jmx_dump(rand, beans)))
+    write(root, 'jolokia.json', json.dumps(jolokia_dump(rand, servlets)))
+    return missing
+
+
+def proc_stat(rand, cpus):
+    def cpu_line(name):
+        return '%s %s\n' % (name, ' '.join(str(rand.randint(0, 10 ** 8)) for _ in xrange(10)))
+    lines = [cpu_line('cpu')] + [cpu_line('cpu%d' % cpu) for cpu in xrange(cpus)]
+    lines.append('intr %s\n' % ' '.join(str(rand.randint(0, 10 ** 6)) for _ in xrange(256)))
+    lines.append('ctxt %d\nbtime 1500000000\nprocesses %d\nprocs_running 3\nprocs_blocked 0\n'
+                 % (rand.randint(0, 10 ** 10), rand.randint(0, 10 ** 6)))
+    lines.append('softirq %s\n' % ' '.join(str(rand.randint(0, 10 ** 6)) for _ in xrange(11)))
+    return ''.join(lines)
+
+
+def disk_name(disk):
+    return 'sd' + chr(ord('a') + disk % 26) * (disk / 26 + 1)
+
+
+def proc_diskstats(rand, disks):
+    lines = []
+    for disk in xrange(disks):
+        name = disk_name(disk)
+        for partition in ('',) + tuple(str(p) for p in xrange(1, 4)):
+            lines.append('%4d %7d %s%s %s\n' % (8, disk * 16 + len(partition), name, partition,
+                                                ' '.join(str(rand.randint(0, 10 ** 9)) for _ in xrange(11))))
+    return ''.join(lines)
+
+
+def proc_net_tcp(rand, sockets):
+    lines = ['  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt'
+             '   uid  timeout inode\n']
+    for i in xrange(sockets):
+        lines.append('%6d: %08X:%04X %08X:%04X %02X %08X:%08X 00:00000000 00000000 %5d        0 %d 1 '
+                     '0000000000000000 20 4 30 10 -1\n'
+                     % (i, rand.getrandbits(32), rand.choice((22, 80, 443, 3306, 8080)),
+                        rand.getrandbits(32), rand.randint(1024, 65535), rand.choice((1, 1, 1, 6, 8, 10)),
+                        rand.randint(0, 4096), rand.randint(0, 4096), rand.choice((0, 0, 1000)),
+                        rand.randint(10 ** 6, 10 ** 8)))
+    return ''.join(lines)
+
+
+def build_processes(root, rand, processes):
+    """The stat, io and cmdline of processes in /proc/[pid]."""
+    for pid in xrange(1, processes + 1):
+        comm = rand.choice(('java', 'python', 'nginx', 'kworker/0:1', 'sshd'))
+        write(root, '/proc/%d/stat' % pid,
+              '%d (%s) S 1 %d %d 0 -1 4194560 %s 20 0 1 0 %d %d %d %s\n'
+              % (pid, comm, pid, pid, ' '.join(str(rand.randint(0, 10 ** 6)) for _ in xrange(8)),
+                 rand.randint(0, 10 ** 7), rand.randint(0, 10 ** 10), rand.randint(0, 10 ** 6),
+                 ' '.join('0' for _ in xrange(28))))
+        write(root, '/proc/%d/io' % pid,
+              'rchar: %d\nwchar: %d\nsyscr: 0\nsyscw: 0\nread_bytes: %d\nwrite_bytes: %d\n'
+              'cancelled_write_bytes: 0\n' % tuple(rand.randint(0, 10 ** 9) for _ in xrange(4)))
+        write(root, '/proc/%d/cmdline' % pid, '' if comm.startswith('kworker') else
+              '/usr/bin/%s\0--config\0/etc/%s/%d.conf\0' % (comm, comm, pid))
+
+
+def build_cgroups(root, rand, containers):
+    for i in xrange(containers):
+        container = '%064x' % rand.getrandbits(256)
+        for controller in CGROUP_CONTROLLERS:
+            path = '/sys/fs/cgroup/%s/docker/%s/' % (controller, container)
+            if controller == 'cpuacct':
+                write(root, path + 'cpuacct.stat', 'user %d\nsystem %d\n'
+                      % (rand.randint(0, 10 ** 7), rand.randint(0, 10 ** 7)))
+            elif controller == 'memory':
+                write(root, path + 'memory.stat', ''.join(
+                    '%s %d\n' % (name, rand.randint(0, 10 ** 9))
+                    for name in ('cache', 'rss', 'rss_huge', 'mapped_file', 'pgpgin', 'pgpgout', 'pgfault',
+                                 'pgmajfault', 'swap', 'active_anon', 'inactive_anon', 'active_file',
+                                 'inactive_file', 'unevictable', 'hierarchical_memory_limit',
+                                 'hierarchical_memsw_limit', 'total_cache', 'total_rss')))
+            else:
+                write(root, path + 'blkio.io_service_bytes', ''.join(
+                    '8:%d %s %d\n' % (minor, op, rand.randint(0, 10 ** 9))
+                    for minor in (0, 16) for op in ('Read', 'Write', 'Sync', 'Async', 'Total')))
+
+
+def jmx_dump(rand, beans):
+    """A NameNode /jmx page."""
+    dump = [{'name': 'java.lang:type=Memory',
+             'HeapMemoryUsage': {'committed': 1 << 30, 'init': 1 << 28, 'max': 1 << 32, 'used': 1 << 29},
+             'ObjectPendingFinalizationCount': 0},
+            {'name': 'java.lang:type=Threading', 'ThreadCount': 120, 'PeakThreadCount': 180,
+             'DaemonThreadCount': 100}]
+    for i in xrange(beans):
+        bean = {'name': 'Hadoop:service=NameNode,name=RpcDetailedActivityForPort%d,sub=Rpc%d' % (8020 + i % 4, i),
+                'modelerType': 'RpcDetailedActivityForPort%d' % (8020 + i % 4), 'tag.port': str(8020 + i % 4)}
+        for j in xrange(20):
+            bean['Method%dNumOps' % j] = rand.randint(0, 10 ** 6)
+            bean['Method%dAvgTime' % j] = rand.random() * 10
+        dump.append(bean)
+    return {'beans': dump}
+
+
+def jolokia_dump(rand, servlets):
+    """The answer of a Tomcat's Jolokia agent to the bulk read of the tomcat
+       collector."""
+    port = PORT_PLACEHOLDER
+    usage = lambda: dict((key, rand.randint(0, 1 << 30)) for key in ('init', 'used', 'committed', 'max'))
+    values = [
+        ('Catalina:name="http-bio-%s",type=GlobalRequestProcessor' % port,
+         dict((key, rand.randint(0, 10 ** 9)) for key in ('bytesSent', 'bytesReceived', 'processingTime',
+                                                          'errorCount', 'maxTime', 'requestCount'))),
+        ('Catalina:name="http-bio-%s",type=ThreadPool' % port,
+         dict((key, rand.randint(0, 200)) for key in ('connectionCount', 'currentThreadCount',
+                                                      'currentThreadsBusy', 'maxThreads'))),
+        ('java.lang:type=Memory', {'HeapMemoryUsage': usage(), 'NonHeapMemoryUsage': usage()}),
+        ('java.lang:type=Threading',
+         dict((key, rand.randint(0, 10 ** 6)) for key in ('CurrentThreadCpuTime', 'PeakThreadCount',
+                                                          'DaemonThreadCount', 'TotalStartedThreadCount',
+                                                          'CurrentThreadUserTime', 'ThreadCount'))),
+        ('java.lang:name=PS Scavenge,type=GarbageCollector',
+         {'LastGcInfo': {'GcThreadCount': 8,
+                         'memoryUsageAfterGc': dict((space, usage()) for space in (
+                             'PS Survivor Space', 'PS Eden Space', 'PS Old Gen', 'Code Cache', 'PS Perm Gen'))},
+          'CollectionCount': rand.randint(0, 10 ** 5), 'CollectionTime': rand.randint(0, 10 ** 7)}),
+        ('java.lang:type=OperatingSystem',
+         dict((key, rand.randint(0, 10 ** 9)) for key in (
+             'FreePhysicalMemorySize', 'FreeSwapSpaceSize', 'AvailableProcessors', 'ProcessCpuLoad',
+             'TotalSwapSpaceSize', 'ProcessCpuTime', 'SystemLoadAverage', 'OpenFileDescriptorCount',
+             'MaxFileDescriptorCount', 'TotalPhysicalMemorySize', 'CommittedVirtualMemorySize',
+             'SystemCpuLoad'))),
+        ('Catalina:J2EEApplication=none,J2EEServer=none,WebModule=*,j2eeType=Servlet,name=*',
+         dict(('Catalina:J2EEApplication=none,J2EEServer=none,WebModule=//localhost/app%d,'
+               'j2eeType=Servlet,name=servlet%d' % (i % 20, i),
+               dict((key, rand.randint(0, 10 ** 6)) for key in ('requestCount', 'processingTime', 'errorCount')))
+              for i in xrange(servlets))),
+        ('Catalina:context=*,host=*,type=Cache',
+         dict(('Catalina:context=/app%d,host=localhost,type=Cache' % i,
+               {'accessCount': rand.randint(0, 10 ** 6), 'hitsCount': rand.randint(0, 10 ** 6)})
+              for i in xrange(20))),
+        ('Catalina:J2EEApplication=none,J2EEServer=none,WebModule=*,name=jsp,type=JspMonitor',
+         dict(('Catalina:J2EEApplication=none,J2EEServer=none,WebModule=//localhost/app%d,'
+               'name=jsp,type=JspMonitor' % i,
+               dict((key, rand.randint(0, 100)) for key in ('jspUnloadCount', 'jspCount', 'jspReloadCount',
+                                                            'jspQueueLength')))
+              for i in xrange(20))),
+    ]
+    return [{'request': {'type': 'read', 'mbean': mbean}, 'value': value,
+             'timestamp': 1500000000, 'status': 200} for mbean, value in values]
+
+
+class FixtureRoot(object):
+    """Redirects what the collectors read under REDIRECTED into a fixture
+       tree, by patching open(), glob and the os functions they use to look
+       around.  Only meant for the benchmark process."""
+
+    def __init__(self, root):
+        self.root = root.rstrip('/')
+        self.saved = None
+
+    def path(self, path):
+        if isinstance(path, basestring) and (path.startswith(REDIRECTED) or path + '/' in REDIRECTED) \
+                and path not in LIVE:
+            return self.root + path
+        return path
+
+    def __enter__(self):
+        saved = self.saved = {}
+        prefix = len(self.root)
+
+        def patch(owner, name, replacement):
+            saved[(owner, name)] = getattr(owner, name)
+            setattr(owner, name, replacement)
+
+        def redirect(func):
+            return lambda path, *args, **kwargs: func(self.path(path), *args, **kwargs)
+
+        for owner, name in ((__builtin__, 'open'), (os, 'listdir'), (os, 'access'), (os.path, 'isdir'),
+                            (os.path, 'isfile'), (os.path, 'exists')):
+            patch(owner, name, redirect(getattr(owner, name)))
+        real_glob = glob.glob
+        patch(glob, 'glob', lambda pattern: [
+            found[prefix:] if found.startswith(self.root) else found for found in real_glob(self.path(pattern))])
+        return self
+
+    def __exit__(self, *exc_info):
+        for (owner, name), func in self.saved.iteritems():
+            setattr(owner, name, func)
+        self.saved = None
+
+
+class FixtureHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers GET /jmx with jmx.json and POSTs to /jolokia/ with
+       jolokia.json of the fixture tree."""
+
+    def do_GET(self):
+        if self.path.startswith('/jmx'):
+            self.answer('jmx.json')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/jolokia'):
+            self.answer('jolokia.json')
+        else:
+            self.send_error(404)
+
+    def answer(self, name):
+        with open(os.path.join(self.server.root, name)) as f:
+            body = f.read().replace(PORT_PLACEHOLDER, str(self.server.server_port))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DockerHandler(SocketServer.StreamRequestHandler):
+    """Answers the container inspection of the docker collector, chunked
+       like the docker daemon does."""
+
+    def handle(self):
+        request = self.rfile.readline().split()
+        container = request[1].split('/')[2] if len(request) > 1 else 'unknown'
+        body = json.dumps({'Id': container, 'Name': '/container-%s' % container[:12],
+                           'Config': {'Image': 'registry/app:%s' % container[:4]}})
+        self.wfile.write('HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         'Transfer-Encoding: chunked\r\n\r\n%x\r\n%s\r\n0\r\n\r\n' % (len(body), body))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class StubServers(object):
+    """The HTTP server of the JMX and Jolokia collectors, and the docker
+       daemon socket, served from a fixture tree."""
+
+    def __init__(self, root):
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHTTPHandler)
+        self.http.root = root
+        self.port = self.http.server_port
+        docker_socket = os.path.join(root, 'var/run/docker.sock')
+        if not os.path.isdir(os.path.dirname(docker_socket)):
+            os.makedirs(os.path.dirname(docker_socket))
+        if os.path.exists(docker_socket):
+            os.remove(docker_socket)
+        self.docker = ThreadingUnixServer(docker_socket, DockerHandler)
+        for server in (self.http, self.docker):
+            thread = threading.Thread(target=server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+
+    def close(self):
+        for server in (self.http, self.docker):
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Compares the shared collectors.lib.procfs snapshots with the way the
+builtin collectors used to read /proc: every collector with its own file
+objects, seek(0), then an uncompiled re.match per line.  Several collectors
+read the same files in a tick, --readers sets how many."""
+
+from __future__ import absolute_import
+
+import re
+import sys
+import time
+from optparse import OptionParser
+
+from collectors.lib import procfs
+
+FILES = ('/proc/meminfo', '/proc/vmstat', '/proc/stat', '/proc/net/tcp')
+
+
+def legacy_parse(path, f):
+    f.seek(0)
+    values = 0
+    if path == '/proc/meminfo':
+        for line in f:
+            if re.match("(\w+):\s+(\d+)\s+(\w+)", line):
+                values += 1
+    elif path == '/proc/net/tcp':
+        for line in f:
+            if line.split(None, 9)[0] != 'sl':
+                values += 1
+    else:
+        for line in f:
+            if re.match("(\w+)\s+(.*)", line):
+                values += 1
+    return values
+
+
+def snapshot_parse(path, max_age):
+    values = 0
+    if path == '/proc/meminfo':
+        for line in procfs.read_lines(path, max_age):
+            fields = line.split()
+            if len(fields) == 3 and fields[0][:-1].replace('_', '').isalnum() and fields[1].isdigit():
+                values += 1
+    elif path == '/proc/net/tcp':
+        for line in procfs.read_lines(path, max_age):
+            if line.split(None, 9)[0] != 'sl':
+                values += 1
+    else:
+        for line in procfs.read_lines(path, max_age):
+            if line.partition(' ')[2]:
+                values += 1
+    return values
+
+
+def legacy(readers, ticks):
+    handles = [dict((path, open(path)) for path in FILES) for _ in xrange(readers)]
+    values = 0
+    for _ in xrange(ticks):
+        for files in handles:
+            for path, f in files.iteritems():
+                values += legacy_parse(path, f)
+    for files in handles:
+        for f in files.itervalues():
+            f.close()
+    return values
+
+
+def snapshots(readers, ticks):
+    values = 0
+    for _ in xrange(ticks):
+        # a new tick, the first reader reads the files and the others
+        # share its snapshot
+        for reader in xrange(readers):
+            for path in FILES:
+                values += snapshot_parse(path, None if reader else 0)
+    return values
+
+
+def run(func, readers, ticks, rounds):
+    best = None
+    for _ in xrange(rounds):
+        start = time.time()
+        values = func(readers, ticks)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, values
+
+
+def main(argv):
+    parser = OptionParser(description='Benchmarks reading and parsing /proc files.')
+    parser.add_option('--readers', type='int', default=3,
+                      help='Collectors reading the files every tick. default=%default')
+    parser.add_option('--ticks', type='int', default=100,
+                      help='Number of ticks per run. default=%default')
+    parser.add_option('--rounds', type='int', default=5,
+                      help='Number of runs, the best one is reported. default=%default')
+    options, args = parser.parse_args(args=argv[1:])
+
+    print '%d readers of %s, %d ticks' % (options.readers, ' '.join(FILES), options.ticks)
+    results = {}
+    for name, func in (('legacy', legacy), ('procfs', snapshots)):
+        elapsed, values = run(func, options.readers, options.ticks, options.rounds)
+        results[name] = elapsed
+        print '%-8s %8.2f ms  %8d values  %8.3f ms/tick' % (name, elapsed * 1000, values,
+                                                         elapsed * 1000 / options.ticks)
+    print 'speedup  %.1fx' % (results['legacy'] / results['procfs'])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
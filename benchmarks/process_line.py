@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Measures lines/sec through tcollector's ReaderThread.process_line and the
+HTTP sender's JSON entry building, against the regex-per-line parser and
+re-tokenizing sender they replaced, on a synthetic stream."""
+
+import logging
+import re
+import sys
+import time
+from optparse import OptionParser
+
+import tcollector
+
+
+class ListQueue(list):
+    """Stands in for the ReaderQueue so that the run never drops lines."""
+
+    def nput(self, value):
+        self.append(value)
+        return True
+
+
+def make_stream(count, series):
+    # stay below tcollector.MAX_REASONABLE_TIMESTAMP
+    start = 1500000000
+    lines = []
+    for i in xrange(count):
+        lines.append('proc.net.tcp %d %d host=web%02d state=%s port=%d'
+                     % (start + i / series, i % 7, i % series % 50,
+                        ('established', 'time_wait')[i % 2], i % series))
+    return lines
+
+
+def legacy_process_line(col, values, line, readerq, dedupinterval):
+    """ReaderThread.process_line before DataPoint, minus the logging."""
+    col.lines_received += 1
+    if len(line) >= 1024:
+        col.lines_invalid += 1
+        return
+    parsed = re.match('^([-_./a-zA-Z0-9]+)\s+'
+                      '(\d+\.?\d+)\s+'
+                      '(\S+?)'
+                      '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$',
+                      line)
+    if parsed is None:
+        col.lines_invalid += 1
+        return
+    metric, timestamp, value, tags = parsed.groups()
+    timestamp = int(timestamp)
+    if len(str(timestamp)) > 11:
+        pass
+    key = (metric, tags)
+    if key in values:
+        if timestamp <= values[key][3]:
+            col.lines_invalid += 1
+            return
+        if (values[key][0] == value and
+                (timestamp - values[key][3] < dedupinterval)):
+            values[key] = (value, True, line, values[key][3])
+            return
+        if ((values[key][1] or
+                (timestamp - values[key][3] >= dedupinterval))
+                and values[key][0] != value):
+            col.lines_sent += 1
+            readerq.nput(values[key][2])
+    values[key] = (value, False, line, timestamp)
+    col.lines_sent += 1
+    readerq.nput(line)
+
+
+def legacy_http_entries(sendq, tags):
+    metrics = []
+    for line in sendq:
+        parts = line.split(None, 3)
+        if len(parts) == 4:
+            (metric, timestamp, value, raw_tags) = parts
+        else:
+            (metric, timestamp, value) = parts
+            raw_tags = ""
+        metric_tags = {}
+        for tag in raw_tags.strip().split():
+            (tag_key, tag_value) = tag.split("=", 1)
+            metric_tags[tag_key] = tag_value
+        metric_entry = {}
+        metric_entry["metric"] = metric
+        metric_entry["timestamp"] = long(timestamp)
+        metric_entry["value"] = float(value)
+        metric_entry["tags"] = dict(tags).copy()
+        metric_entry["tags"].update(metric_tags)
+        metrics.append(metric_entry)
+    return metrics
+
+
+def run_legacy(lines, dedupinterval, batch):
+    col = tcollector.Collector('bench', 0, 'bench')
+    values = {}
+    reader_time = sender_time = 0
+    queued = 0
+    for i in xrange(0, len(lines), batch):
+        readerq = ListQueue()
+        start = time.time()
+        for line in lines[i:i + batch]:
+            legacy_process_line(col, values, line, readerq, dedupinterval)
+        parsed = time.time()
+        legacy_http_entries(readerq, [('host', 'bench')])
+        reader_time += parsed - start
+        sender_time += time.time() - parsed
+        queued += len(readerq)
+    return reader_time, sender_time, queued
+
+
+def run_datapoints(lines, dedupinterval, batch):
+    col = tcollector.Collector('bench', 0, 'bench')
+    reader = tcollector.ReaderThread(dedupinterval, dedupinterval + 1, use_epoll=False)
+    sender = tcollector.SenderThread(reader, True, [('localhost', 4242)], False,
+                                     {'host': 'bench'}, http=True)
+    room = sender.maxtags - len(sender.tags)
+    reader_time = sender_time = 0
+    queued = 0
+    for i in xrange(0, len(lines), batch):
+        reader.readerq = ListQueue()
+        start = time.time()
+        for line in lines[i:i + batch]:
+            reader.process_line(col, line)
+        parsed = time.time()
+        # send_data_via_http() would json.dumps and print in dry-run mode,
+        # time only the entry building that used to re-split every line
+        for dp in reader.readerq:
+            entry = {"metric": dp.metric, "timestamp": long(dp.timestamp),
+                     "value": float(dp.value), "tags": dict(sender.tags)}
+            entry["tags"].update(dp.tags[:room])
+        reader_time += parsed - start
+        sender_time += time.time() - parsed
+        queued += len(reader.readerq)
+    return reader_time, sender_time, queued
+
+
+def main(argv):
+    parser = OptionParser(description='Benchmarks collector line parsing.')
+    parser.add_option('--lines', type='int', default=1000000,
+                      help='Number of lines in the stream. default=%default')
+    parser.add_option('--series', type='int', default=1000,
+                      help='Number of distinct series. default=%default')
+    parser.add_option('--dedup-interval', dest='dedupinterval', type='int', default=300,
+                      help='Dedup interval of the reader. default=%default')
+    parser.add_option('--batch', type='int', default=tcollector.MAX_SENDQ_SIZE,
+                      help='Lines handed from the reader to the sender at once. '
+                           'default=%default')
+    options, args = parser.parse_args(args=argv[1:])
+
+    logging.disable(logging.CRITICAL)
+    lines = make_stream(options.lines, options.series)
+    print '%d lines, %d series' % (len(lines), options.series)
+    results = {}
+    for name, func in (('legacy', run_legacy), ('datapoint', run_datapoints)):
+        parse, send, queued = func(lines, options.dedupinterval, options.batch)
+        results[name] = parse + send
+        print ('%-10s reader %7.0f ms  sender %7.0f ms  %8d queued  %9.0f lines/s'
+               % (name, parse * 1000, send * 1000, queued, len(lines) / (parse + send)))
+    print 'speedup    %.2fx' % (results['legacy'] / results['datapoint'])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
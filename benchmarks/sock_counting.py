@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Compares the two ways Procnettcp counts TCP sockets, parsing
+/proc/net/tcp{,6} and dumping them over netlink sock_diag, on a synthetic
+socket table of loopback connections this process opens."""
+
+from __future__ import absolute_import
+
+import resource
+import socket
+import sys
+import time
+from optparse import OptionParser
+
+import runner
+from collectors.lib import procfs
+from collectors.lib import sock_diag
+
+
+def open_connections(count):
+    """Opens count loopback connections, both ends of which are kept."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = count * 2 + 100
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+        count = min(count, (min(needed, hard) - 100) / 2)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    sockets = [listener]
+    for _ in xrange(count):
+        sockets.append(socket.create_connection(listener.getsockname()))
+        sockets.append(listener.accept()[0])
+    return sockets
+
+
+def run(count, rounds):
+    best = None
+    for _ in xrange(rounds):
+        counter = {}
+        start = time.time()
+        count(counter)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, sum(counter.itervalues())
+
+
+def main(argv):
+    parser = OptionParser(description='Benchmarks counting TCP sockets.')
+    parser.add_option('--connections', type='int', default=20000,
+                      help='Loopback connections to open, two sockets each. default=%default')
+    parser.add_option('--rounds', type='int', default=5,
+                      help='Number of runs, the best one is reported. default=%default')
+    options, args = parser.parse_args(args=argv[1:])
+
+    if not sock_diag.available():
+        print 'netlink sock_diag is not available here'
+        return 1
+    sockets = open_connections(options.connections)
+    # every round reads /proc afresh
+    procfs.SNAPSHOT_AGE = 0
+    collector = runner.load_collector_module('procnettcp', 'collectors/builtin', 'Procnettcp')(None, None, None)
+    print '%d sockets open' % len(sockets)
+    results = {}
+    for name, count in (('procfs', collector.count_procfs), ('netlink', collector.count_netlink)):
+        elapsed, counted = run(count, options.rounds)
+        results[name] = elapsed
+        print '%-8s %8.2f ms  %8d sockets  %10.0f sockets/s' % (name, elapsed * 1000, counted, counted / elapsed)
+    print 'speedup  %.1fx' % (results['procfs'] / results['netlink'])
+    for sock in sockets:
+        sock.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
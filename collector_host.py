@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Hosts one interval Python collector for tcollector.py, when it runs with
+   --host-collectors.  tcollector.py starts it once as
+
+       collector_host.py <collector script>
+
+   The script is imported a single time, then every line on stdin forks a
+   child which calls the script's main().  The child writes to the stdout
+   and stderr of the host, which tcollector.py reads like those of a spawned
+   script.  A child which fails ends the host with its status, so
+   tcollector.py treats it like the script failing on its own."""
+
+import imp
+import os
+import select
+import signal
+import sys
+import time
+import traceback
+
+KILL_GRACE = 5  # seconds an overstaying run gets between SIGTERM and SIGKILL
+
+
+def load(filename):
+    """Imports the collector script without running it as __main__."""
+    sys.argv = [filename]
+    sys.path.insert(0, os.path.dirname(filename))
+    name = os.path.splitext(os.path.basename(filename))[0].replace('-', '_')
+    return imp.load_source('hosted_%s' % name, filename)
+
+
+def exit_status(code):
+    """The process exit status sys.exit(code) would give."""
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+def run(module):
+    """Runs the collector in the forked child, never returns."""
+    status = 1
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, sys.stdin.fileno())
+        os.close(devnull)
+        status = exit_status(module.main())
+    except SystemExit, e:
+        status = exit_status(e.code)
+    except:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def main(argv):
+    module = load(argv[1])
+    if not callable(getattr(module, 'main', None)):
+        sys.stderr.write('%s has no main() to run\n' % argv[1])
+        return 1
+
+    stdin = sys.stdin.fileno()
+    child = None
+    pending = False
+    kill_at = None
+    while True:
+        # while a run is going, wake up every second to reap it
+        timeout = 1 if child else None
+        readable = select.select([stdin], [], [], timeout)[0]
+        if readable:
+            # requests which piled up only make for one run
+            if not os.read(stdin, 4096):
+                break
+            if child:
+                # the previous run overstayed, stop it the way tcollector.py
+                # stops scripts
+                sys.stderr.write('run of pid %d overstayed its welcome, SIGTERM sent\n' % child)
+                os.kill(child, signal.SIGTERM)
+                kill_at = time.time() + KILL_GRACE
+                pending = True
+            else:
+                child = os.fork()
+                if not child:
+                    run(module)
+        if child:
+            pid, status = os.waitpid(child, os.WNOHANG)
+            if pid:
+                child = kill_at = None
+                if os.WIFSIGNALED(status):
+                    return 128 + os.WTERMSIG(status)
+                if os.WEXITSTATUS(status):
+                    return os.WEXITSTATUS(status)
+                if pending:
+                    pending = False
+                    child = os.fork()
+                    if not child:
+                        run(module)
+            elif kill_at and time.time() >= kill_at:
+                os.kill(child, signal.SIGKILL)
+                kill_at = None
+
+    if child:
+        os.kill(child, signal.SIGTERM)
+        os.waitpid(child, 0)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
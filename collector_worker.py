@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Runs one collector in a process of its own, for the collectors whose conf
+   sets isolation=process.  runner.py starts it as
+
+       collector_worker.py <collector dir> <conf file> <name>
+
+   and writes one line to its stdin per run.  The metric lines of a run are
+   streamed back on stdout, followed by a '#done <cpu seconds> <rss kb>' line.
+   Closing stdin cleans the collector up and ends the process."""
+
+import ConfigParser
+import logging
+import os
+import resource
+import sys
+
+import runner
+
+LOG = logging.getLogger('collector_worker')
+DONE = '#done'
+
+
+class PipeQueue(object):
+    """The readq of the collector, writes its lines to the runner."""
+
+    def __init__(self, out):
+        self.out = out
+
+    def nput(self, line):
+        self.out.write(line + '\n')
+        self.out.flush()
+        return True
+
+    def nput_batch(self, lines):
+        self.out.write('\n'.join(lines) + '\n')
+        self.out.flush()
+        return True
+
+
+def rss_kb():
+    """Current resident set size of this process in kB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main(argv):
+    collector_dir, conf_path, name = argv[1:4]
+    handler = logging.StreamHandler(sys.stderr)
+    # the runner logs these lines at the level they start with
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    LOG.addHandler(handler)
+    LOG.setLevel(logging.INFO)
+
+    # stdout belongs to the protocol, anything the collector prints goes to stderr
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    conf = ConfigParser.SafeConfigParser(runner.default_config())
+    conf.read(conf_path)
+    collector_class = runner.load_collector_module(name, os.path.join(collector_dir, 'builtin'),
+                                                   conf.get(runner.SECTION_BASE, runner.CONFIG_COLLECTOR_CLASS))
+    collector = collector_class(conf, LOG, PipeQueue(out))
+
+    for _ in iter(sys.stdin.readline, ''):
+        try:
+            collector()
+        except:
+            LOG.exception('failed to execute collector %s', name)
+        finally:
+            collector.flush()
+        user, system = os.times()[:2]
+        out.write('%s %f %d\n' % (DONE, user + system, rss_kb()))
+        out.flush()
+
+    collector.signal_exit()
+    collector.cleanup()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,6 +1,8 @@
 import time
 from collectors.lib.collectorbase import CollectorBase, MetricType
-import requests
+from collectors.lib import utils
+
+requests = utils.lazy_import('requests')
 
 header={
 "Accept":"text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
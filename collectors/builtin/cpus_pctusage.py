@@ -23,54 +23,71 @@ This plugin tracks, for all CPUs:
 - system %
 - interrupt %
 - idle %
+- iowait %
+- steal %
 
-Requirements :
-- FreeBSD : top
-- Linux : mpstat
+from the deltas of /proc/stat since the previous run, Linux only.
 '''
 
 import time
-import os
-import psutil
 
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib import procfs
+from collectors.lib import rates
+
+# /proc/stat cpu columns, guest time is already counted in user and nice
+FIELDS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal')
+# metrics sent, as indexes into FIELDS
+METRICS = (('cpu.usr', 0), ('cpu.nice', 1), ('cpu.sys', 2), ('cpu.irq', 5), ('cpu.idle', 3),
+           ('cpu.iowait', 4), ('cpu.steal', 7))
 
 
 class CpusPctusage(CollectorBase):
     def __init__(self, config, logger, readq):
         super(CpusPctusage, self).__init__(config, logger, readq)
-        os.environ['LANG'] = "en_US.UTF-8"
+        procfs.proc_file("/proc/stat")
+        self.rates = rates.engine("cpus_pctusage")
 
     def __call__(self):
         try:
-           cpus_count=psutil.cpu_count()
-           for cpu_id in range(cpus_count):
-               cpu_info_list=psutil.cpu_times_percent(interval=1,percpu=True)
-               if(cpu_info_list is not None and len(cpu_info_list)>0):
-                   timestamp = int(time.time())
-                   cpu_info = cpu_info_list[0]
-                   cpuid=str(cpu_id)
-                   cpuuser = cpu_info.user
-                   cpunice = cpu_info.nice
-                   cpusystem = cpu_info.system
-                   cpuinterrupt = cpu_info.irq
-                   cpuidle = cpu_info.idle
-                   self._readq.nput("cpu.usr %s %s cpu=%s" % (timestamp, cpuuser, cpuid))
-                   self._readq.nput("cpu.nice %s %s cpu=%s" % (timestamp, cpunice, cpuid))
-                   self._readq.nput("cpu.sys %s %s cpu=%s" % (timestamp, cpusystem, cpuid))
-                   self._readq.nput("cpu.irq %s %s cpu=%s" % (timestamp, cpuinterrupt, cpuid))
-                   self._readq.nput("cpu.idle %s %s cpu=%s" % (timestamp, cpuidle, cpuid))
-                   self._readq.nput("cpu.state %s %s" % (int(time.time()), '0'))
+            timestamp = int(time.time())
+            cpus = []
+            series = []
+            values = []
+            for line in procfs.read_lines("/proc/stat"):
+                if not line.startswith("cpu") or line.startswith("cpu "):
+                    continue
+                fields = line.split()
+                cpus.append(fields[0][3:])
+                # kernels before 2.6.11 have no steal column
+                fields = fields[1:len(FIELDS) + 1] + ["0"] * (len(FIELDS) + 1 - len(fields))
+                for i, value in enumerate(fields):
+                    series.append((cpus[-1], i))
+                    values.append(int(value))
+
+            deltas = self.rates.update(series, values)[0]
+            width = len(FIELDS)
+            for n, cpuid in enumerate(cpus):
+                cpu_deltas = deltas[n * width:(n + 1) * width]
+                if cpu_deltas.count(None) == width:
+                    # first run for this cpu
+                    continue
+                # per-cpu iowait goes back now and then on NO_HZ kernels,
+                # that field counts as 0 for this run
+                cpu_deltas = [delta or 0 for delta in cpu_deltas]
+                total = sum(cpu_deltas)
+                if not total:
+                    continue
+                for metric, i in METRICS:
+                    self._readq.nput("%s %s %.1f cpu=%s" % (metric, timestamp, 100.0 * cpu_deltas[i] / total, cpuid))
+            self._readq.nput("cpu.state %s %s" % (int(time.time()), '0'))
 
         except Exception as e:
             self._readq.nput("cpu.state %s %s" % (int(time.time()), '1'))
             self.log_error("cpus_pctusage collector except exception when parse the filed, abort %s" % e)
 
 
-
-
 if __name__ == "__main__":
     from Queue import Queue
     cpus_pctusage_inst = CpusPctusage(None, None, Queue())
     cpus_pctusage_inst()
-
@@ -32,6 +32,7 @@
 import os
 import time
 
+from collectors.lib import procfs
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
@@ -51,16 +52,15 @@ FSTYPE_IGNORE = frozenset([
 class Dfstat(CollectorBase):
     def __init__(self, config, logger, readq):
         super(Dfstat, self).__init__(config, logger, readq)
-        self.f_mounts = open("/proc/mounts", "r")
+        procfs.proc_file("/proc/mounts")
 
     def __call__(self):
         with utils.lower_privileges(self._logger):
             ret_metrics = []
             devices = []
-            self.f_mounts.seek(0)
             ts = int(time.time())
 
-            for line in self.f_mounts:
+            for line in procfs.read_lines("/proc/mounts"):
                 # Docs come from the fstab(5)
                 # fs_spec     # Mounted block special device or remote filesystem
                 # fs_file     # Mount point
@@ -145,9 +145,6 @@ class Dfstat(CollectorBase):
                 self._readq.nput("df.state %d %s" % (ts, "0"))
             return ret_metrics
 
-    def cleanup(self):
-        self.safe_close(self.f_mounts)
-
 
 if __name__ == "__main__":
     from Queue import Queue
@@ -4,12 +4,13 @@
 import calendar
 import sys
 import time
-import requests
 from Queue import Queue
 
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
+requests = utils.lazy_import('requests')
+
 DEFAULT_TIMEOUT = 10.0  # seconds
 ALAUDA_HOST = "api.alauda.io"
 ALAUDA_PORT = 443  # TCP port on which Alauda entpoint listens.
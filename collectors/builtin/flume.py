@@ -1,6 +1,8 @@
 import time
-import requests
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib import utils
+
+requests = utils.lazy_import('requests')
 
 # reference: http://flume.apache.org/FlumeUserGuide.html#json-reporting
 # restart flume
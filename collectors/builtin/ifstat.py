@@ -17,6 +17,8 @@
 import time
 import re
 
+from collectors.lib import procfs
+from collectors.lib import rates
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
@@ -40,11 +42,16 @@ FIELDS = ("bytes", "packets", "errs", "dropped",
           "bytes", "packets", "errs", "dropped",
           "fifo.errs", "collisions", "carrier.errs", "compressed")
 
+INTERFACE_RE = re.compile("\s+(eth?\d+|em\d+_\d+/\d+|em\d+_\d+|em\d+|"
+                          "p\d+p\d+_\d+/\d+|p\d+p\d+_\d+|p\d+p\d+):(.*)")
+
 
 class Ifstat(CollectorBase):
     def __init__(self, config, logger, readq):
         super(Ifstat, self).__init__(config, logger, readq)
-        self.f_netdev = open("/proc/net/dev")
+        procfs.proc_file("/proc/net/dev")
+        # the counters are unsigned longs
+        self.rates = rates.engine("ifstat", wrap=2 ** 64)
 
     def __call__(self):
         with utils.lower_privileges(self._logger):
@@ -54,11 +61,11 @@ class Ifstat(CollectorBase):
             # stats are still kept on the child interfaces when
             # you bond.  By skipping bond we avoid double counting.
 
-            self.f_netdev.seek(0)
             ts = int(time.time())
-            for line in self.f_netdev:
-                m = re.match("\s+(eth?\d+|em\d+_\d+/\d+|em\d+_\d+|em\d+|"
-                             "p\d+p\d+_\d+/\d+|p\d+p\d+_\d+|p\d+p\d+):(.*)", line)
+            series = []
+            values = []
+            for line in procfs.read_lines("/proc/net/dev"):
+                m = INTERFACE_RE.match(line)
                 if not m:
                     continue
                 intf = m.group(1)
@@ -69,10 +76,14 @@ class Ifstat(CollectorBase):
                         return "out"
                     return "in"
                 for i in xrange(16):
+                    series.append((FIELDS[i], direction(i), intf))
+                    values.append(int(stats[i]))
                     self._readq.nput("proc.net.%s.%s %d %s iface=%s" % (FIELDS[i], direction(i), ts, stats[i], intf))
 
-    def cleanup(self):
-        self.safe_close(self.f_netdev)
+            # and their per-second rates
+            for (field, side, intf), rate in zip(series, self.rates.update(series, values)[1]):
+                if rate is not None:
+                    self._readq.nput("proc.net.%s.%s.rate %d %.2f iface=%s" % (field, side, ts, rate, intf))
 
 
 if __name__ == "__main__":
@@ -68,7 +68,8 @@
 import time
 import os
 import re
-import copy
+from collectors.lib import procfs
+from collectors.lib import rates
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
@@ -94,31 +95,9 @@ FIELDS_PART = (
     "write_sectors",
 )
 
-prev_times = (0, 0)
-
-
-def read_uptime():
-    global prev_times, f_uptime
-    try:
-        f_uptime = open("/proc/uptime")
-        line = f_uptime.readline()
-
-        curr_times = line.split(None)
-        delta_times = (float(curr_times[0]) - float(prev_times[0]), float(curr_times[1]) - float(prev_times[1]))
-        prev_times = curr_times
-        return delta_times
-    finally:
-        f_uptime.close()
-
-
-def get_system_hz():
-    """Return system hz use SC_CLK_TCK."""
-    ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
-
-    if ticks == -1:
-        return 100
-    else:
-        return ticks
+# counters the svctm and await of a device are computed from, as indexes
+# into FIELDS_DISK
+DELTA_FIELDS = (0, 4, 3, 7, 9)  # read_requests, write_requests, msec_read, msec_write, msec_total
 
 
 def is_device(device_name, allow_virtual):
@@ -137,29 +116,13 @@ def is_device(device_name, allow_virtual):
 class Iostat(CollectorBase):
     def __init__(self, config, logger, readq):
         super(Iostat, self).__init__(config, logger, readq)
-        self.f_diskstats = open("/proc/diskstats")
-        self.hz = get_system_hz()
+        procfs.proc_file("/proc/diskstats")
+        self.rates = rates.engine("iostat")
 
     def __call__(self):
-        init_stats = {
-            "read_requests": 0,
-            "read_merged": 0,
-            "read_sectors": 0,
-            "msec_read": 0,
-            "write_requests": 0,
-            "write_merged": 0,
-            "write_sectors": 0,
-            "msec_write": 0,
-            "ios_in_progress": 0,
-            "msec_total": 0,
-            "msec_weighted_total": 0,
-        }
-        prev_stats = dict()
         with utils.lower_privileges(self._logger):
-            self.f_diskstats.seek(0)
             ts = int(time.time())
-            itv = read_uptime()[0]
-            for line in self.f_diskstats:
+            for line in procfs.read_lines("/proc/diskstats"):
                 # maj, min, devicename, [list of stats, see above]
                 values = line.split(None)
                 # shortcut the deduper and just skip disks that
@@ -181,46 +144,24 @@ class Iostat(CollectorBase):
                     for i in range(11):
                         self._readq.nput("%s%s %d %s dev=%s" % (metric, FIELDS_DISK[i], ts, values[i + 3], device))
 
-                    ret = is_device(device, 0)
-                    # if a device or a partition, calculate the svctm/await/util
-                    if ret:
-                        stats = dict(zip(FIELDS_DISK, values[3:]))
-                        if device not in prev_stats:
-                            prev_stats[device] = init_stats
-                        rd_ios = float(stats.get("read_requests"))
-                        wr_ios = float(stats.get("write_requests"))
+                    # if a device or a partition, calculate the svctm/await
+                    # over the counters' deltas since the previous run
+                    if is_device(device, 0):
+                        deltas = self.rates.update([(device, i) for i in DELTA_FIELDS],
+                                                   [int(values[i + 3]) for i in DELTA_FIELDS])[0]
+                        if None in deltas:
+                            # first run, or the counters were reset
+                            continue
+                        rd_ios, wr_ios, rd_ticks, wr_ticks, total_ticks = deltas
                         nr_ios = rd_ios + wr_ios
-                        prev_rd_ios = float(prev_stats[device].get("read_requests"))
-                        prev_wr_ios = float(prev_stats[device].get("write_requests"))
-                        prev_nr_ios = prev_rd_ios + prev_wr_ios
-                        tput = ((nr_ios - prev_nr_ios) * float(self.hz) / float(itv))
-                        util = ((float(stats.get("msec_total")) - float(prev_stats[device].get("msec_total"))) * float(self.hz) / float(itv))
-                        svctm = 0.0
-                        await = 0.0
-                        r_await = 0.0
-                        w_await = 0.0
-
-                        if tput:
-                            svctm = util / tput
-
-                        rd_ticks = stats.get("msec_read")
-                        wr_ticks = stats.get("msec_write")
-                        prev_rd_ticks = prev_stats[device].get("msec_read")
-                        prev_wr_ticks = prev_stats[device].get("msec_write")
-                        if rd_ios != prev_rd_ios:
-                            r_await = (float(rd_ticks) - float(prev_rd_ticks)) / float(rd_ios - prev_rd_ios)
-                        if wr_ios != prev_wr_ios:
-                            w_await = (float(wr_ticks) - float(prev_wr_ticks)) / float(wr_ios - prev_wr_ios)
-                        if nr_ios != prev_nr_ios:
-                            await = (float(rd_ticks) + float(wr_ticks) - float(prev_rd_ticks) - float(prev_wr_ticks)) / float(nr_ios - prev_nr_ios)
+                        svctm = total_ticks / nr_ios if nr_ios else 0.0
+                        r_await = rd_ticks / rd_ios if rd_ios else 0.0
+                        w_await = wr_ticks / wr_ios if wr_ios else 0.0
+                        await = (rd_ticks + wr_ticks) / nr_ios if nr_ios else 0.0
                         self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "svctm", ts, svctm, device))
                         self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "r_await", ts, r_await, device))
                         self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "w_await", ts, w_await, device))
                         self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "await", ts, await, device))
-                        # can't work for our
-                        #self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "util", ts, float(util / 1000.0), device))
-
-                        prev_stats[device] = copy.deepcopy(stats)
 
                 elif len(values) == 7:
                     # partial stats line
@@ -230,9 +171,6 @@ class Iostat(CollectorBase):
                     self.log_error("Cannot parse /proc/diskstats line: %s", line)
                     continue
 
-    def cleanup(self):
-        self.safe_close(self.f_diskstats)
-
 if __name__ == "__main__":
     from Queue import Queue
     iostat = Iostat(None, None, Queue())
@@ -1,8 +1,9 @@
 import time
-import requests
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
+requests = utils.lazy_import('requests')
+
 # reference by https://hadoop.apache.org/docs/r2.7.2/hadoop-mapreduce-client/hadoop-mapreduce-client-core/MapredAppMasterRest.html
 REST_API = {"YARN_APPS_PATH": "ws/v1/cluster/apps",
             "MAPREDUCE_JOBS_PATH": "ws/v1/mapreduce/jobs"}
@@ -62,6 +62,7 @@ import resource
 import time
 from Queue import Queue
 
+from collectors.lib import procfs
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
@@ -218,13 +219,11 @@ class Netstat(CollectorBase):
 
         self.page_size = resource.getpagesize()
         try:
-            self.sockstat = open("/proc/net/sockstat")
-            self.netstat = open("/proc/net/netstat")
-            self.snmp = open("/proc/net/snmp")
+            for path in ("/proc/net/sockstat", "/proc/net/netstat", "/proc/net/snmp"):
+                procfs.proc_file(path)
         except IOError:
             self._readq.nput("netstat.state %s %s" % (int(time.time()), '1'))
             self.log_exception('open failed')
-            self.cleanup()
             raise
         with utils.lower_privileges(self._logger):
             # Note: up until v2.6.37-rc2 most of the values were 32 bits.
@@ -293,20 +292,12 @@ class Netstat(CollectorBase):
                 if value is not None:
                     self.print_netstat(statstype, metric, ts, value, tags)
 
-    def cleanup(self):
-        self.safe_close(self.sockstat)
-        self.safe_close(self.netstat)
-        self.safe_close(self.snmp)
-
     def __call__(self):
         ts = int(time.time())
-        self.sockstat.seek(0)
-        self.netstat.seek(0)
-        self.snmp.seek(0)
-        data = self.sockstat.read()
-        netstats = self.netstat.read()
-        snmpstats = self.snmp.read()
-        m = re.match(self.regexp, data)
+        data = procfs.read("/proc/net/sockstat")
+        netstats = procfs.read("/proc/net/netstat")
+        snmpstats = procfs.read("/proc/net/snmp")
+        m = self.regexp.match(data)
         if not m:
             self.log_error("Cannot parse sockstat: %r", data)
             raise
@@ -327,8 +318,8 @@ class Netstat(CollectorBase):
         self.print_sockstat("memory", ts, m.group("ip_frag_mem"), " type=ipfrag")
         self.print_sockstat("ipfragqueues", ts, m.group("ip_frag_nqueues"))
 
-        self.parse_stats(netstats, self.netstat.name, ts)
-        self.parse_stats(snmpstats, self.snmp.name, ts)
+        self.parse_stats(netstats, "/proc/net/netstat", ts)
+        self.parse_stats(snmpstats, "/proc/net/snmp", ts)
         self._readq.nput("netstat.state %s %s" % (int(time.time()), '0'))
 
 
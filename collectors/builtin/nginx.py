@@ -17,10 +17,12 @@
 import calendar
 import time
 import re
-import requests
 from Queue import Queue
 
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib import utils
+
+requests = utils.lazy_import('requests')
 
 
 # There are two ways to collect Nginx's stats.
@@ -1,6 +1,8 @@
 import time
-import requests
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib import utils
+
+requests = utils.lazy_import('requests')
 
 
 # reference by http://opentsdb.net/docs/build/html/api_http/stats/index.html
@@ -26,39 +26,33 @@
 
 # Metric: proc.net.tcp
 
-# For each run, we classify each connection and generate subtotals.
-#   TSD will automatically total these up when displaying
-#   the graph, but you can drill down for each possible total or a
-#   particular one.  This does generate a large amount of datapoints,
-#   as the number of points is (S*(U+1)*V) (currently ~400), where
-#   S=number of TCP states, U=Number of users to track, and
-#   V=number of services (collections of ports)
+# For each run, we count the connections by state (state=) and by
+#   service (service=, collections of ports) and generate subtotals.
+#   TSD will automatically total these up when displaying the graph,
+#   but you can drill down for each possible total or a particular one.
+#   The number of points is S*V (currently 110), where S=number of TCP
+#   states and V=number of services.
 # The deduper does dedup this down very well, as only 3 of the 10
 # TCP states are generally ever seen, and most servers only run one
-# service under one user.  On a typical server this dedups down to
-# under 10 values per interval.
+# service.  On a typical server this dedups down to under 10 values per
+# interval.
 
-# Each connection is broken down with a tag for user=username (see
-#   "users" list below) or put under "other" if not in the list.
-#   Expand this for any users you care about.
-# It is also broken down for each state (state=).
-# It is also broken down into services (collections of ports)
-
-# Note that once a connection is closed, Linux seems to forget who
-# opened/handled the connection.  For connections in time_wait, for
-# example, they will always show user=root.
+# With backend = auto (the default) or netlink in procnettcp.conf the
+# sockets are dumped over NETLINK_SOCK_DIAG, which is much cheaper than
+# parsing /proc/net/tcp text with many connections.  /proc is read when
+# netlink is not available, or with backend = procfs.
 
 import os
-import pwd
+import socket
 import time
 
+from collectors.lib import procfs
+from collectors.lib import sock_diag
 from collectors.lib import utils
 from Queue import Queue
 from collectors.lib.collectorbase import CollectorBase
 
 
-USERS = ("root", "www-data", "mysql")
-
 # Note if a service runs on multiple ports and you
 # want to collectively map them up to a single service,
 # just give them the same name below
@@ -120,26 +114,10 @@ TCPSTATES = {
     "0B": "closing",
     }
 
+# the same, by the kernel's TCP_* state numbers
+STATE_NAMES = dict((int(state, 16), name) for state, name in TCPSTATES.iteritems())
 
-def is_public_ip(ipstr):
-    """
-    Take a /proc/net/tcp encoded src or dest string
-    Return True if it is coming from public IP space
-    (i.e. is not RFC1918, loopback, or broadcast).
-    This string is the hex ip:port of the connection.
-    (ip is reversed)
-    """
-    addr = ipstr.split(":")[0]
-    addr = int(addr, 16)
-    byte1 = addr & 0xFF
-    byte2 = (addr >> 8) & 0xFF
-    if byte1 in (10, 0, 127):
-        return False
-    if byte1 == 172 and byte2 > 16:
-        return False
-    if byte1 == 192 and byte2 == 168:
-        return False
-    return True
+BACKENDS = ("auto", "netlink", "procfs")
 
 
 class Procnettcp(CollectorBase):
@@ -150,88 +128,83 @@ class Procnettcp(CollectorBase):
         except OSError:
             self.log_exception("warning: failed to self-renice:")
 
-        # resolve the list of users to match on into UIDs
-        self.uids = {}
-        for user in USERS:
-            try:
-                self.uids[str(pwd.getpwnam(user)[2])] = user
-            except KeyError:
-                continue
+        backend = self.get_config("backend", "auto")
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of %s, not %r" % (", ".join(BACKENDS), backend))
+        self.netlink = backend != "procfs" and sock_diag.available()
+        if backend == "netlink" and not self.netlink:
+            self.log_warn("netlink sock_diag is not available, reading /proc/net/tcp instead")
 
         try:
-            self.tcp = open("/proc/net/tcp")
+            procfs.proc_file("/proc/net/tcp")
+            self.procfiles = ["/proc/net/tcp"]
             # if IPv6 is enabled, even IPv4 connections will also
             # appear in tcp6. It has the same format, apart from the
-            # address size
-            try:
-                self.tcp6 = open("/proc/net/tcp6")
-            except IOError, (errno, msg):
-                if errno == 2:  # No such file => IPv6 is disabled.
-                    self.tcp6 = None
-                else:
-                    raise
+            # address size.  No such file => IPv6 is disabled.
+            if procfs.exists("/proc/net/tcp6"):
+                self.procfiles.append("/proc/net/tcp6")
         except IOError:
             self._readq.nput("procnettcp.state %s %s" % (int(time.time()), '1'))
             self.log_exception("Failed to open proc/net/tcp file")
-            self.cleanup()
             raise
 
-    def cleanup(self):
-        self.safe_close(self.tcp)
-        self.safe_close(self.tcp6)
-
     def __call__(self):
         with utils.lower_privileges(self._logger):
             counter = {}
-
-            for procfile in (self.tcp, self.tcp6):
-                if procfile is None:
-                    continue
-                procfile.seek(0)
-                ts = int(time.time())
-                for line in procfile:
-                    try:
-                        # pylint: disable=W0612
-                        (num, src, dst, state, queue, when, retrans,
-                         uid, timeout, inode) = line.split(None, 9)
-                    except ValueError:  # Malformed line
-                        continue
-
-                    if num == "sl":  # header
-                        continue
-
-                    srcport = src.split(":")[1]
-                    dstport = dst.split(":")[1]
-                    srcport = int(srcport, 16)
-                    dstport = int(dstport, 16)
-                    service = PORTS.get(srcport, "other")
-                    service = PORTS.get(dstport, service)
-
-                    if is_public_ip(dst) or is_public_ip(src):
-                        endpoint = "external"
-                    else:
-                        endpoint = "internal"
-
-                    user = self.uids.get(uid, "other")
-
-                    key = "state=" + TCPSTATES[state] + " endpoint=" + endpoint + \
-                          " service=" + service + " user=" + user
-                    if key in counter:
-                        counter[key] += 1
-                    else:
-                        counter[key] = 1
+            if self.netlink:
+                try:
+                    self.count_netlink(counter)
+                except sock_diag.NetlinkError:
+                    self.log_exception("netlink sock_diag failed, reading /proc/net/tcp from now on")
+                    self.netlink = False
+                    counter = {}
+            if not self.netlink:
+                self.count_procfs(counter)
+            ts = int(time.time())
 
             # output the counters
             for state in TCPSTATES:
                 for service in SERVICES + ("other",):
-                    key = ("state=%s service=%s" % (TCPSTATES[state],service))
-                    if key in counter:
-                        self._readq.nput("proc.net.tcp {0} {1} {2}".format(ts, counter[key], key))
-                    else:
-                        self._readq.nput("proc.net.tcp {0} {1} {2}".format(ts, "0", key))
+                    key = ("state=%s service=%s" % (TCPSTATES[state], service))
+                    self._readq.nput("proc.net.tcp {0} {1} {2}".format(ts, counter.get((TCPSTATES[state], service), 0), key))
 
             self._readq.nput("procnettcp.state %s %s" % (int(time.time()), '0'))
 
+    def count_procfs(self, counter):
+        """Counts the sockets of /proc/net/tcp{,6} in counter, by (state,
+           service)."""
+        for procfile in self.procfiles:
+            for line in procfs.read_lines(procfile):
+                try:
+                    # pylint: disable=W0612
+                    (num, src, dst, state, queue, when, retrans,
+                     uid, timeout, inode) = line.split(None, 9)
+                except ValueError:  # Malformed line
+                    continue
+
+                if num == "sl":  # header
+                    continue
+
+                srcport = src.split(":")[1]
+                dstport = dst.split(":")[1]
+                srcport = int(srcport, 16)
+                dstport = int(dstport, 16)
+                service = PORTS.get(srcport, "other")
+                service = PORTS.get(dstport, service)
+
+                key = (TCPSTATES[state], service)
+                counter[key] = counter.get(key, 0) + 1
+
+    def count_netlink(self, counter):
+        """The same over netlink sock_diag, for the same address families."""
+        families = [socket.AF_INET]
+        if "/proc/net/tcp6" in self.procfiles:
+            families.append(socket.AF_INET6)
+        for family in families:
+            for state, srcport, dstport, _, _, _, _, _ in sock_diag.tcp_sockets(family):
+                key = (STATE_NAMES.get(state), PORTS.get(dstport) or PORTS.get(srcport, "other"))
+                counter[key] = counter.get(key, 0) + 1
+
 
 if __name__ == "__main__":
     procnettcp_inst = Procnettcp(None, None, Queue())
@@ -21,6 +21,8 @@ import time
 import glob
 from Queue import Queue
 
+from collectors.lib import procfs
+from collectors.lib import rates
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
@@ -48,163 +50,144 @@ def find_sysfs_numa_stats():
     return numastats
 
 
+VMSTAT_FIELDS = frozenset(("pgpgin", "pgpgout", "pswpin", "pswpout", "pgfault", "pgmajfault"))
+CPU_TYPES = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'guest', 'guest_nice')
+
+
+def is_word(s):
+    """Whether s would match the regex \w+."""
+    return s != "" and s.replace("_", "").isalnum()
+
+
 class Procstats(CollectorBase):
     def __init__(self, config, logger, readq):
         super(Procstats, self).__init__(config, logger, readq)
         try:
-            self.f_uptime = open("/proc/uptime", "r")
-            self.f_meminfo = open("/proc/meminfo", "r")
-            self.f_vmstat = open("/proc/vmstat", "r")
-            self.f_stat = open("/proc/stat", "r")
-            self.f_loadavg = open("/proc/loadavg", "r")
-            self.f_entropy_avail = open("/proc/sys/kernel/random/entropy_avail", "r")
-            self.f_interrupts = open("/proc/interrupts", "r")
+            for path in ("/proc/uptime", "/proc/meminfo", "/proc/vmstat", "/proc/stat", "/proc/loadavg",
+                         "/proc/sys/kernel/random/entropy_avail", "/proc/interrupts"):
+                procfs.proc_file(path)
+            self.softirqs = procfs.exists("/proc/softirqs")
+            if not self.softirqs:
+                self.log_warn("unable to process /proc/softirqs")
 
             self.f_scaling = "/sys/devices/system/cpu/cpu%s/cpufreq/%s_freq"
-            self.f_scaling_min = dict([])
-            self.f_scaling_max = dict([])
-            self.f_scaling_cur = dict([])
-            try:
-                self.f_softirqs = open("/proc/softirqs", "r")
-            except:
-                self.log_warn("unable to process /proc/softirqs")
-                self.f_softirqs = None
-                
+            self.scaling_cpus = []
             for cpu in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq"):
                 m = re.match("/sys/devices/system/cpu/cpu([0-9]*)/cpufreq/scaling_cur_freq", cpu)
                 if not m:
                     continue
                 cpu_no = m.group(1)
-                sys.stderr.write(self.f_scaling % (cpu_no, "min"))
-                self.f_scaling_min[cpu_no] = open(self.f_scaling % (cpu_no, "cpuinfo_min"), "r")
-                self.f_scaling_max[cpu_no] = open(self.f_scaling % (cpu_no, "cpuinfo_max"), "r")
-                self.f_scaling_cur[cpu_no] = open(self.f_scaling % (cpu_no, "scaling_cur"), "r")
+                for name in ("cpuinfo_min", "cpuinfo_max", "scaling_cur"):
+                    procfs.proc_file(self.f_scaling % (cpu_no, name))
+                self.scaling_cpus.append(cpu_no)
 
             self.numastats = find_sysfs_numa_stats()
+            self.rates = rates.engine("procstats")
         except:
             self._readq.nput("procstats.state %s %s" % (int(time.time()), '1'))
-            self.cleanup()
             raise
 
-    def cleanup(self):
-        self.safe_close(self.f_uptime)
-        self.safe_close(self.f_meminfo)
-        self.safe_close(self.f_vmstat)
-        self.safe_close(self.f_stat)
-        self.safe_close(self.f_loadavg)
-        self.safe_close(self.f_entropy_avail)
-        self.safe_close(self.f_interrupts)
-        if self.f_softirqs is not None:
-            self.safe_close(self.f_softirqs)
-        self._cleanup_dict(self.f_scaling_min)
-        self._cleanup_dict(self.f_scaling_max)
-        self._cleanup_dict(self.f_scaling_cur)
-
-    def _cleanup_dict(self, d):
-        for key, val in d.iteritems():
-            self.safe_close(val)
-
     def __call__(self):
         with utils.lower_privileges(self._logger):
             # proc.uptime
-            self.f_uptime.seek(0)
             ts = int(time.time())
-            for line in self.f_uptime:
-                m = re.match("(\S+)\s+(\S+)", line)
-                if m:
-                    self._readq.nput("proc.uptime.total %d %s" % (ts, m.group(1)))
-                    self._readq.nput("proc.uptime.now %d %s" % (ts, m.group(2)))
+            fields = procfs.read("/proc/uptime").split()
+            if len(fields) >= 2:
+                self._readq.nput("proc.uptime.total %d %s" % (ts, fields[0]))
+                self._readq.nput("proc.uptime.now %d %s" % (ts, fields[1]))
 
             # proc.meminfo
-            self.f_meminfo.seek(0)
             ts = int(time.time())
             mem_total = 0
             mem_free = 0
             mem_buffers = 0
             mem_cached = 0
-            for line in self.f_meminfo:
-                m = re.match("(\w+):\s+(\d+)\s+(\w+)", line)
-                if m:
-                    if m.group(3).lower() == 'kb':
-                        # convert from kB to B for easier graphing
-                        value = str(int(m.group(2)) * 1024)
-                    else:
-                        value = m.group(2)
-                    self._readq.nput("proc.meminfo.%s %d %s" % (m.group(1).lower(), ts, value))
-                    if m.group(1) == 'MemTotal':
-                        mem_total = float(m.group(2)) * 1024
-                    if m.group(1) == 'MemFree':
-                        mem_free = float(m.group(2)) * 1024
-                    if m.group(1) == 'Buffers':
-                        mem_buffers = float(m.group(2)) * 1024
-                    if m.group(1) == 'Cached':
-                        mem_cached = float(m.group(2)) * 1024
+            for line in procfs.read_lines("/proc/meminfo"):
+                # "Name:   1234 kB", lines without a unit are left out
+                fields = line.split()
+                if len(fields) < 3 or not fields[0].endswith(":"):
+                    continue
+                name, value, unit = fields[0][:-1], fields[1], fields[2]
+                if not (is_word(name) and value.isdigit() and is_word(unit)):
+                    continue
+                if unit.lower() == 'kb':
+                    # convert from kB to B for easier graphing
+                    self._readq.nput("proc.meminfo.%s %d %d" % (name.lower(), ts, int(value) * 1024))
+                else:
+                    self._readq.nput("proc.meminfo.%s %d %s" % (name.lower(), ts, value))
+                if name == 'MemTotal':
+                    mem_total = float(value) * 1024
+                elif name == 'MemFree':
+                    mem_free = float(value) * 1024
+                elif name == 'Buffers':
+                    mem_buffers = float(value) * 1024
+                elif name == 'Cached':
+                    mem_cached = float(value) * 1024
             percentused = 100 * (mem_total - mem_free - mem_buffers - mem_cached) / mem_total
             self._readq.nput("proc.meminfo.%s %d %s" % ("percentused", ts, percentused))
 
+            # counters which are also sent as per-second rates
+            counters = []
+            values = []
+
             # proc.vmstat
-            self.f_vmstat.seek(0)
             ts = int(time.time())
-            for line in self.f_vmstat:
-                m = re.match("(\w+)\s+(\d+)", line)
-                if not m:
-                    continue
-                if m.group(1) in ("pgpgin", "pgpgout", "pswpin",
-                                  "pswpout", "pgfault", "pgmajfault"):
-                    self._readq.nput("proc.vmstat.%s %d %s" % (m.group(1), ts, m.group(2)))
+            for line in procfs.read_lines("/proc/vmstat"):
+                name, _, value = line.partition(" ")
+                if name in VMSTAT_FIELDS:
+                    self._readq.nput("proc.vmstat.%s %d %s" % (name, ts, value.strip()))
+                    counters.append("proc.vmstat." + name)
+                    values.append(int(value))
 
             # proc.stat
-            self.f_stat.seek(0)
             ts = int(time.time())
-            for line in self.f_stat:
-                m = re.match("(\w+)\s+(.*)", line)
-                if not m:
-                    continue
-                if m.group(1).startswith("cpu"):
-                    cpu_m = re.match("cpu(\d+)", m.group(1))
-                    if cpu_m:
+            for line in procfs.read_lines("/proc/stat"):
+                name, _, value = line.partition(" ")
+                if name.startswith("cpu"):
+                    if name[3:].isdigit():
                         metric_percpu = '.percpu'
-                        tags = ' cpu=%s' % cpu_m.group(1)
+                        tags = ' cpu=%s' % name[3:]
                     else:
                         metric_percpu = ''
                         tags = ''
-                    fields = m.group(2).split()
-                    cpu_types = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'guest', 'guest_nice']
-
                     # We use zip to ignore fields that don't exist.
-                    for value, field_name in zip(fields, cpu_types):
+                    for value, field_name in zip(value.split(), CPU_TYPES):
                         self._readq.nput("proc.stat.cpu%s %d %s type=%s%s" % (metric_percpu, ts, value, field_name, tags))
-                elif m.group(1) == "intr":
-                    self._readq.nput("proc.stat.intr %d %s" % (ts, m.group(2).split()[0]))
-                elif m.group(1) == "ctxt":
-                    self._readq.nput("proc.stat.ctxt %d %s" % (ts, m.group(2)))
-                elif m.group(1) == "processes":
-                    self._readq.nput("proc.stat.processes %d %s" % (ts, m.group(2)))
-                elif m.group(1) == "procs_blocked":
-                    self._readq.nput("proc.stat.procs_blocked %d %s" % (ts, m.group(2)))
+                elif name == "intr":
+                    value = value.split()[0]
+                    self._readq.nput("proc.stat.intr %d %s" % (ts, value))
+                    counters.append("proc.stat.intr")
+                    values.append(int(value))
+                elif name in ("ctxt", "processes"):
+                    self._readq.nput("proc.stat.%s %d %s" % (name, ts, value.strip()))
+                    counters.append("proc.stat." + name)
+                    values.append(int(value))
+                elif name == "procs_blocked":
+                    self._readq.nput("proc.stat.procs_blocked %d %s" % (ts, value.strip()))
+
+            for metric, rate in zip(counters, self.rates.update(counters, values)[1]):
+                if rate is not None:
+                    self._readq.nput("%s.rate %d %.2f" % (metric, ts, rate))
 
-            self.f_loadavg.seek(0)
             ts = int(time.time())
-            for line in self.f_loadavg:
-                m = re.match("(\S+)\s+(\S+)\s+(\S+)\s+(\d+)/(\d+)\s+", line)
-                if not m:
-                    continue
-                self._readq.nput("proc.loadavg.1min %d %s" % (ts, m.group(1)))
-                self._readq.nput("proc.loadavg.5min %d %s" % (ts, m.group(2)))
-                self._readq.nput("proc.loadavg.15min %d %s" % (ts, m.group(3)))
-                self._readq.nput("proc.loadavg.runnable %d %s" % (ts, m.group(4)))
-                self._readq.nput("proc.loadavg.total_threads %d %s" % (ts, m.group(5)))
+            fields = procfs.read("/proc/loadavg").split()
+            if len(fields) >= 5:
+                runnable, _, total_threads = fields[3].partition("/")
+                self._readq.nput("proc.loadavg.1min %d %s" % (ts, fields[0]))
+                self._readq.nput("proc.loadavg.5min %d %s" % (ts, fields[1]))
+                self._readq.nput("proc.loadavg.15min %d %s" % (ts, fields[2]))
+                self._readq.nput("proc.loadavg.runnable %d %s" % (ts, runnable))
+                self._readq.nput("proc.loadavg.total_threads %d %s" % (ts, total_threads))
 
-            self.f_entropy_avail.seek(0)
             ts = int(time.time())
-            for line in self.f_entropy_avail:
+            for line in procfs.read_lines("/proc/sys/kernel/random/entropy_avail"):
                 self._readq.nput("proc.kernel.entropy_avail %d %s" % (ts, line.strip()))
 
-            self.f_interrupts.seek(0)
             ts = int(time.time())
+            lines = procfs.read_lines("/proc/interrupts")
             # Get number of CPUs from description line.
-            num_cpus = len(self.f_interrupts.readline().split())
-            for line in self.f_interrupts:
+            num_cpus = len(lines[0].split())
+            for line in lines[1:]:
                 cols = line.split()
 
                 irq_type = cols[0].rstrip(":")
@@ -224,46 +207,33 @@ class Procstats(CollectorBase):
                             self.log_error("Unexpected interrupts value %r in %r: ", val, cols)
                             break
                         self._readq.nput("proc.interrupts %s %s type=%s cpu=%s" % (ts, val, irq_type, i))
-            if self.f_softirqs is not None:
-            	self.f_softirqs.seek(0)
-            	ts = int(time.time())
-            	# Get number of CPUs from description line.
-            	num_cpus = len(self.f_softirqs.readline().split())
-            	for line in self.f_softirqs:
+            if self.softirqs:
+                ts = int(time.time())
+                lines = procfs.read_lines("/proc/softirqs")
+                # Get number of CPUs from description line.
+                num_cpus = len(lines[0].split())
+                for line in lines[1:]:
                     cols = line.split()
                     irq_type = cols[0].rstrip(":")
                     for i, val in enumerate(cols[1:]):
-                    	if i >= num_cpus:
+                        if i >= num_cpus:
                             # All values read, remaining cols contain textual
                             # description
                             break
-                    	if not val.isdigit():
+                        if not val.isdigit():
                             # something is weird, there should only be digit values
                             self.log_error("Unexpected softirq value %r in %r: ", val, cols)
                             break
-                    	self._readq.nput("proc.softirqs %s %s type=%s cpu=%s" % (ts, val, irq_type, i))
+                        self._readq.nput("proc.softirqs %s %s type=%s cpu=%s" % (ts, val, irq_type, i))
 
             self._print_numa_stats(self.numastats)
 
             # Print scaling stats
-            ts = int(time.time())
-            for cpu_no in self.f_scaling_min.keys():
-                f = self.f_scaling_min[cpu_no]
-                f.seek(0)
-                for line in f:
-                    self._readq.nput("proc.scaling.min %d %s cpu=%s" % (ts, line.rstrip('\n'), cpu_no))
-            ts = int(time.time())
-            for cpu_no in self.f_scaling_max.keys():
-                f = self.f_scaling_max[cpu_no]
-                f.seek(0)
-                for line in f:
-                    self._readq.nput("proc.scaling.max %d %s cpu=%s" % (ts, line.rstrip('\n'), cpu_no))
-            ts = int(time.time())
-            for cpu_no in self.f_scaling_cur.keys():
-                f = self.f_scaling_cur[cpu_no]
-                f.seek(0)
-                for line in f:
-                    self._readq.nput("proc.scaling.cur %d %s cpu=%s" % (ts, line.rstrip('\n'), cpu_no))
+            for name, metric in (("cpuinfo_min", "min"), ("cpuinfo_max", "max"), ("scaling_cur", "cur")):
+                ts = int(time.time())
+                for cpu_no in self.scaling_cpus:
+                    for line in procfs.read_lines(self.f_scaling % (cpu_no, name)):
+                        self._readq.nput("proc.scaling.%s %d %s cpu=%s" % (metric, ts, line, cpu_no))
 
             self._readq.nput("procstats.state %s %s" % (int(time.time()), '0'))
 
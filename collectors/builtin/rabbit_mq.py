@@ -8,8 +8,9 @@ from collectors.lib.utils import remove_invalid_characters
 from collectors.lib.collectorbase import CollectorBase
 
 # 3p
-import requests
-from requests.exceptions import RequestException
+from collectors.lib import utils
+
+requests = utils.lazy_import('requests')
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'rabbitmq'
 QUEUE_TYPE = 'queues'
@@ -183,7 +184,7 @@ class RabbitMq(CollectorBase):
             r = requests.get(url, auth=auth, proxies=proxies, timeout=10, verify=ssl_verify)
             r.raise_for_status()
             return r.json()
-        except RequestException as e:
+        except requests.exceptions.RequestException as e:
             raise RabbitMqException('Cannot open RabbitMQ API url: {} {}'.format(url, str(e)))
         except ValueError as e:
             raise RabbitMqException('Cannot parse JSON response from API url: {} {}'.format(url, str(e)))
@@ -1,7 +1,9 @@
-import requests
 import time
 from collectors.lib.collectorbase import CollectorBase
 from collectors.lib.utils import remove_invalid_characters
+from collectors.lib import utils
+
+requests = utils.lazy_import('requests')
 
 
 class ResponseTime(CollectorBase):
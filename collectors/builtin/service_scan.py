@@ -1,10 +1,11 @@
-import psutil
 import time
 
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 from collectors.lib.utils import TestQueue, TestLogger
 
+psutil = utils.lazy_import('psutil')
+
 
 class ServiceScan(CollectorBase):
     def __init__(self, config, logger, readq):
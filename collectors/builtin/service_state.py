@@ -1,10 +1,11 @@
-import psutil
 import socket
 import time
 
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
+psutil = utils.lazy_import('psutil')
+
 # We assume service_name_to_cmd_map = { 'procXYZ' : "its unique cmd', 'proc123': 'unique cmd' } in config.
 class ServiceState(CollectorBase):
     def __init__(self, config, logger, readq):
@@ -1,7 +1,9 @@
 import time
-import requests
 from HTMLParser import HTMLParser
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib import utils
+
+requests = utils.lazy_import('requests')
 
 SPARK_STANDALONE_MODE = 'spark_standalone_mode'
 SPARK_YARN_MODE = 'spark_yarn_mode'
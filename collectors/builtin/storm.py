@@ -1,8 +1,9 @@
 import time
-import requests
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
+requests = utils.lazy_import('requests')
+
 # reference: http://storm.apache.org/releases/1.0.2/STORM-UI-REST-API.html
 REST_API = {"cluster": "/api/v1/cluster/summary",
             "supervisor": "/api/v1/supervisor/summary",
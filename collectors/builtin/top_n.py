@@ -12,16 +12,24 @@
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 #
-"""TopN cpu and memory stats"""
+"""TopN cpu, memory and io stats"""
 
+import heapq
+import os
 import time
-from subprocess import Popen, PIPE, CalledProcessError, STDOUT
-import psutil
+from collectors.lib import procfs
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
-# We collect top N usages of CPU,MEM,IO processes by calling "ps -Ao xxx".
-# Then we will send metric="cpu.topn", tags:(proc=<pid>_<cmd>), ts=currTimeInSec.
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# We collect the top N processes by CPU, memory and I/O from a single scan of
+# /proc/[pid]/stat and /proc/[pid]/io every run.  CPU and I/O are taken over
+# the interval since the previous scan, so the first run only sends memory,
+# and idle processes are left out of them.
+# Then we will send metric="cpu.topN", tags:(pid_cmd=<pid>_<cmd>), ts=currTimeInSec.
+
 
 class TopN(CollectorBase):
     def print_metric(self, metric, ts, value, tags=""):
@@ -30,46 +38,111 @@ class TopN(CollectorBase):
 
     def __init__(self, config, logger, readq):
         super(TopN, self).__init__(config, logger, readq)
-        self.N = self.get_config("N", 10);
+        self.N = int(self.get_config("N", 10))
+        # pid -> (starttime, cpu ticks, io bytes) of the previous scan, only
+        # the pids alive then are kept
+        self.prev = {}
+        self.prev_time = None
 
     def __call__(self):
-        self.get_top_N("cpu.topN", "pcpu", "pcpu")
-        self.get_top_N("mem.topN", "pmem", "rss")
+        now = time.time()
+        elapsed = now - self.prev_time if self.prev_time else None
+        # percents of the whole box, like ps' pcpu divided by the cpu count
+        cpu_scale = 100.0 / (CLOCK_TICKS * elapsed * os.sysconf('SC_NPROCESSORS_ONLN')) if elapsed else None
+        mem_scale = 100.0 * PAGE_SIZE / self.mem_total()
+
+        top_cpu = []
+        top_mem = []
+        top_io = []
+        current = {}
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            stat = self.read_stat(pid)
+            if stat is None:
+                continue
+            comm, starttime, cpu_ticks, rss = stat
+            io_bytes = read_io(pid)
+            current[pid] = (starttime, cpu_ticks, io_bytes)
+            push(top_mem, self.N, (rss, pid, comm))
+
+            prev = self.prev.get(pid)
+            # a reused pid has another starttime
+            if prev and prev[0] == starttime:
+                if cpu_ticks > prev[1]:
+                    push(top_cpu, self.N, (cpu_ticks - prev[1], pid, comm))
+                if io_bytes is not None and prev[2] is not None and io_bytes > prev[2]:
+                    push(top_io, self.N, (io_bytes - prev[2], pid, comm))
+        self.prev = current
+        self.prev_time = now
 
-    def get_top_N(self, metric, ps_field, ps_sort_by):
+        ts = int(now)
+        for metric, top, scale in (("cpu.topN", top_cpu, cpu_scale), ("mem.topN", top_mem, mem_scale),
+                                   ("io.topN", top_io, 1.0 / elapsed if elapsed else None)):
+            for value, pid, comm in sorted(top, reverse=True):
+                tag = "pid_cmd=%s_%s" % (pid, utils.remove_invalid_characters(command(pid, comm)))
+                self.print_metric(metric, ts, "%.2f" % (value * scale), tag)
+
+    def mem_total(self):
+        for line in procfs.read_lines("/proc/meminfo"):
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+        raise ValueError("no MemTotal in /proc/meminfo")
+
+    def read_stat(self, pid):
+        """Returns the command name, start time, CPU ticks and RSS pages of
+           the process, None if it's gone."""
+        try:
+            with open("/proc/%s/stat" % pid) as f:
+                data = f.read()
+        except IOError:
+            return None
+        # the command name is in parentheses and may contain anything
+        comm_start = data.find("(")
+        comm_end = data.rfind(")")
+        fields = data[comm_end + 2:].split()
         try:
-            p = Popen("ps -Ao comm,pid,%s,cmd --sort=-%s | head -n %s"%(ps_field, ps_sort_by,self.N), shell=True, stdout=PIPE, stderr=STDOUT)
-            for line in p.stdout.readlines():
-                self.process(line, metric)
-
-            out, err = p.communicate()
-            if err:
-                raise CalledProcessError(err, "ps -Ao comm,pid,%s,cmd --sort=-%s | head -n %s" % (
-                ps_field, ps_sort_by, self.N), "ps returned %i" % out)
-        except OSError as e1:
-            self.log_exception("ps -Ao comm,pid,%s,cmd --sort=-%s | head -n %s. [%s]"%(ps_field, ps_sort_by,self.N, e1))
-            return
-
-        except CalledProcessError as e:
-            self.log_exception("Error run ps in subprocess. [%s]", e)
-            return
-
-    def process(self, line, metric):
-        if not ("COMMAND" in line and "PID" in line):
-            tokens = line.split()
-            #cmd = utils.remove_invalid_characters(tokens[0])
-            pid = tokens[1]
-            #print cmd, pid, tokens[2]
-             # cpu or mem
-
-            if 'cpu' in metric:
-                cpu_count=psutil.cpu_count()
-                value = float(tokens[2])/cpu_count
-            else:
-                value = float(tokens[2])
-            full_command = ''.join(tokens[3:len(tokens)])  # full command
-            tag = "pid_cmd=%s_%s"%(pid,utils.remove_invalid_characters(full_command))
-            self.print_metric(metric, (int(time.time())), value, tag)
+            # utime, stime, starttime and rss, see proc(5)
+            return (data[comm_start + 1:comm_end], int(fields[19]),
+                    int(fields[11]) + int(fields[12]), int(fields[21]))
+        except (IndexError, ValueError):
+            self.log_error("Cannot parse /proc/%s/stat: %r", pid, data)
+            return None
+
+
+def push(heap, n, item):
+    """Keeps the n biggest items in the min-heap."""
+    if len(heap) < n:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def read_io(pid):
+    """Returns the bytes the process read and wrote to storage, None if
+       /proc/[pid]/io can't be read, it needs the process' privileges."""
+    try:
+        with open("/proc/%s/io" % pid) as f:
+            data = f.read()
+    except IOError:
+        return None
+    total = 0
+    for line in data.splitlines():
+        name, _, value = line.partition(": ")
+        if name in ("read_bytes", "write_bytes"):
+            total += int(value)
+    return total
+
+
+def command(pid, comm):
+    """The full command line of the process, its name in brackets when it
+       has none, like ps shows kernel threads."""
+    try:
+        with open("/proc/%s/cmdline" % pid) as f:
+            cmdline = f.read()
+    except IOError:
+        cmdline = ""
+    return cmdline.replace("\0", "") or "[%s]" % comm
 
 
 if __name__ == "__main__":
@@ -78,4 +151,3 @@ if __name__ == "__main__":
 
     inst = TopN(None, None, TestQueue())
     inst()
-
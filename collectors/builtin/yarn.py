@@ -1,8 +1,9 @@
 import time
-import requests
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
+requests = utils.lazy_import('requests')
+
 #reference by : https://github.com/DataDog/dd-agent/blob/master/checks.d/yarn.py
 REST_API = {"metrics": "/ws/v1/cluster/metrics",
             "apps": "/ws/v1/cluster/apps",
@@ -52,6 +52,7 @@ def get_defaults():
         'no_tcollector_stats': False,
         'evictinterval': 6000,
         'dedupinterval': 300,
+        'dedup_max_entries': 200000,
         'allowed_inactivity_time': 600,
         'dryrun': False,
         'maxtags': 8,
@@ -69,8 +70,12 @@ def get_defaults():
         'logfile': '/var/log/tcollector.log',
         'cdir': default_cdir,
         'ssl': False,
+        'compression': 'none',
+        'compression_level': 6,
+        'compression_min_size': 1024,
         'stdin': False,
         'daemonize': False,
+        'host_collectors': False,
         'hosts': False
     }
 
@@ -4,14 +4,76 @@ import sys
 import signal
 import os
 import time
+from threading import Lock
 from threading import Thread
 
+BATCH_MAX_LINES = 1000  # lines buffered before they are handed over to the readq
+BATCH_MAX_DELAY = 5  # seconds a line may wait in the buffer of a long running collector
+
+
+class BatchQueue(object):
+    """Stands in for the readq of a collector.  The lines emitted during a
+       run are buffered and handed to the readq as one list with
+       nput_batch when the run ends, so the readq's lock is taken once per
+       run instead of once per line.  Collectors running for long are
+       flushed every BATCH_MAX_LINES lines, and by the scheduler once their
+       oldest line waited BATCH_MAX_DELAY seconds."""
+
+    def __init__(self, readq, max_lines=BATCH_MAX_LINES, max_delay=BATCH_MAX_DELAY):
+        self.readq = readq
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        # held while handing over too, so batches reach the readq in order
+        self.lock = Lock()
+        self.lines = []
+        self.oldest = 0
+        # lines and bytes handed over so far
+        self.lines_emitted = 0
+        self.bytes_emitted = 0
+
+    def nput(self, line):
+        with self.lock:
+            if not self.lines:
+                self.oldest = time.time()
+            self.lines.append(line)
+            if len(self.lines) >= self.max_lines:
+                # the readq drops what doesn't fit, pass its back-pressure on
+                return self._flush()
+            return True
+
+    def flush(self):
+        """Hands the buffered lines over to the readq, returns false if it
+           dropped any."""
+        with self.lock:
+            return self._flush()
+
+    def flush_stale(self, now=None):
+        """Flushes the buffer if its oldest line waited max_delay seconds."""
+        with self.lock:
+            if self.lines and (now or time.time()) - self.oldest >= self.max_delay:
+                return self._flush()
+            return True
+
+    def _flush(self):
+        lines, self.lines = self.lines, []
+        if not lines:
+            return True
+        self.lines_emitted += len(lines)
+        self.bytes_emitted += sum(map(len, lines))
+        if hasattr(self.readq, 'nput_batch'):
+            return self.readq.nput_batch(lines)
+        accepted = True
+        for line in lines:
+            if not self.readq.nput(line):
+                accepted = False
+        return accepted
+
 
 class CollectorBase(object):
     def __init__(self, config, logger, readq):
         self._config = config
         self._logger = logger
-        self._readq = readq
+        self._readq = BatchQueue(readq)
         self._exit = False
         """ long running collector need to check this flag to ensure responsive to shut down request to this collector"""
 
@@ -40,6 +102,30 @@ class CollectorBase(object):
         """
         self._exit = True
 
+    def flush(self):
+        """
+        hands the metrics emitted so far to the readq, called after every run of the collector
+        Returns: None
+
+        """
+        self._readq.flush()
+
+    def flush_stale(self, now=None):
+        """
+        hands the metrics over if the oldest waited BATCH_MAX_DELAY seconds, called by the scheduler during long runs
+        Returns: None
+
+        """
+        self._readq.flush_stale(now)
+
+    def emitted(self):
+        """
+        lines and bytes the collector handed to the readq so far, for the runner's accounting
+        Returns: (lines, bytes)
+
+        """
+        return self._readq.lines_emitted, self._readq.bytes_emitted
+
     # below are convenient methods available to all collectors
     def log_info(self, msg, *args, **kwargs):
         if self._logger:
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Shared reader of the /proc and /sys files the builtin collectors parse.
+
+Every file is opened once per process and read whole into a buffer which
+is reused from one read to the next.  A read is kept as the file's
+snapshot for SNAPSHOT_AGE seconds, so collectors running in the same tick
+parse the same contents instead of each reading the file again."""
+
+import errno
+import os
+import threading
+import time
+
+SNAPSHOT_AGE = 0.5  # seconds a read is shared for, 0 reads every time
+BUFFER_SIZE = 16384  # initial buffer size, doubled while files don't fit
+
+
+class ProcFile(object):
+    """One /proc or /sys file, kept open and read whole from offset 0."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.buf = bytearray(BUFFER_SIZE)
+        self.data = None
+        self.read_at = 0
+        self.file = None
+        self.pid = None
+        self.open()
+
+    def open(self):
+        # unbuffered, readinto goes straight to read(2)
+        self.file = open(self.path, 'rb', 0)
+        # forked collectors would share the file offset with their parent
+        self.pid = os.getpid()
+
+    def read(self, max_age=None):
+        """Returns the contents of the file, the shared snapshot if it's
+           younger than max_age seconds, SNAPSHOT_AGE by default."""
+        if max_age is None:
+            max_age = SNAPSHOT_AGE
+        with self.lock:
+            now = time.time()
+            if self.data is not None and now - self.read_at < max_age and self.pid == os.getpid():
+                return self.data
+            if self.pid != os.getpid():
+                self.open()
+            self.data = self.fill()
+            self.read_at = now
+            return self.data
+
+    def fill(self):
+        self.file.seek(0)
+        size = 0
+        while True:
+            if size == len(self.buf):
+                self.buf.extend(bytearray(len(self.buf)))
+            # seq_file based files return at most what fits, a short read
+            # isn't the end of the file, only an empty one is
+            count = self.file.readinto(memoryview(self.buf)[size:])
+            if not count:
+                break
+            size += count
+        return str(buffer(self.buf, 0, size))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.data = None
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+
+def proc_file(path):
+    """Returns the shared ProcFile of path, opening it if needed.  Raises
+       IOError if the file can't be opened."""
+    with _files_lock:
+        procfile = _files.get(path)
+        if procfile is None:
+            procfile = _files[path] = ProcFile(path)
+        return procfile
+
+
+def read(path, max_age=None):
+    """Returns the contents of path, shared with the other collectors
+       reading it within max_age seconds."""
+    return proc_file(path).read(max_age)
+
+
+def read_lines(path, max_age=None):
+    return read(path, max_age).splitlines()
+
+
+def exists(path):
+    """Returns whether path exists, opening it if it does."""
+    try:
+        proc_file(path)
+    except IOError, e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return False
+        raise
+    return True
+
+
+def uptime(max_age=None):
+    """Returns the uptime and the idle time of /proc/uptime, in seconds."""
+    total, idle = read('/proc/uptime', max_age).split()[:2]
+    return float(total), float(idle)
+
+
+def close_all():
+    """Closes every shared file, the next read opens them again."""
+    with _files_lock:
+        for procfile in _files.itervalues():
+            procfile.close()
+        _files.clear()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Turns counters into deltas and per-second rates for the collectors.
+
+A RateEngine keeps the previous value and time of every series it's fed
+in two array columns, a dict maps the series to their row.  update()
+takes the counters of a whole run at once.  The engines live here, not in
+the collectors, so a reloaded collector picks up where the previous
+instance left off:
+
+    deltas, rates = rates.engine('ifstat').update(series, values)"""
+
+import threading
+import time
+from array import array
+from itertools import izip
+
+MAX_IDLE = 3600  # seconds a series is kept without updates
+
+
+class RateEngine(object):
+    """Previous values of counters, keyed by series.  Counters going back
+       are taken for a wraparound when wrap is set and the wrapped delta is
+       under half of it, for a reset otherwise.  Values are kept as
+       doubles, exact up to 2**53."""
+
+    def __init__(self, wrap=None, max_idle=MAX_IDLE):
+        self.wrap = wrap
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.rows = {}  # series -> row in the columns
+        self.values = array('d')
+        self.times = array('d')
+        self.next_expire = time.time() + max_idle
+
+    def __len__(self):
+        return len(self.rows)
+
+    def update(self, series, values, now=None):
+        """Stores values as the latest of series, two aligned sequences.
+           Returns the lists of deltas and per-second rates since the
+           previous update of each series, None where there is none yet or
+           the counter was reset."""
+        if now is None:
+            now = time.time()
+        deltas = []
+        rates = []
+        with self.lock:
+            rows = self.rows
+            prev_values = self.values
+            prev_times = self.times
+            wrap = self.wrap
+            for key, value in izip(series, values):
+                row = rows.get(key)
+                if row is None:
+                    rows[key] = len(prev_values)
+                    prev_values.append(value)
+                    prev_times.append(now)
+                    deltas.append(None)
+                    rates.append(None)
+                    continue
+                prev = prev_values[row]
+                delta = value - prev
+                elapsed = now - prev_times[row]
+                prev_values[row] = value
+                prev_times[row] = now
+                if delta < 0:
+                    if wrap and prev < wrap and delta + wrap < wrap / 2:
+                        delta += wrap
+                    else:
+                        deltas.append(None)
+                        rates.append(None)
+                        continue
+                deltas.append(delta)
+                rates.append(delta / elapsed if elapsed > 0 else None)
+            if now >= self.next_expire:
+                self._expire(now - self.max_idle)
+                self.next_expire = now + self.max_idle
+        return deltas, rates
+
+    def forget(self, series):
+        """Drops the given series, their next update starts over."""
+        with self.lock:
+            for key in series:
+                # the row is dropped at the next compaction
+                self.rows.pop(key, None)
+
+    def _expire(self, before):
+        """Drops the series last updated before the given time and
+           compacts the columns."""
+        rows = {}
+        values = array('d')
+        times = array('d')
+        for key, row in self.rows.iteritems():
+            if self.times[row] >= before:
+                rows[key] = len(values)
+                values.append(self.values[row])
+                times.append(self.times[row])
+        self.rows = rows
+        self.values = values
+        self.times = times
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def engine(name, wrap=None, max_idle=MAX_IDLE):
+    """Returns the RateEngine called name, creating it on first use.  It
+       outlives the collector instances using it."""
+    with _engines_lock:
+        rate_engine = _engines.get(name)
+        if rate_engine is None:
+            rate_engine = _engines[name] = RateEngine(wrap, max_idle)
+        return rate_engine
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Dumps TCP sockets over NETLINK_SOCK_DIAG (inet_diag), the binary
+interface ss(8) uses, instead of parsing /proc/net/tcp{,6} text.
+
+    for state, sport, dport, src1, src2, dst1, dst2, uid in tcp_sockets(socket.AF_INET):
+        ...
+
+src1, src2 and dst1, dst2 are the address bytes /proc/net/tcp based
+classification looks at: the first two of an IPv4 address, bytes 12 and
+13 of an IPv6 one.  Raises NetlinkError when the kernel can't answer,
+callers fall back to /proc then."""
+
+import errno
+import os
+import socket
+import struct
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+ALL_STATES = 0xffe  # TCP_ESTABLISHED (1) to TCP_CLOSING (11)
+RECV_SIZE = 1 << 20
+
+NLMSGHDR = struct.Struct('=IHHII')
+# inet_diag_req_v2: family, protocol, ext, pad, states, then a zeroed
+# inet_diag_sockid
+INET_DIAG_REQ = struct.Struct('=BBBxI48x')
+NLMSGERR = struct.Struct('=i')
+# inet_diag_msg: state, sport, dport, the address bytes, uid
+INET_DIAG_MSG = {
+    socket.AF_INET: struct.Struct('=xB2xHHBB14xBB14x24xI'),
+    socket.AF_INET6: struct.Struct('=xB2xHH12xBB2x12xBB2x24xI'),
+}
+
+
+class NetlinkError(Exception):
+    pass
+
+
+def available():
+    """Returns whether sock_diag can be queried on this host."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+    except (AttributeError, socket.error):
+        return False
+    sock.close()
+    return True
+
+
+def tcp_sockets(family, states=ALL_STATES):
+    """Yields (state, sport, dport, src1, src2, dst1, dst2, uid) for the
+       TCP sockets of family in one of the states, a bit mask of
+       1 << TCP_* state numbers."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+    except (AttributeError, socket.error), e:
+        raise NetlinkError('no sock_diag: %s' % e)
+    try:
+        request = INET_DIAG_REQ.pack(family, socket.IPPROTO_TCP, 0, states)
+        sock.sendto(NLMSGHDR.pack(NLMSGHDR.size + len(request), SOCK_DIAG_BY_FAMILY,
+                                  NLM_F_REQUEST | NLM_F_DUMP, 1, os.getpid()) + request, (0, 0))
+        while True:
+            try:
+                data = sock.recv(RECV_SIZE)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise NetlinkError('sock_diag dump failed: %s' % e)
+            if not data:
+                raise NetlinkError('sock_diag dump ended early')
+            sockets, done = parse_reply(data, family)
+            for sock_info in sockets:
+                yield sock_info
+            if done:
+                return
+    finally:
+        sock.close()
+
+
+def parse_reply(data, family):
+    """Returns the sockets in one datagram of a dump, as tcp_sockets()
+       yields them, and whether the datagram ended the dump."""
+    unpack_msg = INET_DIAG_MSG[family].unpack_from
+    unpack_hdr = NLMSGHDR.unpack_from
+    hdr_size = NLMSGHDR.size
+    ntohs = socket.ntohs
+    sockets = []
+    offset = 0
+    while offset + hdr_size <= len(data):
+        length, msg_type = unpack_hdr(data, offset)[:2]
+        if length < hdr_size:
+            raise NetlinkError('malformed sock_diag reply')
+        if msg_type == NLMSG_DONE:
+            return sockets, True
+        if msg_type == NLMSG_ERROR:
+            code = -NLMSGERR.unpack_from(data, offset + hdr_size)[0]
+            raise NetlinkError('sock_diag dump failed: %s' % os.strerror(code))
+        if msg_type == SOCK_DIAG_BY_FAMILY:
+            state, sport, dport, src1, src2, dst1, dst2, uid = unpack_msg(data, offset + hdr_size)
+            # ports are in network byte order
+            sockets.append((state, ntohs(sport), ntohs(dport), src1, src2, dst1, dst2, uid))
+        # messages are aligned to 4 bytes
+        offset += (length + 3) & ~3
+    return sockets, False
@@ -19,11 +19,11 @@ import stat
 import pwd
 import errno
 import sys
-import requests
 import subprocess
 import socket
 import ConfigParser
 import re
+import threading
 from Queue import Queue
 from collectors.lib.inventory.linux_network import LinuxNetwork
 from collectors.lib.inventory.linux_platform import Platform
@@ -32,6 +32,40 @@ from collectors.lib.inventory.linux_platform import Platform
 USER = "cwiz-user"
 
 
+class LazyModule(object):
+    """Stands in for a module which is only imported when one of its
+       attributes is first used, so heavy dependencies don't slow down
+       loading collectors which may never need them."""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self.__dict__['_module'] = __import__(self._name, fromlist=['*'])
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._module or self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
+
+
+def lazy_import(name):
+    """Returns the module if it's already imported, a LazyModule otherwise."""
+    return sys.modules.get(name) or LazyModule(name)
+
+
+requests = lazy_import('requests')
+
+
 class RevertibleLowPrivilegeUser(object):
     def __init__(self, low_privelege_user, logger):
         self.low_privilege_user = low_privelege_user
@@ -1,7 +1,17 @@
 #!/usr/bin/env python
 
+import ctypes
+import ctypes.util
+import errno
 import logging
+import os
+import select
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
 from logging.handlers import RotatingFileHandler
 
 
@@ -20,3 +30,192 @@ def setup_logging(logger, logfile, max_bytes=None, backup_count=None):
     ch.setFormatter(logging.Formatter('%(asctime)s %(module)s[%(process)d:%(thread)d]:%(lineno)d '
                                       '%(levelname)s: %(message)s'))
     logger.addHandler(ch)
+
+
+COMPRESSION_METHODS = ('none', 'gzip', 'deflate')
+
+
+def compress_payload(payload, method, level=6, min_size=0):
+    """Compresses an HTTP request body.  Returns the body to send and the
+       value of its Content-Encoding header, which is None when the body
+       went out as is because compression is off or the body is smaller
+       than min_size."""
+    if method == 'none' or len(payload) < min_size:
+        return payload, None
+    if method == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif method == 'deflate':
+        # HTTP "deflate" is the zlib format, not a raw deflate stream
+        compressor = zlib.compressobj(level)
+    else:
+        raise ValueError('unknown compression method %r' % method)
+    return compressor.compress(payload) + compressor.flush(), method
+
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000  # O_CLOEXEC
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, followed by the name
+
+
+class DirectoryWatcher(object):
+    """Tells when something changed in a set of directories.  Uses inotify
+       where the platform has it.  Elsewhere wait() just sleeps for its
+       timeout and reports a change, so callers rescan like they always
+       did."""
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    SETTLE_TIME = 0.1  # seconds to let a burst of changes (an editor saving a file) complete
+
+    def __init__(self, paths=()):
+        self.fd = -1
+        self.watches = {}  # path -> watch descriptor
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        except (AttributeError, OSError):
+            pass  # no inotify, poll
+        for path in paths:
+            self.watch(path)
+
+    @property
+    def available(self):
+        return self.fd >= 0
+
+    def watch(self, path):
+        """Adds a directory to the watched ones.  Directories which don't
+           exist are ignored."""
+        if self.fd < 0 or path in self.watches:
+            return
+        wd = self.add_watch(self.fd, path, self.MASK)
+        if wd >= 0:
+            self.watches[path] = wd
+
+    def wait(self, timeout=None):
+        """Waits at most timeout seconds, forever if it is None, for a
+           change.  Returns True if there was one."""
+        if self.fd < 0:
+            time.sleep(timeout)
+            return True
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+        time.sleep(self.SETTLE_TIME)
+        self.drain()
+        return True
+
+    def drain(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if not data:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size + length
+                if mask & IN_IGNORED:
+                    # the directory is gone, it can be watched again once it's back
+                    for path, watched in self.watches.items():
+                        if watched == wd:
+                            del self.watches[path]
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all the threads of the process for a while and
+       writes them in the collapsed format flamegraph.pl and speedscope read:
+       one line per distinct stack, the thread name and then the frames from
+       the outermost one, separated by semicolons, followed by the number of
+       samples it was seen in.  Nothing runs between profiles."""
+
+    def __init__(self, directory, rate=100, duration=30):
+        self.directory = directory
+        self.rate = rate  # samples per second
+        self.duration = duration  # seconds, of the profiles started without one
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, duration=None):
+        """Starts a profile of duration seconds in the background.  Returns
+           the file it will be written to, None if a profile is running.
+           The directory is created, private to the user, if it's missing."""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return None
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0700)
+            path = os.path.join(self.directory, 'profile-%d-%d.folded' % (os.getpid(), time.time()))
+            self.thread = threading.Thread(target=self.run, name='profiler',
+                                           args=(duration or self.duration, path))
+            self.thread.setDaemon(True)
+            self.thread.start()
+            return path
+
+    def wait(self, timeout=None):
+        """Waits for the running profile to be written."""
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def run(self, duration, path):
+        stacks = self.sample(duration)
+        # a new file of a name nobody can guess, rename() replaces whatever
+        # is at path without following it
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            for stack, count in sorted(stacks.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+        os.rename(tmp, path)
+
+    def sample(self, duration):
+        """Returns how many times each stack was seen over duration seconds."""
+        stacks = {}
+        me = threading.current_thread().ident
+        interval = 1.0 / self.rate
+        end = time.time() + duration
+        while time.time() < end:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                  code.co_firstlineno))
+                    frame = frame.f_back
+                frames.append(names.get(ident, 'thread-%d' % ident).replace(';', ','))
+                frames.reverse()
+                stack = ';'.join(frames)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            time.sleep(interval)
+        return stacks
@@ -6,23 +6,36 @@ import logging
 import sys
 import re
 import socket
+import stat
+import subprocess
 import time
 import ConfigParser
+import heapq
 import imp
+import itertools
 import json
+import httplib
 import urllib2
 import random
+import resource
 import base64
 import threading
+import zlib
 from optparse import OptionParser
 from Queue import Queue
 from Queue import Full
 from Queue import Empty
 import ssl
+import errno
 import common_utils
 
 # global variables._
+START_TIME = time.time()
 COLLECTORS = {}
+SCHEDULER = None
+PROFILER = None
+STARTUP_TIMELINE = {}  # collector name -> (import ms, init ms, status) of its last load
+LOADED = False  # whether the collectors were loaded once, later loads are reloads
 DEFAULT_LOG = '/var/log/cloudwiz-collector.log'
 LOG = logging.getLogger('runner')
 # TODO consider put into config file
@@ -33,11 +46,34 @@ MAX_SENDQ_SIZE = 20000      # this should match tsd.http.request.max_chunk, usua
 MAX_READQ_SIZE = 100000
 MAX_READQ_SIZE_TO_START = MAX_READQ_SIZE / 10
 MAX_DROPPED_LINES_TO_START = MAX_READQ_SIZE / 10
+MAX_COMPRESSION_RATIO = 8  # caps how much larger compression makes a batch
+HTTP_TIMEOUT = 20  # seconds
+BATCH_MAX_LINES = 1000  # lines a worker process streams back per readq item
+SEND_RETRY_INTERVAL = 50  # seconds to wait before sending again after a failure
+TSD_PROBE_INTERVAL = 10  # seconds before a failed TSD gets probed again, doubled on each failure
+MAX_TSD_PROBE_INTERVAL = 600
+LATENCY_EWMA_WEIGHT = 0.2  # weight of the newest sample in a TSD's average latency
+DEFAULT_TSD_LATENCY = 0.1  # seconds assumed for a TSD without a latency sample yet
+SPOOL_SEGMENT_SIZE = 4 * 1024 * 1024  # bytes per spool segment file
+SPOOL_REPLAY_BURST = 10  # seconds worth of replay credit that can build up
+SENDER_STATS_INTERVAL = 60  # seconds between two reports of the sender's own stats
 # config constants
 SECTION_BASE = 'base'
 CONFIG_ENABLED = 'enabled'
 CONFIG_COLLECTOR_CLASS = 'collectorclass'
 CONFIG_INTERVAL = 'interval'
+CONFIG_ISOLATION = 'isolation'
+CONFIG_DEADLINE = 'deadline'
+ISOLATION_PROCESS = 'process'
+COLLECTOR_WORKER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'collector_worker.py')
+WORKER_STOP_TIMEOUT = 10  # seconds a worker process gets to clean up before it's killed
+DEADLINE_INTERVALS = 3  # default deadline of a collector run, in collector intervals
+QUARANTINE_DEADLINES = 3  # a run this many deadlines long gets its collector restarted
+MAX_QUARANTINES = 3  # a collector restarted this many times is disabled
+WATCHDOG_INTERVAL = 5  # seconds between two checks of the running collectors
+INIT_TIMEOUT = 30  # seconds a collector gets to be imported and constructed
+RUSAGE_THREAD = 1  # linux, python 2's resource module doesn't define it
+MAX_PROFILE_DURATION = 600  # seconds a profile asked for on the control socket may last
 
 # metric entry constant
 METRIC_NAME = 'metric'
@@ -91,6 +127,18 @@ def main(argv):
     for sig in (signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, shutdown_signal)
 
+    # profiling costs nothing until SIGUSR2 or the control socket asks for it
+    global PROFILER
+    profile_dir = options.profile_dir or os.path.join(os.path.dirname(os.path.abspath(options.logfile)),
+                                                      'tcollector-profiles')
+    PROFILER = common_utils.SamplingProfiler(profile_dir, options.profile_rate, options.profile_duration)
+    signal.signal(signal.SIGUSR2, profile_signal)
+    if options.control_socket:
+        try:
+            ControlServer(options.control_socket, PROFILER).start()
+        except EnvironmentError, e:
+            LOG.error('not listening on control socket %s: %s', options.control_socket, e)
+
     # prepare list of (host, port) of TSDs given on CLI
     if not options.hosts:
         options.hosts = [(options.host, options.port)]
@@ -117,6 +165,9 @@ def main(argv):
     global SENDER
     SENDER = Sender(token, readq, options, tags)
     SENDER.start()
+    global SCHEDULER
+    SCHEDULER = Scheduler(readq, options.collector_workers, options.align_collection)
+    SCHEDULER.start()
 
     LOG.info('agent finish initializing, enter main loop.')
     main_loop(readq, options, {}, COLLECTORS)
@@ -124,20 +175,31 @@ def main(argv):
 
 def main_loop(readq, options, configs, collectors):
     loop_interval = options.update_interval
+    # reload only when the conf directory changed, or every update
+    # interval without inotify
+    confdir = os.path.join(options.cdir, 'conf')
+    watcher = common_utils.DirectoryWatcher()
     while True:
         start = time.time()
         try:
             changed_configs, deleted_configs = reload_collector_confs(configs, options)
             close_collecotors(deleted_configs, collectors)
-            load_collectors(options.cdir, changed_configs, collectors, readq)
+            load_collectors(options.cdir, changed_configs, collectors, readq,
+                            options.collector_workers, options.init_timeout)
             if options.verbose:
                 import datetime
                 sys.stdout.write('sent data at %s\n' % datetime.datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S'))
         except:
             LOG.exception('failed collector update loop.')
 
-        end = time.time()
-        sleep_reasonably(loop_interval, start, end)
+        # the conf directory may have been created since the last pass
+        watcher.watch(confdir)
+        if confdir in watcher.watches:
+            while not watcher.wait():
+                pass
+        else:
+            end = time.time()
+            sleep_reasonably(loop_interval, start, end)
 
 
 def get_proxy(agentconfig):
@@ -217,7 +279,9 @@ def default_config():
     return {
         CONFIG_ENABLED: 'False',
         CONFIG_INTERVAL: '15',
-        CONFIG_COLLECTOR_CLASS: None
+        CONFIG_COLLECTOR_CLASS: None,
+        CONFIG_ISOLATION: 'thread',
+        CONFIG_DEADLINE: '0'
     }
 
 
@@ -244,24 +308,21 @@ def close_single_collector(collectors, name):
         LOG.error('failed to shutdown collector %s', name)
 
 
-def load_collectors(coldir, configs, collectors, readq):
+def load_collectors(coldir, configs, collectors, readq, workers=1, timeout=INIT_TIMEOUT):
+    global LOADED
+    # the first load is part of the agent's startup
+    start = time.time() if LOADED else START_TIME
+    LOADED = True
     collector_dir = '%s/builtin' % coldir
+    inits = []
     for config_filename, (path, conf, timestamp) in configs.iteritems():
+        collector_path_name = None
         try:
             name = os.path.splitext(config_filename)[0]
             collector_path_name = '%s/%s.py' % (collector_dir, name)
             if conf.getboolean(SECTION_BASE, CONFIG_ENABLED):
                 if os.path.isfile(collector_path_name) and os.access(collector_path_name, os.X_OK):
-                    collector_class_name = conf.get(SECTION_BASE, CONFIG_COLLECTOR_CLASS)
-                    collector_class = load_collector_module(name, collector_dir, collector_class_name)
-                    collector_instance = collector_class(conf, LOG, readq)
-                    interval = conf.getint(SECTION_BASE, CONFIG_INTERVAL)
-
-                    # shutdown and remove old collector
-                    if name in collectors:
-                        close_single_collector(collectors, name)
-                    LOG.info('loading collector %s from %s', name, collector_path_name)
-                    collectors[name] = CollectorExec(name, collector_instance, interval)
+                    inits.append(CollectorInit(name, coldir, path, conf, readq))
                 else:
                     LOG.warn('failed to access collector file: %s', collector_path_name)
             elif name in collectors:
@@ -270,11 +331,168 @@ def load_collectors(coldir, configs, collectors, readq):
         except:
             LOG.exception('failed to load collector %s, skipped.', collector_path_name if collector_path_name else config_filename)
 
+    for init in initialize_collectors(inits, workers, timeout):
+        name = init.collector
+        collector_path_name = '%s/%s.py' % (collector_dir, name)
+        if init.error:
+            LOG.error('failed to load collector %s, skipped.', collector_path_name, exc_info=init.error)
+            continue
+        try:
+            interval = init.conf.getint(SECTION_BASE, CONFIG_INTERVAL)
+            deadline = init.conf.getint(SECTION_BASE, CONFIG_DEADLINE) or interval * DEADLINE_INTERVALS
+
+            # shutdown and remove old collector
+            if name in collectors:
+                close_single_collector(collectors, name)
+            LOG.info('loading collector %s from %s (import %dms, init %dms)',
+                     name, collector_path_name, init.import_ms, init.init_ms)
+            collectors[name] = CollectorExec(name, init.instance, interval, SCHEDULER,
+                                             deadline, init.factory)
+        except:
+            LOG.exception('failed to load collector %s, skipped.', collector_path_name)
+    report_startup_timeline(readq, inits, start)
+
+
+def initialize_collectors(inits, workers, timeout):
+    """Imports and constructs the collectors of the inits, at most workers at
+       a time.  Each gets timeout seconds from the moment it starts, the ones
+       which take longer are abandoned.  Returns the inits which finished, in
+       the order they finished."""
+    slots = threading.Semaphore(workers)
+    done = Queue()
+    for init in inits:
+        init.begin(slots, done)
+    pending = set(inits)
+    finished = []
+    while pending:
+        started = [init.started for init in pending if init.started]
+        wait = min(started) + timeout - time.time() if started else timeout
+        try:
+            init = done.get(True, max(wait, 0.01))
+            pending.discard(init)
+            finished.append(init)
+        except Empty:
+            now = time.time()
+            for init in list(pending):
+                if init.started and now - init.started >= timeout and init.abandon():
+                    pending.discard(init)
+                    LOG.error('collector %s took more than %ds to initialize, skipped.', init.collector, timeout)
+    return finished
+
+
+def report_startup_timeline(readq, inits, start):
+    """Records how long each collector took to import and construct, and
+       emits it along with how long after start, the agent's start for the
+       first load and the reload's for later ones, that was."""
+    now = int(time.time())
+    for init in inits:
+        STARTUP_TIMELINE[init.collector] = (init.import_ms, init.init_ms, init.status)
+        readq.nput('collector.startup.import_ms %d %d collector=%s status=%s'
+                   % (now, init.import_ms, init.collector, init.status))
+        readq.nput('collector.startup.init_ms %d %d collector=%s status=%s'
+                   % (now, init.init_ms, init.collector, init.status))
+    if inits:
+        readq.nput('collector.startup.loaded_ms %d %d phase=%s'
+                   % (now, (time.time() - start) * 1000, 'startup' if start == START_TIME else 'reload'))
+
+
+class CollectorInit(threading.Thread):
+    """Imports a collector module and constructs the collector on a thread of
+       its own, timing both steps."""
+
+    def __init__(self, name, coldir, conf_path, conf, readq):
+        super(CollectorInit, self).__init__(name='init-%s' % name)
+        self.setDaemon(True)
+        self.collector = name
+        self.coldir = coldir
+        self.conf_path = conf_path
+        self.conf = conf
+        self.readq = readq
+        self.factory = None
+        self.instance = None
+        self.error = None
+        self.started = None
+        self.imported = None
+        self.import_ms = 0
+        self.init_ms = 0
+        self.status = 'pending'
+        self.lock = threading.Lock()
+        self.slots = None
+        self.done = None
+
+    def begin(self, slots, done):
+        self.slots = slots
+        self.done = done
+        self.start()
+
+    def run(self):
+        self.slots.acquire()
+        self.started = time.time()
+        factory = instance = error = None
+        try:
+            if self.conf.get(SECTION_BASE, CONFIG_ISOLATION) == ISOLATION_PROCESS:
+                factory = lambda: ProcessCollector(self.collector, self.coldir, self.conf_path, self.readq)
+            else:
+                collector_class = load_collector_module(self.collector, '%s/builtin' % self.coldir,
+                                                        self.conf.get(SECTION_BASE, CONFIG_COLLECTOR_CLASS))
+                factory = lambda cls=collector_class, conf=self.conf, readq=self.readq: cls(conf, LOG, readq)
+            self.imported = time.time()
+            instance = factory()
+        except:
+            error = sys.exc_info()
+        with self.lock:
+            if self.status == 'timeout':
+                # nobody is waiting for this collector any more
+                if instance is not None:
+                    try:
+                        instance.cleanup()
+                    except:
+                        LOG.exception('failed to clean up abandoned collector %s', self.collector)
+                return
+            self.slots.release()
+            self.timed(time.time())
+            self.factory, self.instance, self.error = factory, instance, error
+            self.status = 'failed' if error else 'ok'
+        self.done.put(self)
+
+    def timed(self, end):
+        imported = self.imported or end
+        self.import_ms = int((imported - self.started) * 1000)
+        self.init_ms = int((end - imported) * 1000)
+
+    def abandon(self):
+        """Gives up on the collector, unless it's already done.  Its slot goes
+           to the next collector."""
+        with self.lock:
+            if self.status != 'pending':
+                return False
+            self.status = 'timeout'
+            self.timed(time.time())
+            self.slots.release()
+            return True
+
 
 # caller to handle exception
+_module_locks = {}  # module name -> lock held while loading it
+
+
 def load_collector_module(module_name, module_path, collector_class_name=None):
-    (file_obj, filename, description) = imp.find_module(module_name, [module_path])
-    mod = imp.load_module(module_name, file_obj, filename, description)
+    # collectors are loaded concurrently and imp doesn't lock.  Loads of the
+    # same module are serialized, the import lock is only held to look up
+    # the module's lock, so a collector hanging at import time holds up no
+    # other import
+    imp.acquire_lock()
+    try:
+        lock = _module_locks.setdefault(module_name, threading.Lock())
+    finally:
+        imp.release_lock()
+    with lock:
+        (file_obj, filename, description) = imp.find_module(module_name, [module_path])
+        try:
+            mod = imp.load_module(module_name, file_obj, filename, description)
+        finally:
+            if file_obj:
+                file_obj.close()
     if collector_class_name is None:
         collector_class_name = module_name.title().replace('_', '').replace('-', '')
     return getattr(mod, collector_class_name)
@@ -376,8 +594,70 @@ def parse_cmdline(argv):
                       help='Password to use for HTTP Basic Auth when sending the data via HTTP')
     parser.add_option('--ssl', dest='ssl', action='store_true', default=defaults['ssl'],
                       help='Enable SSL - used in conjunction with http')
+    parser.add_option('--compression', dest='compression', type='choice',
+                      choices=common_utils.COMPRESSION_METHODS, default=defaults['compression'],
+                      help='Compress HTTP request bodies with gzip or deflate. default=%default')
+    parser.add_option('--compression-level', dest='compression_level', type='int',
+                      default=defaults['compression_level'],
+                      help='zlib compression level, 1 (fastest) to 9 (smallest). default=%default')
+    parser.add_option('--compression-min-size', dest='compression_min_size', type='int',
+                      default=defaults['compression_min_size'],
+                      help='Request bodies smaller than this many bytes are sent '
+                           'uncompressed. default=%default')
+    parser.add_option('--spool-dir', dest='spool_dir', default=defaults['spool_dir'],
+                      help='Directory where batches that could not be sent are kept '
+                           'until the TSD is back, e.g. /var/lib/tcollector/spool. Off '
+                           'when empty, the default.')
+    parser.add_option('--spool-max-bytes', dest='spool_max_bytes', type='int',
+                      default=defaults['spool_max_bytes'],
+                      help='Maximum size of the spool, the oldest data is dropped '
+                           'beyond it. default=%default')
+    parser.add_option('--spool-replay-rate', dest='spool_replay_rate', type='float',
+                      default=defaults['spool_replay_rate'],
+                      help='Spooled batches resent per second once the TSD is '
+                           'reachable again. default=%default')
+    parser.add_option('--max-inflight', dest='max_inflight', type='int',
+                      default=defaults['max_inflight'],
+                      help='Number of batches sent concurrently, spread over the '
+                           'TSDs given with --hosts. default=%default')
+    parser.add_option('--send-buffer', dest='send_buffer', type='int',
+                      default=defaults['send_buffer'],
+                      help='Number of built batches waiting for a transmit thread '
+                           'before the builder stops draining readq. default=%default')
+    parser.add_option('--collector-workers', dest='collector_workers', type='int',
+                      default=defaults['collector_workers'],
+                      help='Number of threads the collectors run on. default=%default')
+    parser.add_option('--init-timeout', dest='init_timeout', type='int',
+                      default=defaults['init_timeout'],
+                      help='Seconds a collector gets to be imported and constructed '
+                           'before it is skipped. default=%default')
+    parser.add_option('--align-collection', dest='align_collection', action='store_true',
+                      default=defaults['align_collection'],
+                      help='Run collectors on wall-clock multiples of their interval, '
+                           'so timestamps line up across hosts.')
+    parser.add_option('--send-interval', dest='send_interval', type='int',
+                      default=defaults['send_interval'],
+                      help='Send once every this many seconds, at an offset derived '
+                           'from the host name. 0 sends as soon as data is there. '
+                           'default=%default')
     parser.add_option('--update-interval', dest='update_interval', type='int', default=defaults['update_interval'],
                       help='interval the update of collector is picked up')
+    parser.add_option('--profile-dir', dest='profile_dir', metavar='DIR',
+                      default=defaults['profile_dir'],
+                      help='Directory the profiles started with SIGUSR2 or the '
+                           'control socket are written to, created private to the '
+                           'agent\'s user if missing. Empty, the default, for '
+                           'tcollector-profiles next to the log file.')
+    parser.add_option('--profile-rate', dest='profile_rate', type='int',
+                      default=defaults['profile_rate'],
+                      help='Stack samples per second while profiling. default=%default')
+    parser.add_option('--profile-duration', dest='profile_duration', type='int',
+                      default=defaults['profile_duration'],
+                      help='Seconds a profile started with SIGUSR2 lasts. default=%default')
+    parser.add_option('--control-socket', dest='control_socket', metavar='PATH',
+                      default=defaults['control_socket'],
+                      help='Unix socket to accept "profile [<seconds>]" commands on, '
+                           'none if empty.')
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
         parser.error('--dedup-interval must be at least 0 seconds')
@@ -386,6 +666,24 @@ def parse_cmdline(argv):
                      '--dedup-interval')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    if not 1 <= options.compression_level <= 9:
+        parser.error('--compression-level must be between 1 and 9')
+    if options.send_interval < 0:
+        parser.error('--send-interval must be at least 0 seconds')
+    if options.collector_workers < 1:
+        parser.error('--collector-workers must be at least 1')
+    if options.profile_rate < 1:
+        parser.error('--profile-rate must be at least 1')
+    if options.profile_duration < 1:
+        parser.error('--profile-duration must be at least 1 second')
+    if options.init_timeout < 1:
+        parser.error('--init-timeout must be at least 1 second')
+    if options.send_buffer < 1:
+        parser.error('--send-buffer must be at least 1')
+    if options.max_inflight < 1:
+        parser.error('--max-inflight must be at least 1')
+    if options.spool_replay_rate <= 0:
+        parser.error('--spool-replay-rate must be greater than 0')
     # We cannot write to stdout when we're a daemon.
     if (options.daemonize or options.max_bytes) and not options.backup_count:
         options.backup_count = 1
@@ -418,9 +716,25 @@ def get_defaults():
         'logfile': '/var/log/tcollector.log',
         'cdir': default_cdir,
         'ssl': False,
+        'compression': 'none',
+        'compression_level': 6,
+        'compression_min_size': 1024,
         'stdin': False,
         'daemonize': False,
         'hosts': False,
+        'spool_dir': '',
+        'spool_max_bytes': 256 * 1024 * 1024,
+        'spool_replay_rate': 2,
+        'max_inflight': 1,
+        'send_buffer': 4,
+        'collector_workers': 8,
+        'init_timeout': INIT_TIMEOUT,
+        'align_collection': False,
+        'send_interval': 0,
+        'profile_dir': '',
+        'profile_rate': 100,
+        'profile_duration': 30,
+        'control_socket': '',
         'update_interval': 15
     }
 
@@ -502,86 +816,576 @@ def shutdown_signal(signum, frame):
     shutdown()
 
 
+# noinspection PyUnusedLocal
+def profile_signal(signum, frame):
+    try:
+        path = PROFILER.start()
+    except EnvironmentError:
+        LOG.exception('got signal %d, but failed to start a profile', signum)
+        return
+    if path:
+        LOG.warning('got signal %d, profiling for %ds into %s', signum, PROFILER.duration, path)
+    else:
+        LOG.warning('got signal %d, but a profile is already running', signum)
+
+
+class ControlServer(threading.Thread):
+    """Listens on a unix socket, only accessible to the agent's user, for
+       commands sent one per connection:
+
+           profile [<seconds>]    starts profiling the agent, for at most
+                                  MAX_PROFILE_DURATION seconds, and answers
+                                  with the file the stacks will be written
+                                  to; it shows up once the profile is done
+
+       A socket left at path by an earlier agent is replaced, anything else
+       there fails with EEXIST."""
+
+    def __init__(self, path, profiler):
+        super(ControlServer, self).__init__(name='control')
+        self.setDaemon(True)
+        self.profiler = profiler
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise OSError(errno.EEXIST, 'not a socket, not replacing it', path)
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(1)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error, e:
+                # signals are delivered to any thread in python 2
+                if e.errno != errno.EINTR:
+                    LOG.exception('failed to accept a control connection')
+                    time.sleep(1)
+                continue
+            try:
+                conn.sendall(self.handle(conn.makefile().readline().split()) + '\n')
+            except:
+                LOG.exception('failed to handle control connection')
+            finally:
+                conn.close()
+
+    def handle(self, command):
+        if not command or command[0] != 'profile':
+            return 'error: unknown command %r' % ' '.join(command)
+        try:
+            duration = int(command[1]) if len(command) > 1 else None
+        except ValueError:
+            return 'error: bad duration %r' % command[1]
+        if duration is not None and not 1 <= duration <= MAX_PROFILE_DURATION:
+            return 'error: the duration must be 1 to %d seconds' % MAX_PROFILE_DURATION
+        try:
+            path = self.profiler.start(duration)
+        except EnvironmentError, e:
+            return 'error: failed to start a profile: %s' % e
+        if path is None:
+            return 'error: a profile is already running'
+        LOG.info('profiling for %ds into %s', duration or self.profiler.duration, path)
+        return path
+
+
 def sleep_reasonably(interval, start, end):
     sleepsec = interval - (end - start) if interval > (end - start) else 0
     time.sleep(sleepsec)
 
 
+class ProcessCollector(object):
+    """Stands in for a collector which runs in a worker process of its own,
+       so its CPU use doesn't hold the GIL of the runner.  Every call runs
+       the collector once in collector_worker.py and puts the lines it
+       streams back into readq in batches.  A worker which died is started
+       again for the next run.  The worker's CPU time and RSS are reported
+       after every run."""
+
+    def __init__(self, name, coldir, conf_path, readq):
+        self.name = name
+        self.coldir = coldir
+        self.conf_path = conf_path
+        self.readq = readq
+        self.proc = None
+        self.starts = 0
+        # accounting, over all the worker processes so far
+        self.lines_emitted = 0
+        self.bytes_emitted = 0
+        self.worker_cpu = 0.0  # seconds, of the current worker
+        self.cpu_seconds = 0.0
+
+    def start(self):
+        self.proc = subprocess.Popen([sys.executable, COLLECTOR_WORKER, self.coldir, self.conf_path, self.name],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     close_fds=True)
+        forwarder = threading.Thread(target=self.forward_stderr, args=(self.proc,),
+                                     name='stderr-%s' % self.name)
+        forwarder.daemon = True
+        forwarder.start()
+        self.worker_cpu = 0.0
+        self.starts += 1
+        LOG.info('started worker process %d for collector %s', self.proc.pid, self.name)
+
+    def forward_stderr(self, proc):
+        """Logs what the worker writes to stderr until it exits, so its log
+           and the traceback it died with end up in the runner's log even
+           when the runner is daemonized.  The worker's log lines start with
+           their level, anything else is logged as a warning."""
+        for line in iter(proc.stderr.readline, ''):
+            line = line.rstrip('\n')
+            level, _, message = line.partition(' ')
+            level = logging.getLevelName(level)
+            if not isinstance(level, int):
+                level, message = logging.WARNING, line
+            LOG.log(level, 'collector %s: %s', self.name, message)
+        proc.stderr.close()
+
+    def __call__(self):
+        if self.proc is None or self.proc.poll() is not None:
+            if self.proc is not None:
+                LOG.error('worker process of collector %s exited with %s, restarting', self.name, self.proc.returncode)
+            self.start()
+        lines = []
+        done = None
+        try:
+            self.proc.stdin.write('run\n')
+            self.proc.stdin.flush()
+            for line in iter(self.proc.stdout.readline, ''):
+                if line.startswith('#done '):
+                    done = line.split()
+                    break
+                lines.append(line.rstrip('\n'))
+                self.lines_emitted += 1
+                self.bytes_emitted += len(line) - 1
+                if len(lines) >= BATCH_MAX_LINES:
+                    self.readq.nput_batch(lines)
+                    lines = []
+        except IOError:
+            LOG.exception('lost worker process of collector %s', self.name)
+        if lines:
+            self.readq.nput_batch(lines)
+        if done is None:
+            LOG.error('worker process of collector %s died during a run', self.name)
+            self.stop()
+            return
+        self.cpu_seconds += max(float(done[1]) - self.worker_cpu, 0)
+        self.worker_cpu = float(done[1])
+        now = time.time()
+        # the worker's CPU goes out as collector.self.cpu_ms, see Scheduler.execute
+        self.readq.nput_batch(['collector.worker.rss_kb %d %s collector=%s' % (now, done[2], self.name),
+                               'collector.worker.restarts %d %d collector=%s' % (now, self.starts - 1, self.name)])
+
+    def stop(self):
+        """Closes the worker's stdin, which makes it clean up and exit, and
+           kills it if it doesn't in time."""
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        deadline = time.time() + WORKER_STOP_TIMEOUT
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.poll() is None:
+            LOG.warning('killing worker process %d of collector %s', proc.pid, self.name)
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+    def emitted(self):
+        return self.lines_emitted, self.bytes_emitted
+
+    def cpu_time(self):
+        """CPU seconds the worker processes have used, as of their last run."""
+        return self.cpu_seconds
+
+    def abort(self):
+        """Kills the worker, which ends a run that is stuck."""
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+
+    def flush(self):
+        pass
+
+    def signal_exit(self):
+        pass
+
+    def cleanup(self):
+        self.stop()
+
+
+class Scheduler(threading.Thread):
+    """Runs the collectors on a bounded pool of worker threads.  The next
+       run of every collector is kept in a heap ordered by due time; the
+       scheduler thread hands the due ones to the workers.  A run is
+       scheduled one interval after the previous one was due, right away
+       if that time has already passed, and never while the previous run
+       is still going on.
+
+       The scheduler thread also is the watchdog.  Every WATCHDOG_INTERVAL
+       it looks at the runs in progress.  The lines a run buffered longer
+       than collectorbase.BATCH_MAX_DELAY are flushed.  A run past its
+       collector's deadline is counted as an overrun.  A run past
+       QUARANTINE_DEADLINES deadlines gets its collector restarted: the
+       worker process of an isolated collector is killed, an in-process
+       collector is replaced with a new instance and its stuck thread with
+       a new worker.  The new instance is constructed on a worker, under the same watch as a run.
+       A collector stuck MAX_QUARANTINES times is disabled, and no more
+       stuck threads are replaced than there are workers.  A stuck thread
+       which comes back retires if the pool is full without it.
+
+       With align set, runs are due on wall-clock multiples of their
+       collector's interval, so the samples of all hosts line up."""
+
+    def __init__(self, readq, workers, align=False):
+        super(Scheduler, self).__init__(name='scheduler')
+        self.daemon = True
+        self.readq = readq
+        self.align = align
+        self.cond = threading.Condition()
+        self.heap = []  # (due time, sequence number, CollectorExec)
+        self.sequence = itertools.count()
+        self.running = set()  # CollectorExecs handed to the workers
+        self.runq = Queue()  # (CollectorExec, due time, None to restart it)
+        self.size = workers
+        self.workers = []
+        for i in xrange(workers):
+            self.workers.append(self.new_worker())
+        self.stuck = 0  # workers held by a stuck run
+        self.next_watch = 0
+
+    def new_worker(self):
+        worker = threading.Thread(target=self.work, name='collector-worker-%d' % len(self.workers))
+        worker.daemon = True
+        return worker
+
+    def first_due(self, interval):
+        now = time.time()
+        if not self.align:
+            return now
+        return now - now % interval + interval
+
+    def next_due(self, interval, due, end):
+        """Returns when the run after the one due at due, which ended at
+           end, is due."""
+        due += interval
+        if due >= end:
+            return due
+        if self.align:
+            # skip the boundaries missed while the run was overdue
+            return end - (end - due) % interval + interval
+        return end
+
+    def add(self, collector, due):
+        with self.cond:
+            heapq.heappush(self.heap, (due, next(self.sequence), collector))
+            self.cond.notify()
+
+    def cancel(self, collector):
+        """Stops scheduling collector.  Returns False if it is running, in
+           which case the worker finishes it once the run is over."""
+        with self.cond:
+            collector.exit = True
+            if collector in self.running:
+                return False
+            self.heap = [entry for entry in self.heap if entry[2] is not collector]
+            heapq.heapify(self.heap)
+            return True
+
+    def run(self):
+        LOG.info('scheduler started with %d workers', len(self.workers))
+        for worker in self.workers:
+            worker.start()
+        while True:
+            stuck = []
+            started = []
+            with self.cond:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    due, _, collector = heapq.heappop(self.heap)
+                    self.running.add(collector)
+                    self.runq.put((collector, due))
+                if now >= self.next_watch:
+                    stuck = self.watch(now)
+                    started = [collector.instance for collector in self.running if collector.started is not None]
+                    self.next_watch = now + WATCHDOG_INTERVAL
+                if not stuck and not started:
+                    wakeup = min(self.heap[0][0], self.next_watch) if self.heap else self.next_watch
+                    self.cond.wait(wakeup - now)
+            for instance in started:
+                # the lines a long run emitted a while ago
+                flush_stale = getattr(instance, 'flush_stale', None)
+                if flush_stale:
+                    flush_stale(now)
+            for collector in stuck:
+                self.quarantine(collector)
+
+    def watch(self, now):
+        """Reports the runs past their deadline, returns the stuck ones."""
+        stuck = []
+        for collector in self.running:
+            if collector.started is None:
+                continue  # still waiting for a worker
+            elapsed = now - collector.started
+            if elapsed > collector.deadline and not collector.overran:
+                collector.overran = True
+                collector.overruns += 1
+                LOG.warning('collector %s has been running for %d seconds, over its %d seconds deadline',
+                            collector.name, elapsed, collector.deadline)
+                self.readq.nput('collector.overrun %d %d collector=%s' % (now, collector.overruns, collector.name))
+            if elapsed > collector.deadline * QUARANTINE_DEADLINES:
+                stuck.append(collector)
+        return stuck
+
+    def quarantine(self, collector):
+        instance = collector.instance
+        if hasattr(instance, 'abort'):
+            LOG.error('collector %s is stuck, killing its worker process', collector.name)
+            instance.abort()
+            return
+        if collector.factory is None:
+            return
+        with self.cond:
+            if collector not in self.running:
+                return  # the run just finished
+            self.running.discard(collector)
+            collector.generation += 1
+            collector.started = None
+            collector.quarantines += 1
+            self.stuck += 1
+            if self.stuck <= self.size:
+                LOG.error('collector %s is stuck, replacing its worker', collector.name)
+                worker = self.new_worker()
+                self.workers.append(worker)
+                worker.start()
+            else:
+                LOG.error('collector %s is stuck, %d workers already are, not replacing its worker',
+                          collector.name, self.stuck - 1)
+            disable = collector.quarantines >= MAX_QUARANTINES
+            if not disable and not collector.exit:
+                # constructed on a worker, a hanging constructor is watched
+                # like a run and doesn't hold up scheduling
+                self.running.add(collector)
+                self.runq.put((collector, None))
+        self.readq.nput('collector.quarantined %d %d collector=%s'
+                        % (time.time(), collector.quarantines, collector.name))
+        instance.signal_exit()
+        if collector.exit:
+            collector.finish(None)
+        elif disable:
+            LOG.error('collector %s got stuck %d times, disabling it', collector.name, collector.quarantines)
+            collector.finish(None)
+
+    def restart(self, collector):
+        """Replaces the instance of a quarantined collector.  Returns whether
+           the watchdog gave up on the restart."""
+        with self.cond:
+            generation = collector.generation
+            collector.started = time.time()
+            collector.overran = False
+        LOG.info('restarting collector %s', collector.name)
+        try:
+            instance = collector.factory()
+        except:
+            LOG.exception('failed to restart collector %s', collector.name)
+            instance = None
+        with self.cond:
+            gave_up = collector.generation != generation
+            if not gave_up:
+                self.running.discard(collector)
+                collector.started = None
+                if instance is not None and not collector.exit:
+                    collector.instance = instance
+                    heapq.heappush(self.heap, (self.first_due(collector.interval), next(self.sequence), collector))
+                    self.cond.notify()
+                    return False
+        if gave_up:
+            self.discard(collector, instance)
+        else:
+            collector.finish(instance)
+        return gave_up
+
+    def discard(self, collector, instance):
+        """Cleans up an instance of collector the watchdog gave up on."""
+        if instance is None:
+            return
+        try:
+            instance.cleanup()
+        except:
+            LOG.exception('failed to clean up collector %s', collector.name)
+
+    def work(self):
+        while True:
+            collector, due = self.runq.get()
+            if due is None:
+                gave_up = self.restart(collector)
+            else:
+                gave_up = self.execute(collector, due)
+            if gave_up and not self.unstick():
+                LOG.info('retiring the worker of the stuck run of collector %s', collector.name)
+                break
+
+    def execute(self, collector, due):
+        """Runs collector once and schedules its next run.  Returns whether
+           the watchdog gave up on the run."""
+        with self.cond:
+            instance = collector.instance
+            generation = collector.generation
+            collector.started = start = time.time()
+            collector.overran = False
+        cpu, lines, nbytes = collector_usage(instance)
+        collector.run_once(instance)
+        end = time.time()
+        end_cpu, end_lines, end_nbytes = collector_usage(instance)
+        # wall and CPU time of the run, for a ProcessCollector the worker's
+        self.readq.nput_batch(['collector.schedule.lateness_ms %d %d collector=%s'
+                               % (start, (start - due) * 1000, collector.name),
+                               'collector.self.wall_ms %d %d collector=%s' % (end, (end - start) * 1000, collector.name),
+                               'collector.self.cpu_ms %d %d collector=%s' % (end, (end_cpu - cpu) * 1000, collector.name),
+                               'collector.self.lines %d %d collector=%s' % (end, end_lines - lines, collector.name),
+                               'collector.self.bytes %d %d collector=%s' % (end, end_nbytes - nbytes, collector.name)])
+        with self.cond:
+            gave_up = collector.generation != generation
+            if not gave_up:
+                self.running.discard(collector)
+                collector.started = None
+                if not collector.exit:
+                    heapq.heappush(self.heap, (self.next_due(collector.interval, due, end),
+                                               next(self.sequence), collector))
+                    self.cond.notify()
+                    return False
+        if gave_up:
+            self.discard(collector, instance)
+        else:
+            collector.finish(instance)
+        return gave_up
+
+    def unstick(self):
+        """Called by a worker back from a stuck run, returns whether it
+           stays in the pool, or retires because it was replaced."""
+        with self.cond:
+            self.stuck -= 1
+            if len(self.workers) - self.stuck <= self.size:
+                return True
+            self.workers.remove(threading.current_thread())
+            return False
+
+
+def thread_cpu_time():
+    """CPU seconds used by the calling thread, 0 where that can't be told."""
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        return 0.0
+    return usage.ru_utime + usage.ru_stime
+
+
+def collector_usage(instance):
+    """Returns the CPU seconds used so far by the collector, and the lines
+       and bytes it emitted so far.  The CPU of an in-process collector is
+       the calling worker thread's, that of a ProcessCollector its worker
+       process'."""
+    cpu_time = getattr(instance, 'cpu_time', None)
+    emitted = getattr(instance, 'emitted', None)
+    lines, nbytes = emitted() if emitted else (0, 0)
+    return cpu_time() if cpu_time else thread_cpu_time(), lines, nbytes
+
+
 class CollectorExec(object):
-    def __init__(self, name, collector_instance, interval):
+    def __init__(self, name, collector_instance, interval, scheduler, deadline=None, factory=None):
         self._validate(name, 'name')
         self._validate(collector_instance, 'collector_instance')
         self._validate(interval, 'interval')
 
-        self._name = name
-        self._collector_instance = collector_instance
-        self._interval = interval
-        self._thread = CollectorThread(name, collector_instance, interval)
-        self._thread.start()
+        self.name = name
+        self.instance = collector_instance
+        self.interval = interval
+        self.deadline = deadline or interval * DEADLINE_INTERVALS
+        self.factory = factory  # creates a new instance when the collector is stuck
+        self.exit = False
+        # watchdog state, guarded by the scheduler's lock
+        self.started = None
+        self.overran = False
+        self.overruns = 0
+        self.quarantines = 0
+        self.generation = 0
+        self._scheduler = scheduler
+        self._done = threading.Event()
+        scheduler.add(self, scheduler.first_due(interval))
+
+    def run_once(self, instance):
+        try:
+            LOG.info("start one collection for collector %s", self.name)
+            instance()
+            LOG.info("finish one collection for collector %s", self.name)
+        except:
+            LOG.exception('failed to execute collector %s', self.name)
+        finally:
+            instance.flush()
+
+    def finish(self, instance):
+        if instance is not None:
+            try:
+                instance.cleanup()
+            except:
+                LOG.exception('failed to clean up collector %s', self.name)
+        self._done.set()
 
     def shutdown(self, wait=True):
-        LOG.info('starting to shut down %s', self._name)
-        if self._collector_instance:
-            self._collector_instance.signal_exit()
-        else:
-            LOG.error('no collector instance for %s', self._name)
-
-        if self._thread:
-            self._thread.exit = True
-        else:
-            LOG.error('no thread instance for %s', self._name)
+        LOG.info('starting to shut down %s', self.name)
+        self.instance.signal_exit()
+        if self._scheduler.cancel(self):
+            self.finish(self.instance)
         if wait:
-            self._thread.join()
-            LOG.info('finish shutting down %s', self._name)
+            self.wait_shutdown()
 
     def signal_shutdown(self):
-        """ signal shutdown without waiting for the thread to exit, should used in pair with wait_shutdown"""
+        """ signal shutdown without waiting for the collector to finish, should used in pair with wait_shutdown"""
         self.shutdown(False)
 
     def wait_shutdown(self):
-        """ used in pair with signal_shutdown to wait for the thread to exit """
-        self._thread.join()
-        LOG.info('finish shutting down %s', self._name)
+        """ used in pair with signal_shutdown to wait for the collector to finish its last run """
+        self._done.wait()
+        LOG.info('finish shutting down %s', self.name)
 
     def _validate(self, val, name):
         if not val:
             raise ValueError('%s is not set' % name)
 
 
-class CollectorThread(threading.Thread):
-    def __init__(self, name, collector_instance, interval):
-        super(CollectorThread, self).__init__()
-        self.name = name
-        self.collector_instance = collector_instance
-        self.interval = interval
-        self.exit = False
+class NonBlockingQueue(Queue):
+    """A queue of lines.  A list of lines put with nput_batch is a single
+       item, but the queue's size and capacity are counted in lines."""
+    dropped = 0
 
-    def run(self):
-        LOG.info('started collector thread: %s', self.name)
-        while not self.exit:
-            start = time.time()
-            try:
-                LOG.info("start one collection for collector %s", self.name)
-                self.collector_instance()
-                LOG.info("finish one collection for collector %s", self.name)
-            except:
-                LOG.exception('failed to execute collector %s', self.name)
-            self.sleep_responsively(start)
-        self.collector_instance.cleanup()
+    def _init(self, maxsize):
+        Queue._init(self, maxsize)
+        self.lines = 0
 
-    def sleep_responsively(self, start):
-        max_sleepsec = 5
-        end = time.time()
-        sleepsec = self.interval - (end - start) if self.interval > (end - start) else 0
-        while not self.exit and sleepsec > 0:
-            sleepsec = sleepsec if sleepsec < max_sleepsec else max_sleepsec
-            time.sleep(sleepsec)
-            end = time.time()
-            sleepsec = self.interval - (end - start) if self.interval > (end - start) else 0
+    def _qsize(self, len=len):
+        return self.lines
 
+    def _put(self, item):
+        self.queue.append(item)
+        self.lines += len(item) if isinstance(item, list) else 1
 
-class NonBlockingQueue(Queue):
-    dropped = 0
+    def _get(self):
+        item = self.queue.popleft()
+        self.lines -= len(item) if isinstance(item, list) else 1
+        return item
 
     def nput(self, value):
         """A nonblocking put, that simply logs and discards the value when the
@@ -589,17 +1393,341 @@ class NonBlockingQueue(Queue):
         try:
             self.put(value, False)
         except Full:
-            NonBlockingQueue.dropped += 1
-            if NonBlockingQueue.dropped % 50 == 0:
-                LOG.error("DROPPED LINE: %s", value)
-
-            if NonBlockingQueue.dropped > MAX_DROPPED_LINES_TO_START:
-                LOG.error("Too many lines dropped. Let's exit")
-                os._exit(1)
-
+            self.drop(value)
             return False
         return True
 
+    def nput_batch(self, lines):
+        """Puts a list of lines as a single item, taking the lock once.  The
+           lines which don't fit are dropped like nput drops them, returns
+           false if any were."""
+        with self.mutex:
+            room = self.maxsize - self.lines if self.maxsize > 0 else len(lines)
+            dropped = lines[room:]
+            if room > 0:
+                self._put(lines[:room])
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+        for value in dropped:
+            self.drop(value)
+        return not dropped
+
+    def drop(self, value):
+        NonBlockingQueue.dropped += 1
+        if NonBlockingQueue.dropped % 50 == 0:
+            LOG.error("DROPPED LINE: %s", value)
+
+        if NonBlockingQueue.dropped > MAX_DROPPED_LINES_TO_START:
+            LOG.error("Too many lines dropped. Let's exit")
+            os._exit(1)
+
+
+class TsdConnection(object):
+    """A persistent HTTP/1.1 keep-alive connection to one TSD.  The
+       connection is opened on first use and only re-established after a
+       failure."""
+
+    def __init__(self, host, port, ssl_context=None, proxy=None, timeout=HTTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.proxy = proxy
+        self.timeout = timeout
+        self.conn = None
+        self.requests = 0         # requests sent
+        self.reused = 0           # requests sent over an already open connection
+        self.connects = 0         # connections established
+        self.handshake_time = 0   # seconds the last TCP (and TLS) handshake took
+
+    def url(self, path):
+        """Plain HTTP proxies want the absolute URL, everybody else the path."""
+        if self.proxy is not None and self.ssl_context is None:
+            return 'http://%s:%s%s' % (self.host, self.port, path)
+        return path
+
+    def connect(self):
+        if self.proxy is not None:
+            host, port = self.proxy['host'], self.proxy['port']
+        else:
+            host, port = self.host, self.port
+        if self.ssl_context is not None:
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+            if self.proxy is not None:
+                conn.set_tunnel(self.host, self.port)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        start = time.time()
+        conn.connect()
+        self.handshake_time = time.time() - start
+        self.connects += 1
+        self.conn = conn
+        LOG.info('connected to %s:%d in %.1f ms', self.host, self.port, self.handshake_time * 1000)
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except:
+                pass
+            self.conn = None
+
+    def post(self, path, body, headers):
+        """Sends a POST request and returns (status, reason, response body).
+           Connection failures are raised as urllib2.URLError."""
+        # the TSD may have closed an idle keep-alive connection since the
+        # last request, give such a connection one retry on a fresh one.
+        # Other failures may come after the TSD took the batch, a retry
+        # could store it twice.
+        for attempt in (0, 1):
+            reused = self.conn is not None
+            stale = False
+            try:
+                if not reused:
+                    self.connect()
+                try:
+                    self.conn.request('POST', self.url(path), body, headers)
+                except socket.error, e:
+                    stale = e.errno in (errno.ECONNRESET, errno.EPIPE)
+                    raise
+                try:
+                    response = self.conn.getresponse()
+                except httplib.BadStatusLine:
+                    # closed without a word, like an idle connection is
+                    stale = True
+                    raise
+                # the response needs to be drained for the connection to be reused
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                if reused and stale and attempt == 0:
+                    LOG.info('connection to %s:%d went away (%s), reconnecting', self.host, self.port, e)
+                    continue
+                raise urllib2.URLError(e)
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            if response.will_close:
+                self.close()
+            return response.status, response.reason, data
+
+    def stats(self):
+        """Returns (metric, value) pairs of the connection's counters."""
+        return [('collector.sender.requests', self.requests),
+                ('collector.sender.reused', self.reused),
+                ('collector.sender.connects', self.connects),
+                ('collector.sender.handshake_ms', int(self.handshake_time * 1000))]
+
+
+class TsdPool(object):
+    """Spreads requests over the TSDs.  Each request goes to the healthy
+       TSD with the least expected wait, its average latency times the
+       requests already in flight to it plus one.  DEFAULT_TSD_LATENCY
+       stands in for the average until it is measured.  A TSD that failed
+       is taken out of rotation and probed with a single request once its
+       probe interval expired; the interval doubles with each failed
+       probe.  If no TSD is healthy, the one due for a probe first is
+       used."""
+
+    def __init__(self, hosts):
+        self.lock = threading.Lock()
+        self.hosts = list(hosts)
+        self.latency = dict((hostport, 0.0) for hostport in self.hosts)  # EWMA, seconds
+        self.inflight = dict((hostport, 0) for hostport in self.hosts)
+        self.probe_at = {}        # failed (host, port) -> time of the next probe
+        self.probe_interval = {}  # failed (host, port) -> current probe interval
+        self.failures = 0
+
+    def acquire(self):
+        """Returns the (host, port) to send the next request to."""
+        now = time.time()
+        with self.lock:
+            candidates = [hostport for hostport in self.hosts
+                          if self.probe_at.get(hostport, 0) <= now]
+            if not candidates:
+                candidates = [min(self.probe_at, key=self.probe_at.get)]
+            hostport = min(candidates,
+                           key=lambda hp: (self.latency[hp] or DEFAULT_TSD_LATENCY) * (self.inflight[hp] + 1))
+            if hostport in self.probe_at:
+                # only one probe at a time
+                self.probe_at[hostport] = now + self.probe_interval[hostport]
+            self.inflight[hostport] += 1
+            return hostport
+
+    def release(self, hostport, latency=None):
+        """Records the outcome of a request, latency is None if it failed."""
+        with self.lock:
+            self.inflight[hostport] -= 1
+            if latency is None:
+                self.failures += 1
+                interval = min(self.probe_interval.get(hostport, TSD_PROBE_INTERVAL / 2) * 2,
+                               MAX_TSD_PROBE_INTERVAL)
+                self.probe_interval[hostport] = interval
+                self.probe_at[hostport] = time.time() + interval
+                LOG.info('Blacklisting %s:%d for %d seconds', hostport[0], hostport[1], interval)
+                return
+            if hostport in self.probe_at:
+                LOG.info('%s:%d is back', hostport[0], hostport[1])
+                del self.probe_at[hostport]
+                del self.probe_interval[hostport]
+            if self.latency[hostport]:
+                self.latency[hostport] += LATENCY_EWMA_WEIGHT * (latency - self.latency[hostport])
+            else:
+                self.latency[hostport] = latency
+
+    def stats(self):
+        """Returns (metric, value, (host, port)) triples for every TSD."""
+        with self.lock:
+            result = []
+            for hostport in self.hosts:
+                result.append(('collector.sender.latency_ms', int(self.latency[hostport] * 1000), hostport))
+                result.append(('collector.sender.inflight', self.inflight[hostport], hostport))
+                result.append(('collector.sender.blacklisted', int(hostport in self.probe_at), hostport))
+            return result
+
+
+class DiskSpool(object):
+    """Write-ahead spool of the batches the sender couldn't deliver.
+
+       Batches are appended, one JSON line each, to segment files in
+       directory.  A new segment is started once the current one reaches
+       segment_size bytes.  When the spool grows beyond max_bytes the
+       oldest segments are deleted.  Replay reads the oldest batch first.
+       The position of the next batch to replay is kept in a cursor file,
+       so the spool survives restarts."""
+
+    CURSOR = 'cursor'
+    SUFFIX = '.seg'
+
+    def __init__(self, directory, max_bytes, segment_size=SPOOL_SEGMENT_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.spooled = 0        # batches written to the spool
+        self.replayed = 0       # batches taken out of the spool
+        self.evicted_bytes = 0  # bytes dropped to stay under max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(name[:-len(self.SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(self.SUFFIX) and name[:-len(self.SUFFIX)].isdigit())
+        self.sizes = dict((seq, os.path.getsize(self.path(seq))) for seq in self.segments)
+        self.writer = None
+        self.reader = None
+        self.read_seq, self.read_offset = self.load_cursor()
+
+    def path(self, seq):
+        return os.path.join(self.directory, '%016d%s' % (seq, self.SUFFIX))
+
+    def load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, self.CURSOR)) as f:
+                seq, offset = f.read().split()
+            seq, offset = int(seq), int(offset)
+        except (IOError, ValueError):
+            seq, offset = -1, 0
+        if seq not in self.sizes:
+            # the segment was replayed or evicted, start at the oldest one
+            return (self.segments[0] if self.segments else -1), 0
+        return seq, offset
+
+    def save_cursor(self):
+        tmp = os.path.join(self.directory, self.CURSOR + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write('%d %d' % (self.read_seq, self.read_offset))
+        os.rename(tmp, os.path.join(self.directory, self.CURSOR))
+
+    def __len__(self):
+        """Bytes in the spool which haven't been replayed yet."""
+        if not self.segments:
+            return 0
+        return sum(self.sizes.itervalues()) - (self.read_offset if self.read_seq in self.sizes else 0)
+
+    def append(self, metrics):
+        """Spools a batch of metric entries."""
+        if not metrics:
+            return
+        if self.writer is None or self.sizes[self.segments[-1]] >= self.segment_size:
+            self.roll()
+        data = json.dumps(metrics) + '\n'
+        self.writer.write(data)
+        self.writer.flush()
+        self.sizes[self.segments[-1]] += len(data)
+        self.spooled += 1
+        self.enforce_max_bytes()
+
+    def roll(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        seq = self.segments[-1] + 1 if self.segments else 0
+        self.writer = open(self.path(seq), 'ab')
+        self.segments.append(seq)
+        self.sizes[seq] = 0
+        if self.read_seq == -1:
+            self.read_seq, self.read_offset = seq, 0
+
+    def enforce_max_bytes(self):
+        while len(self.segments) > 1 and sum(self.sizes.itervalues()) > self.max_bytes:
+            seq = self.segments[0]
+            LOG.warning('spool exceeds %d bytes, dropping segment %s', self.max_bytes, self.path(seq))
+            self.evicted_bytes += self.sizes[seq] - (self.read_offset if seq == self.read_seq else 0)
+            self.remove(seq)
+
+    def remove(self, seq):
+        if self.reader is not None and self.read_seq == seq:
+            self.reader.close()
+            self.reader = None
+        self.segments.remove(seq)
+        del self.sizes[seq]
+        try:
+            os.remove(self.path(seq))
+        except OSError:
+            LOG.exception('failed to remove spool segment %s', self.path(seq))
+        if self.read_seq == seq:
+            self.read_seq, self.read_offset = (self.segments[0] if self.segments else -1), 0
+            self.save_cursor()
+
+    def peek(self):
+        """Returns the oldest batch, or None when the spool is empty.  The
+           batch stays in the spool until commit() is called."""
+        while self.read_seq != -1:
+            if self.reader is None:
+                self.reader = open(self.path(self.read_seq), 'rb')
+                self.reader.seek(self.read_offset)
+            line = self.reader.readline()
+            if line.endswith('\n'):
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    LOG.error('skipping corrupt spool entry in %s', self.path(self.read_seq))
+                    self.commit()
+                    continue
+            # end of the segment, or a record torn by a crash
+            self.reader.seek(self.read_offset)
+            if self.read_seq == self.segments[-1]:
+                return None
+            self.remove(self.read_seq)
+        return None
+
+    def commit(self):
+        """Drops the batch last returned by peek() from the spool."""
+        self.read_offset = self.reader.tell()
+        self.replayed += 1
+        self.save_cursor()
+
+    def close(self):
+        for f in (self.writer, self.reader):
+            if f is not None:
+                f.close()
+        self.writer = self.reader = None
+
+    def stats(self):
+        """Returns (metric, value) pairs describing the spool."""
+        return [('collector.spool.bytes', len(self)),
+                ('collector.spool.segments', len(self.segments)),
+                ('collector.spool.spooled', self.spooled),
+                ('collector.spool.replayed', self.replayed),
+                ('collector.spool.evicted_bytes', self.evicted_bytes)]
+
 
 # noinspection PyDictCreation
 class Sender(threading.Thread):
@@ -616,69 +1744,122 @@ class Sender(threading.Thread):
         self.maxtags = options.maxtags
         self.dryrun = options.dryrun
         self.dtestmetric = options.dtestmetric
-        self.current_tsd = -1
         self.count = 0
         self.test_count=0
         self.byteSize = 0
-        self.blacklisted_hosts = set()
         random.shuffle(self.hosts)
+        self.pool = TsdPool(self.hosts)
         runner_config = load_runner_conf()
         self.proxy = get_proxy(runner_config)
+        # everything but the body is the same for every request, and the
+        # connections are kept open between batches
+        self.ssl_context = None
+        if self.ssl:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.headers = {'Content-Type': 'application/json',
+                        'Cookie': '_token=' + self.token}
+        if self.http_username and self.http_password:
+            self.headers['Authorization'] = 'Basic %s' % base64.b64encode(
+                '%s:%s' % (self.http_username, self.http_password))
+        self.compression = options.compression
+        self.compression_level = options.compression_level
+        self.compression_min_size = options.compression_min_size
+        # uncompressed to compressed size of the last batch, batches are
+        # this much larger so a request carries MAX_SENDQ_SIZE on the wire
+        self.compression_ratio = 1.0
+        # TsdConnections aren't thread-safe, every sending thread has its own
+        self.local = threading.local()
+        self.connections = []
+        self.last_stats = time.time()
+        self.retry_at = 0  # don't try to send before this time after a failure
+        self.spool_lock = threading.Lock()
+        self.spool = None
+        if options.spool_dir:
+            try:
+                self.spool = DiskSpool(options.spool_dir, options.spool_max_bytes)
+            except EnvironmentError:
+                LOG.exception('failed to open spool %s, running without one', options.spool_dir)
+        self.replay_rate = options.spool_replay_rate
+        self.replay_credit = 0
+        self.last_replay = time.time()
+        # run() builds the request bodies and hands them to the transmit
+        # threads through this bounded buffer, it blocks while they are
+        # behind and leaves the lines in readq
+        self.batches = Queue(options.send_buffer)
+        self.blocked_time = 0.0  # seconds run() waited for room in self.batches
+        self.workers = []
+        for i in xrange(options.max_inflight):
+            worker = threading.Thread(target=self.transmit, name='sender-%d' % i)
+            worker.daemon = True
+            self.workers.append(worker)
+        self.replay_lock = threading.Lock()
+        # sends are spread over send_interval by an offset derived from the
+        # host name, so the agents of a fleet don't all send at once
+        self.send_interval = options.send_interval
+        self.send_offset = 0
+        if self.send_interval:
+            host = tags.get('host') or socket.gethostname()
+            self.send_offset = (zlib.crc32(host) & 0xffffffff) % (self.send_interval * 1000) / 1000.0
+            LOG.info('sending every %d seconds at offset %.3f', self.send_interval, self.send_offset)
+        self.backlogged = False  # the last batch was cut at the batch size
 
     def shutdown(self):
         LOG.info("signaled sender thread shutdown.")
         self.exit = True
 
     def run(self):
-        """Main loop.  A simple scheduler.  Loop waiting for 5
-           seconds for data on the queue.  If there's no data, just
-           loop and make sure our connection is still open.  If there
-           is data, wait 5 more seconds and grab all of the pending data and
-           send it.  A little better than sending every line as its
-           own packet."""
+        """Main loop, the builder stage.  Loop waiting for 5 seconds for
+           data on the queue.  If there is data, grab all of the pending
+           data up to the batch size, turn it into a request body and hand
+           it to the transmit threads.  A little better than sending every
+           line as its own packet."""
 
         errors = 0  # How many uncaught exceptions in a row we got.
         LOG.info('sender thread started')
+        for worker in self.workers:
+            worker.start()
         while not self.exit:
             metrics = []
             byte_count = 0
             try:
+                if self.send_interval and not self.backlogged:
+                    self.wait_for_send_slot()
                 try:
-                    line = self.readq.get(True, 5)
+                    item = self.readq.get(True, 5)
                 except Empty:
                     time.sleep(5)  # Wait for more data
                     self.readq.nput("%s %d %d" % ("collector.byteSize", time.time(), self.byteSize))
                     self.count += 1
                     self.readq.nput("%s %d %d" % ("collector.batchCount", time.time(), self.count))
+                    self.report_stats()
                     continue
-                metric = self.process(line)
-                if metric is not None:
-                    metrics.append(metric)
-                    byte_count += len(line)
-                while byte_count < MAX_SENDQ_SIZE:
+                byte_count += self.add_lines(item, metrics)
+                batch_size = int(MAX_SENDQ_SIZE * self.compression_ratio)
+                while byte_count < batch_size:
                     # prevents self.sendq fast growing in case of sending fails
                     # in send_data()
                     try:
-                        line = self.readq.get(False)
+                        item = self.readq.get(False)
                     except Empty:
                         break
-                    metric = self.process(line)
-                    if metric is not None:
-                        metrics.append(metric)
-                        byte_count += len(line)
-
-                self.send_data_via_http(metrics)
+                    byte_count += self.add_lines(item, metrics)
+                self.backlogged = byte_count >= batch_size
+
+                if self.spool is not None and time.time() < self.retry_at:
+                    # the TSD is down, keep draining readq into the spool
+                    if self.spool_batch(metrics):
+                        continue
+                if self.dryrun or self.dtestmetric:
+                    self.send_data_via_http(metrics)
+                else:
+                    self.enqueue(metrics, self.build_request(metrics))
                 self.byteSize = byte_count
-                LOG.info('send %d bytes, readq size %d', byte_count, self.readq.qsize())
+                LOG.info('queued %d bytes, readq size %d, %d batches buffered',
+                         byte_count, self.readq.qsize(), self.batches.qsize())
+                self.report_stats()
                 errors = 0  # We managed to do a successful iteration.
-            except urllib2.URLError:
-                if self.readq.qsize() > MAX_READQ_SIZE_TO_START:
-                    LOG.error("sender thread exceeds the max number of url errors (%d). exit", MAX_READQ_SIZE_TO_START)
-                    shutdown()
-                    raise
-                LOG.exception('url exception in Sender. readq size %d < threshold %d, ignoring', self.readq.qsize(), MAX_READQ_SIZE_TO_START)
-                time.sleep(50)
-                continue
             except (ArithmeticError, EOFError, EnvironmentError, LookupError, ValueError):
                 errors += 1
                 if errors > MAX_UNCAUGHT_EXCEPTIONS:
@@ -691,8 +1872,113 @@ class Sender(threading.Thread):
                 LOG.exception('Uncaught exception in Sender, going to exit')
                 shutdown()
                 raise
+        if self.spool is not None:
+            with self.spool_lock:
+                self.spool.close()
         LOG.info('sender thread exited')
 
+    def wait_for_send_slot(self):
+        """Sleeps until the next multiple of send_interval plus our offset."""
+        now = time.time()
+        slot = now - (now - self.send_offset) % self.send_interval + self.send_interval
+        while not self.exit and now < slot:
+            time.sleep(min(slot - now, 1))
+            now = time.time()
+
+    def enqueue(self, metrics, request):
+        """Hands a built batch to the transmit threads, waiting while the
+           buffer between them is full."""
+        start = time.time()
+        while not self.exit:
+            try:
+                self.batches.put((metrics, request), True, 1)
+                break
+            except Full:
+                continue
+        self.blocked_time += time.time() - start
+
+    def transmit(self):
+        """The transmit stage.  Sends the batches run() built and replays
+           the spool in between."""
+        name = threading.current_thread().name
+        while not self.exit:
+            try:
+                metrics, (body, headers) = self.batches.get(True, 1)
+            except Empty:
+                self.replay_spool()
+                continue
+            try:
+                self.post(body, headers)
+            except urllib2.URLError:
+                self.retry_at = time.time() + SEND_RETRY_INTERVAL
+                if self.spool is not None:
+                    LOG.exception('url exception in %s, spooling %d metrics', name, len(metrics))
+                    if self.spool_batch(metrics):
+                        continue
+                if self.readq.qsize() > MAX_READQ_SIZE_TO_START:
+                    LOG.error("sender thread exceeds the max number of url errors (%d). exit", MAX_READQ_SIZE_TO_START)
+                    shutdown()
+                LOG.exception('url exception in %s, dropping %d metrics. readq size %d < threshold %d',
+                              name, len(metrics), self.readq.qsize(), MAX_READQ_SIZE_TO_START)
+                time.sleep(SEND_RETRY_INTERVAL)
+                continue
+            except:
+                LOG.exception('Uncaught exception in %s, ignoring', name)
+                continue
+            self.replay_spool()
+
+    def spool_batch(self, metrics):
+        """Spools metrics, returns False if they couldn't be written."""
+        with self.spool_lock:
+            try:
+                self.spool.append(metrics)
+            except EnvironmentError:
+                LOG.exception('failed to spool %d metrics', len(metrics))
+                return False
+        return True
+
+    def replay_spool(self):
+        """Resends spooled batches once the TSD is reachable again, at no
+           more than replay_rate batches per second on top of the live
+           data."""
+        now = time.time()
+        if self.spool is None or now < self.retry_at:
+            return
+        # one transmit thread replays at a time
+        if not self.replay_lock.acquire(False):
+            return
+        try:
+            self.replay_credit = min(self.replay_credit + (now - self.last_replay) * self.replay_rate,
+                                     self.replay_rate * SPOOL_REPLAY_BURST)
+            self.last_replay = now
+            while self.replay_credit >= 1:
+                with self.spool_lock:
+                    metrics = self.spool.peek()
+                if metrics is None:
+                    break
+                try:
+                    self.send_data_via_http(metrics)
+                except urllib2.URLError:
+                    LOG.exception('failed to replay spooled metrics')
+                    self.retry_at = time.time() + SEND_RETRY_INTERVAL
+                    return
+                with self.spool_lock:
+                    self.spool.commit()
+                self.replay_credit -= 1
+        finally:
+            self.replay_lock.release()
+
+    def add_lines(self, item, metrics):
+        """Adds the metric entries of a readq item, a line or a list of
+           lines, to metrics.  Returns the number of bytes added."""
+        byte_count = 0
+        for line in (item if isinstance(item, list) else (item,)):
+            metric = self.process(line)
+            if metric is not None:
+                metrics.append(metric)
+                byte_count += len(line)
+        return byte_count
+
     def process(self, line):
         parts = line.split(None, 3)
         # not all metrics have metric-specific tags
@@ -744,84 +2030,89 @@ class Sender(threading.Thread):
                                                     indent=4)
             return
 
-        if (self.current_tsd == -1) or (len(self.hosts) > 1):
-            self.pick_connection()
-        # print "Using server: %s:%s" % (self.host, self.port)
-        # url = "http://%s:%s/api/put?details" % (self.host, self.port)
-        # print "Url is %s" % url
-        LOG.debug("Sending metrics to http://%s:%s/api/put?details",
-                  self.host, self.port)
-        if self.ssl:
-            protocol = "https"
-        else:
-            protocol = "http"
+        self.post(*self.build_request(metrics))
+
+    def build_request(self, metrics):
+        """Returns the body and headers of the put request for metrics."""
+        payload = json.dumps({'token': self.token, 'metrics': metrics})
+        body, encoding = common_utils.compress_payload(
+            payload, self.compression, self.compression_level, self.compression_min_size)
+        headers = self.headers
+        if encoding is not None:
+            headers = dict(headers, **{'Content-Encoding': encoding})
+            self.compression_ratio = min(len(payload) / float(len(body)), MAX_COMPRESSION_RATIO)
+        LOG.info('put request payload %d, %d on the wire', len(payload), len(body))
+        return body, headers
+
+    def post(self, body, headers):
+        """Sends a put request, raises urllib2.URLError if no TSD took it."""
+        # a batch a TSD failed is tried on the others before giving up
+        for attempt in xrange(len(self.hosts)):
+            host, port = self.pool.acquire()
+            LOG.debug("Sending metrics to %s://%s:%s/api/put?details",
+                      self.ssl and 'https' or 'http', host, port)
+            start = time.time()
+            try:
+                status, reason, response = self.get_connection(host, port).post(
+                    '/api/put?details', body, headers)
+                LOG.debug("Received response %s", status)
+            except urllib2.URLError:
+                self.pool.release((host, port))
+                if attempt == len(self.hosts) - 1:
+                    raise
+                LOG.exception("error when sending to server %s:%d, trying the next one", host, port)
+                continue
+            except:
+                self.pool.release((host, port))
+                LOG.exception("unknown error when sending to server %s:%d", host, port)
+                raise
+            self.pool.release((host, port), time.time() - start)
+            if not 200 <= status < 300:
+                LOG.error("Got error when sending to server %s: %d %s %s", host, status, reason, response)
+            return
+
+    def get_connection(self, host, port):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        connection = connections.get((host, port))
+        if connection is None:
+            connection = TsdConnection(host, port, self.ssl_context, self.proxy)
+            connections[(host, port)] = connection
+            self.connections.append(connection)
+        return connection
+
+    def report_stats(self):
+        """Queues the sender's own stats, at most every SENDER_STATS_INTERVAL."""
+        now = time.time()
+        if now - self.last_stats < SENDER_STATS_INTERVAL:
+            return
+        self.last_stats = now
+        # sending threads may share a TSD, sum up their connections
+        totals = {}
+        for connection in list(self.connections):
+            for metric, value in connection.stats():
+                key = (metric, (connection.host, connection.port))
+                if metric.endswith('_ms'):
+                    totals[key] = max(totals.get(key, 0), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        for (metric, (host, port)), value in totals.iteritems():
+            self.readq.nput("%s %d %d tsd=%s port=%d" % (metric, now, value, host, port))
+        for metric, value, (host, port) in self.pool.stats():
+            self.readq.nput("%s %d %d tsd=%s port=%d" % (metric, now, value, host, port))
+        # depth of the queues in front of the builder and transmit stages
+        self.readq.nput("collector.sender.readq_depth %d %d" % (now, self.readq.qsize()))
+        self.readq.nput("collector.sender.buffer_depth %d %d" % (now, self.batches.qsize()))
+        self.readq.nput("collector.sender.builder_blocked_ms %d %d" % (now, self.blocked_time * 1000))
+        if self.send_interval:
+            self.readq.nput("collector.sender.send_offset_ms %d %d" % (now, self.send_offset * 1000))
+        if self.spool is not None:
+            with self.spool_lock:
+                stats = self.spool.stats()
+            for metric, value in stats:
+                self.readq.nput("%s %d %d" % (metric, now, value))
 
-        if self.proxy is not None:
-            self.proxy['http'] = "%s:%s" % (self.proxy['host'], self.proxy['port'])
-            self.proxy['https'] = "%s:%s" % (self.proxy['host'], self.proxy['port'])
-            urllib2.install_opener(
-                urllib2.build_opener(
-                    urllib2.ProxyHandler(self.proxy)
-                )
-            )
-        req = urllib2.Request("%s://%s:%s/api/put?details" % (
-            protocol, self.host, self.port))
-        if self.http_username and self.http_password:
-            req.add_header("Authorization", "Basic %s"
-                           % base64.b64encode("%s:%s" % (self.http_username, self.http_password)))
-        req.add_header("Content-Type", "application/json")
-        req.add_header("Cookie", "_token="+self.token)
-        try:
-            payload = json.dumps(data)
-            LOG.info('put request payload %d', len(payload))
-            if self.ssl:
-                ctx = ssl.create_default_context()
-                ctx.check_hostname = False
-                ctx.verify_mode = ssl.CERT_NONE
-                response = urllib2.urlopen(req, payload, context=ctx, timeout=20)
-            else:
-                response = urllib2.urlopen(req, payload, timeout=20)
-            LOG.debug("Received response %s", response.getcode())
-            # print "Got response code: %s" % response.getcode()
-            # print "Content:"
-            # for line in response:
-            #     print line,
-            #     print
-        except urllib2.HTTPError, e:
-            LOG.exception("Got error when sending to server %s", self.host)
-            # for line in http_error:
-            #   print line,
-        except:
-            LOG.exception("unknown error when sending to server %s:%d", self.host, self.port)
-            raise
-
-    def pick_connection(self):
-        """Picks up a random host/port connection."""
-        # Try to get the next host from the list, until we find a host that
-        # isn't in the blacklist, or until we run out of hosts (i.e. they
-        # are all blacklisted, which typically happens when we lost our
-        # connectivity to the outside world).
-        for self.current_tsd in xrange(self.current_tsd + 1, len(self.hosts)):
-            hostport = self.hosts[self.current_tsd]
-            if hostport not in self.blacklisted_hosts:
-                break
-        else:
-            LOG.info('No more healthy hosts, retry with previously blacklisted')
-            random.shuffle(self.hosts)
-            self.blacklisted_hosts.clear()
-            self.current_tsd = 0
-            hostport = self.hosts[self.current_tsd]
-        # noinspection PyAttributeOutsideInit
-        self.host, self.port = hostport
-        LOG.info('Selected connection: %s:%d', self.host, self.port)
-
-    def blacklist_connection(self):
-        """Marks the current TSD host we're trying to use as blacklisted.
-
-           Blacklisted hosts will get another chance to be elected once there
-           will be no more healthy hosts."""
-        LOG.info('Blacklisting %s:%s for a while', self.host, self.port)
-        self.blacklisted_hosts.add((self.host, self.port))
     def test_metrics(self,metrics):
 
         metric_dict = {'metric_name_count':{}}
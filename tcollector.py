@@ -21,12 +21,15 @@
 #
 
 import atexit
+import bisect
 import errno
 import fcntl
+import itertools
 import logging
 import os
 import random
 import re
+import select
 import signal
 import socket
 import subprocess
@@ -36,19 +39,27 @@ import time
 import json
 import urllib2
 import base64
+from collections import deque
 from logging.handlers import RotatingFileHandler
 from Queue import Queue
 from Queue import Empty
 from Queue import Full
 from optparse import OptionParser
 
+import common_utils
+
 
 # global variables.
 COLLECTORS = {}
 GENERATION = 0
+INSTANCES = itertools.count()  # numbers the Collector instances
+# with --host-collectors, interval Python collectors run from a collector_host.py
+HOST_COLLECTORS = False
+COLLECTOR_HOST = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'collector_host.py')
 DEFAULT_LOG = '/var/log/tcollector.log'
 LOG = logging.getLogger('tcollector')
 ALIVE = True
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
 # If the SenderThread catches more than this many consecutive uncaught
 # exceptions, something is not right and tcollector will shutdown.
 # Hopefully some kind of supervising daemon will then restart it.
@@ -58,8 +69,22 @@ MAX_REASONABLE_TIMESTAMP = 1600000000  # Good until September 2020 :)
 # How long to wait for datapoints before assuming
 # a collector is dead and restarting it
 ALLOWED_INACTIVITY_TIME = 600  # seconds
+TSD_PROBE_INTERVAL = 10  # seconds a failed TSD is skipped, doubled on each failure
+MAX_TSD_PROBE_INTERVAL = 600
 MAX_SENDQ_SIZE = 10000
 MAX_READQ_SIZE = 100000
+# How many dedup cache entries the ReaderThread looks at for eviction on
+# every pass of its loop.
+DEDUP_EVICT_BUDGET = 10000
+# Tag strings seen recently and their parsed form, most series send the same
+# tags every interval.
+PARSED_TAGS = {}
+MAX_PARSED_TAGS = 100000
+# The format of a line printed by a collector.
+DATAPOINT_RE = re.compile(r'^([-_./a-zA-Z0-9]+)\s+'  # Metric name.
+                          r'(\d+\.?\d+)\s+'        # Timestamp.
+                          r'(\S+?)'                # Value (int or float).
+                          r'((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$')  # Tags
 
 
 def register_collector(collector):
@@ -78,6 +103,43 @@ def register_collector(collector):
     COLLECTORS[collector.name] = collector
 
 
+class DataPoint(object):
+    """A datapoint parsed out of a collector line.  Lines are tokenized once
+       by the ReaderThread and travel through dedup, the queue and the
+       senders as DataPoints."""
+
+    __slots__ = ('metric', 'timestamp', 'value', 'raw_tags', '_tags')
+
+    def __init__(self, metric, timestamp, value, raw_tags=''):
+        self.metric = metric
+        self.timestamp = timestamp  # int, seconds or milliseconds
+        self.value = value          # str, exactly as the collector sent it
+        self.raw_tags = raw_tags    # ' k1=v1 k2=v2', as the collector sent it
+        self._tags = None
+
+    @property
+    def tags(self):
+        """The tags as a tuple of (key, value) pairs.  Only split on first
+           use, most datapoints get suppressed by dedup before anybody asks."""
+        if self._tags is None:
+            tags = PARSED_TAGS.get(self.raw_tags)
+            if tags is None:
+                if len(PARSED_TAGS) >= MAX_PARSED_TAGS:
+                    PARSED_TAGS.clear()
+                tags = tuple([tuple(tag.split('=', 1))
+                              for tag in self.raw_tags.split()])
+                PARSED_TAGS[self.raw_tags] = tags
+            self._tags = tags
+        return self._tags
+
+    def __str__(self):
+        return '%s %d %s%s' % (self.metric, self.timestamp, self.value,
+                               self.raw_tags)
+
+    def __repr__(self):
+        return 'DataPoint(%r)' % str(self)
+
+
 class ReaderQueue(Queue):
     """A Queue for the reader thread"""
 
@@ -92,6 +154,159 @@ class ReaderQueue(Queue):
         return True
 
 
+class ReadLatencyHistogram(object):
+    """Histogram of the delay between the timestamp a collector put on a
+       datapoint and the moment the ReaderThread picked the line up.
+
+       Collectors mostly emit whole-second timestamps, so every sample
+       carries up to one second of truncation on top of the real delay;
+       what matters is how the distribution moves, not the absolute values."""
+
+    # upper bounds of the buckets, in seconds
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, latency):
+        """Records one sample, in seconds."""
+        self.counts[bisect.bisect_left(self.BUCKETS, latency)] += 1
+        self.total += 1
+        self.sum += latency
+
+    def stats(self):
+        """Returns (name, tags, value) tuples of the cumulative bucket counts,
+           in the format used by the SenderThread for self-reported stats."""
+        strs = []
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            cumulative += count
+            strs.append(('reader.read_latency', 'le=%s' % bound, cumulative))
+        strs.append(('reader.read_latency', 'le=inf', self.total))
+        strs.append(('reader.read_latency_sum', '', self.sum))
+        return strs
+
+
+class LineFramer(object):
+    """Splits the byte stream coming out of a collector into lines.
+
+       Every chunk is split in a single pass and the complete lines are
+       handed back as one batch.  Only the trailing partial line is carried
+       over, in a bytearray so that a line dribbling in over many reads
+       doesn't get copied over and over."""
+
+    def __init__(self):
+        self.tail = bytearray()
+
+    def feed(self, data):
+        """Consumes a chunk of bytes and returns the list of complete lines
+           found, stripped, with the empty ones left out."""
+        if data.rfind('\n') == -1:
+            self.tail.extend(data)
+            return []
+        lines = data.split('\n')
+        if self.tail:
+            self.tail.extend(lines[0])
+            lines[0] = str(self.tail)
+            del self.tail[:]
+        self.tail.extend(lines.pop())
+        return [line for line in [l.strip() for l in lines] if line]
+
+    def __len__(self):
+        return len(self.tail)
+
+
+class DedupCache(object):
+    """The last value seen for every (collector instance, metric, tags)
+       key, used by the ReaderThread to suppress duplicate values.
+
+       Keys are interned, the same metric names and tag strings come back
+       every interval.  Besides the dict, keys are filed in a wheel of time
+       buckets by when they were last seen: old entries get evicted a few at
+       a time from the oldest bucket, and when the cache grows over
+       max_entries the least recently seen entries go first.  A key is filed
+       again at most once per bucket, the stale filings left behind are
+       skipped when their bucket is evicted."""
+
+    def __init__(self, evictinterval, max_entries=0):
+        self.evictinterval = evictinterval
+        self.max_entries = max_entries  # 0 for no limit
+        self.granularity = max(1, evictinterval // 16)  # seconds per bucket
+        # Maps keys to (value, last_timestamp, timestamp, bucket) where:
+        #  value: Last value seen.
+        #  last_timestamp: Timestamp of the last datapoint seen for the key,
+        #    if it differs from timestamp the value was repeated.
+        #  timestamp: Time at which we saw the value for the first time.
+        #  bucket: The bucket the key was last filed in.
+        self.entries = {}
+        self.buckets = deque()  # (bucket, deque of keys), both oldest first
+        self.evicted = 0        # entries dropped because they were too old
+        self.overflowed = 0     # entries dropped because of max_entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value, last_timestamp, timestamp, now):
+        """Stores an entry for key, now being the current time."""
+        bucket = int(now) // self.granularity
+        entry = self.entries.get(key)
+        if entry is not None and entry[3] == bucket:
+            self.entries[key] = (value, last_timestamp, timestamp, bucket)
+            return
+        key = tuple([intern(part) for part in key])
+        self.entries[key] = (value, last_timestamp, timestamp, bucket)
+        if not self.buckets or self.buckets[-1][0] < bucket:
+            self.buckets.append((bucket, deque()))
+        self.buckets[-1][1].append(key)
+        if self.max_entries and len(self.entries) > self.max_entries:
+            self.overflowed += self._drop(None, len(self.entries) - self.max_entries, key)
+
+    def evict(self, now, budget):
+        """Removes the entries that haven't been seen for evictinterval
+           seconds, looking at no more than budget filings at a time."""
+        cut_off = int(now - self.evictinterval) // self.granularity
+        self.evicted += self._drop(cut_off, budget)
+
+    def _drop(self, cut_off, budget, keep=None):
+        """Drops the least recently filed entries, stopping at bucket
+           cut_off or once budget filings were looked at, and never dropping
+           the key keep.  Returns the number of entries dropped."""
+        dropped = 0
+        while self.buckets and budget > 0:
+            bucket, keys = self.buckets[0]
+            if cut_off is not None and bucket >= cut_off:
+                break
+            while keys and budget > 0:
+                if keys[0] is keep:
+                    # only the key just filed is left
+                    return dropped
+                key = keys.popleft()
+                entry = self.entries.get(key)
+                if entry is not None and entry[3] == bucket:
+                    del self.entries[key]
+                    dropped += 1
+                    budget -= 1
+                elif cut_off is not None:
+                    budget -= 1
+            if not keys:
+                self.buckets.popleft()
+        return dropped
+
+    def stats(self):
+        """Returns (name, tags, value) tuples in the format used by the
+           SenderThread for self-reported stats."""
+        return [('dedup.entries', '', len(self.entries)),
+                ('dedup.max_entries', '', self.max_entries),
+                ('dedup.buckets', '', len(self.buckets)),
+                ('dedup.evicted', '', self.evicted),
+                ('dedup.overflowed', '', self.overflowed)]
+
+
 class Collector(object):
     """A Collector is a script that is run that gathers some data
        and prints it out in standard TSD format on STDOUT.  This
@@ -111,26 +326,39 @@ class Collector(object):
         self.dead = False
         self.mtime = mtime
         self.generation = GENERATION
-        self.buffer = ""
-        self.datalines = []
-        # Maps (metric, tags) to (value, repeated, line, timestamp) where:
-        #  value: Last value seen.
-        #  repeated: boolean, whether the last value was seen more than once.
-        #  line: The last line that was read from that collector.
-        #  timestamp: Time at which we saw the value for the first time.
-        # This dict is used to keep track of and remove duplicate values.
-        # Since it might grow unbounded (in case we see many different
-        # combinations of metrics and tags) someone needs to regularly call
-        # evict_old_keys() to remove old entries.
-        self.values = {}
+        # dedup keys of a respawned collector don't carry over from the
+        # collector it replaced, whose entries get evicted as they age
+        self.dedup_name = '%s#%d' % (colname, next(INSTANCES))
+        self.hosted = HOST_COLLECTORS and interval > 0 and is_hostable(filename)
+        self.framer = LineFramer()
+        self.datalines = deque()
         self.lines_sent = 0
         self.lines_received = 0
         self.lines_invalid = 0
+        self.bytes_received = 0
+        self.started = None  # when the process was spawned, for accounting
+        self.reported = None  # (time, cpu, lines, bytes) as of the last usage report
         self.last_datapoint = int(time.time())
+        # reap_children() drains the pipes of a dead collector while the
+        # ReaderThread may still be reading them
+        self.read_lock = threading.Lock()
+
+    def lines_read(self):
+        """Lines read from the process so far, processed or not."""
+        return self.lines_received + len(self.datalines)
+
+    def spawned(self):
+        """Notes that the process was just started, for accounting."""
+        self.started = time.time()
+        self.reported = (self.started, 0.0, self.lines_read(), self.bytes_received)
 
     def read(self):
         """Read bytes from our subprocess and store them in our temporary
            line storage buffer.  This needs to be non-blocking."""
+        with self.read_lock:
+            self._read()
+
+    def _read(self):
 
         # we have to use a buffer because sometimes the collectors
         # will write out a bunch of data points at one time and we
@@ -155,33 +383,28 @@ class Collector(object):
         # out a bunch of data points at one time and we get some weird sized
         # chunk.  This read call is non-blocking.
         try:
-            self.buffer += self.proc.stdout.read()
-            if len(self.buffer):
-                LOG.debug('reading %s, buffer now %d bytes',
-                          self.name, len(self.buffer))
+            out = self.proc.stdout.read()
+            if out:
+                self.bytes_received += len(out)
+                LOG.debug('reading %s got %d bytes, %d bytes pending',
+                          self.name, len(out), len(self.framer))
         except IOError, (err, msg):
             if err != errno.EAGAIN:
                 raise
+            return
         except AttributeError:
             # sometimes the process goes away in another thread and we don't
             # have it anymore, so log an error and bail
             LOG.exception('caught exception, collector process went away while reading stdout')
+            return
         except:
             LOG.exception('uncaught exception in stdout read')
             return
 
-        # iterate for each line we have
-        while self.buffer:
-            idx = self.buffer.find('\n')
-            if idx == -1:
-                break
-
-            # one full line is now found and we can pull it out of the buffer
-            line = self.buffer[0:idx].strip()
-            if line:
-                self.datalines.append(line)
-                self.last_datapoint = int(time.time())
-            self.buffer = self.buffer[idx+1:]
+        lines = self.framer.feed(out)
+        if lines:
+            self.datalines.extend(lines)
+            self.last_datapoint = int(time.time())
 
     def collect(self):
         """Reads input from the collector and returns the lines up to whomever
@@ -190,10 +413,10 @@ class Collector(object):
 
         while self.proc is not None:
             self.read()
-            if not len(self.datalines):
+            if not self.datalines:
                 return
-            while len(self.datalines):
-                yield self.datalines.pop(0)
+            while self.datalines:
+                yield self.datalines.popleft()
 
     def shutdown(self):
         """Cleanly shut down the collector"""
@@ -215,17 +438,19 @@ class Collector(object):
             # we really don't want to die as we're trying to exit gracefully
             LOG.exception('ignoring uncaught exception while shutting down')
 
-    def evict_old_keys(self, cut_off):
-        """Remove old entries from the cache used to detect duplicate values.
 
-        Args:
-          cut_off: A UNIX timestamp.  Any value that's older than this will be
-            removed from the cache.
-        """
-        for key in self.values.keys():
-            time = self.values[key][3]
-            if time < cut_off:
-                del self.values[key]
+def is_hostable(filename):
+    """Tells whether a collector script can be run by collector_host.py:
+       a Python script with a main() it only calls when run as __main__."""
+    if not filename.endswith('.py'):
+        return False
+    try:
+        with open(filename) as f:
+            source = f.read()
+    except IOError:
+        return False
+    return re.search(r'^def main\(', source, re.M) is not None and \
+        re.search(r'^if __name__ == .__main__.:', source, re.M) is not None
 
 
 class StdinCollector(Collector):
@@ -266,7 +491,8 @@ class ReaderThread(threading.Thread):
        All data read is put into the self.readerq Queue, which is
        consumed by the SenderThread."""
 
-    def __init__(self, dedupinterval, evictinterval):
+    def __init__(self, dedupinterval, evictinterval, use_epoll=True,
+                 dedup_max_entries=0):
         """Constructor.
             Args:
               dedupinterval: If a metric sends the same value over successive
@@ -278,6 +504,13 @@ class ReaderThread(threading.Thread):
                 combination of (metric, tags).  Values older than
                 evictinterval will be removed from the cache to save RAM.
                 Invariant: evictinterval > dedupinterval
+              use_epoll: If true and the platform supports it, wait on the
+                collectors' pipes with epoll instead of polling every
+                collector once a second.  The StdinCollector does blocking
+                reads and needs this to be off.
+              dedup_max_entries: The most (metric, tags) combinations to
+                keep track of for dedup, 0 for no limit.  The least recently
+                seen ones are forgotten first.
         """
         assert evictinterval > dedupinterval, "%r <= %r" % (evictinterval,
                                                             dedupinterval)
@@ -288,38 +521,138 @@ class ReaderThread(threading.Thread):
         self.lines_dropped = 0
         self.dedupinterval = dedupinterval
         self.evictinterval = evictinterval
+        self.dedup = DedupCache(evictinterval, dedup_max_entries)
+        self.read_latency = ReadLatencyHistogram()
+        self.poller = None
+        self.registered = {}  # fd -> Collector owning that pipe
+        self.hungup = set()   # registered fds whose writer went away
+        self.wakeup_r = self.wakeup_w = None
+        if use_epoll and hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            # self-pipe, so that the main loop can get newly spawned
+            # collectors registered without waiting for the poll timeout
+            self.wakeup_r, self.wakeup_w = os.pipe()
+            set_nonblocking(self.wakeup_r)
+            set_nonblocking(self.wakeup_w)
+            self.poller.register(self.wakeup_r, select.EPOLLIN)
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
            does our input processing and de-duping, and puts the data
            into the queue."""
 
-        LOG.debug("ReaderThread up and running")
+        LOG.debug("ReaderThread up and running (%s)",
+                  self.poller is not None and 'epoll' or 'polling')
 
-        lastevict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
         while ALIVE:
-            for col in all_living_collectors():
-                for line in col.collect():
-                    self.process_line(col, line)
+            if self.poller is not None:
+                self.wait_for_collectors(1)
+            else:
+                # no epoll here, read everybody and sleep a second to
+                # prevent us from spinning
+                for col in all_living_collectors():
+                    for line in col.collect():
+                        self.process_line(col, line)
+                time.sleep(1)
 
             if self.dedupinterval != 0:  # if 0 we do not use dedup
-                now = int(time.time())
-                if now - lastevict_time > self.evictinterval:
-                    lastevict_time = now
-                    now -= self.evictinterval
-                    for col in all_collectors():
-                        col.evict_old_keys(now)
+                # a little at a time, so that we never stall the reader
+                self.dedup.evict(time.time(), DEDUP_EVICT_BUDGET)
+
+        if self.poller is not None:
+            self.poller.close()
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+
+    def wakeup(self):
+        """Interrupts a pending wait_for_collectors() so that collectors
+           spawned in the meantime get registered right away."""
+        if self.wakeup_w is None:
+            return
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:  # a wakeup is already pending
+                raise
+
+    def sync_registrations(self):
+        """Registers the pipes of newly spawned collectors with the poller
+           and forgets about the ones of collectors that went away."""
+        wanted = {}
+        for col in all_living_collectors():
+            try:
+                wanted[col.proc.stdout.fileno()] = col
+                wanted[col.proc.stderr.fileno()] = col
+            except (AttributeError, ValueError):
+                # the process went away in another thread, or this
+                # collector has no pipes to wait on
+                continue
 
-            # and here is the loop that we really should get rid of, this
-            # just prevents us from spinning right now
-            time.sleep(1)
+        for fd, col in self.registered.items():
+            if wanted.get(fd) is not col:
+                self.unregister(fd)
+        for fd, col in wanted.iteritems():
+            if fd not in self.registered:
+                self.register(fd, col)
+
+    def register(self, fd, col):
+        try:
+            self.poller.register(fd, select.EPOLLIN)
+        except IOError, e:
+            # the fd number got recycled before we noticed the old pipe
+            # was closed, and the kernel kept the old registration
+            if e.errno != errno.EEXIST:
+                raise
+            self.poller.modify(fd, select.EPOLLIN)
+        self.registered[fd] = col
+
+    def unregister(self, fd):
+        del self.registered[fd]
+        if fd in self.hungup:
+            self.hungup.discard(fd)
+            return
+        try:
+            self.poller.unregister(fd)
+        except (IOError, ValueError):
+            # closed fds are dropped from the epoll set by the kernel
+            pass
+
+    def wait_for_collectors(self, timeout):
+        """Waits up to timeout seconds for output on any collector pipe and
+           processes whatever lines are available."""
+        self.sync_registrations()
+        try:
+            events = self.poller.poll(timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            return
 
-    def process_line(self, col, line):
-        """Parses the given line and appends the result to the reader queue."""
+        for fd, event in events:
+            if fd == self.wakeup_r:
+                try:
+                    while os.read(self.wakeup_r, 512):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                continue
+            col = self.registered.get(fd)
+            if col is None:
+                continue
+            now = time.time()
+            for line in col.collect():
+                self.process_line(col, line, now)
+            if event & (select.EPOLLHUP | select.EPOLLERR):
+                # the collector closed its end of the pipe, we drained what
+                # was left above.  Stop watching it until it gets reaped,
+                # epoll would otherwise report the hangup forever.
+                self.poller.unregister(fd)
+                self.hungup.add(fd)
+
+    def process_line(self, col, line, now=None):
+        """Parses the given line and appends the result to the reader queue.
+           now is the time the line was read at, the current time if None."""
 
         self.lines_collected += 1
 
@@ -328,23 +661,29 @@ class ReaderThread(threading.Thread):
             LOG.warning('%s line too long: %s', col.name, line)
             col.lines_invalid += 1
             return
-        parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
-                          '(\d+\.?\d+)\s+'               # Timestamp.
-                          '(\S+?)'                 # Value (int or float).
-                          '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
-                          line)
+        parsed = DATAPOINT_RE.match(line)
         if parsed is None:
             LOG.warning('%s sent invalid data: %s', col.name, line)
             col.lines_invalid += 1
             return
         metric, timestamp, value, tags = parsed.groups()
-        timestamp = int(timestamp)
+        try:
+            timestamp = int(timestamp)
+        except ValueError:  # the timestamp pattern lets '123.45' through
+            LOG.warning('%s sent invalid data: %s', col.name, line)
+            col.lines_invalid += 1
+            return
 
+        if now is None:
+            now = time.time()
         # If there are more than 11 digits we're dealing with a timestamp
         # with millisecond precision
-        if len(str(timestamp)) > 11:
+        if timestamp > 99999999999:
             global MAX_REASONABLE_TIMESTAMP
             MAX_REASONABLE_TIMESTAMP = MAX_REASONABLE_TIMESTAMP * 1000
+            self.read_latency.observe(now - timestamp / 1000.0)
+        else:
+            self.read_latency.observe(now - timestamp)
 
         # De-dupe detection...  To reduce the number of points we send to the
         # TSD, we suppress sending values of metrics that don't change to
@@ -356,21 +695,23 @@ class ReaderThread(threading.Thread):
         # slopes of graphs correct).
         #
         if self.dedupinterval != 0:  # if 0 we do not use dedup
-            key = (metric, tags)
-            if key in col.values:
+            key = (col.dedup_name, metric, tags)
+            prev = self.dedup.get(key)
+            if prev is not None:
+                prev_value, last_timestamp, prev_timestamp = prev[:3]
                 # if the timestamp isn't > than the previous one, ignore this value
-                if timestamp <= col.values[key][3]:
+                if timestamp <= prev_timestamp:
                     LOG.error("Timestamp out of order: metric=%s%s,"
                               " old_ts=%d >= new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              prev_timestamp, timestamp, value, col.name)
                     col.lines_invalid += 1
                     return
                 elif timestamp >= MAX_REASONABLE_TIMESTAMP:
                     LOG.error("Timestamp is too far out in the future: metric=%s%s"
                               " old_ts=%d, new_ts=%d - ignoring data point"
                               " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              prev_timestamp, timestamp, value, col.name)
                     return
 
                 # if this data point is repeated, store it but don't send.
@@ -378,33 +719,29 @@ class ReaderThread(threading.Thread):
                 # we send the timestamp when this metric first became the current
                 # value instead of the last.  Fall through if we reach
                 # the dedup interval so we can print the value.
-                if (col.values[key][0] == value and
-                    (timestamp - col.values[key][3] < self.dedupinterval)):
-                    col.values[key] = (value, True, line, col.values[key][3])
+                if (prev_value == value and
+                    (timestamp - prev_timestamp < self.dedupinterval)):
+                    self.dedup.put(key, value, timestamp, prev_timestamp, now)
                     return
 
                 # we might have to append two lines if the value has been the same
                 # for a while and we've skipped one or more values.  we need to
                 # replay the last value we skipped (if changed) so the jumps in
                 # our graph are accurate,
-                if ((col.values[key][1] or
-                    (timestamp - col.values[key][3] >= self.dedupinterval))
-                    and col.values[key][0] != value):
+                if ((last_timestamp != prev_timestamp or
+                    (timestamp - prev_timestamp >= self.dedupinterval))
+                    and prev_value != value):
                     col.lines_sent += 1
-                    if not self.readerq.nput(col.values[key][2]):
+                    if not self.readerq.nput(DataPoint(metric, last_timestamp,
+                                                       prev_value, tags)):
                         self.lines_dropped += 1
 
             # now we can reset for the next pass and send the line we actually
             # want to send
-            # col.values is a dict of tuples, with the key being the metric and
-            # tags (essentially the same as wthat TSD uses for the row key).
-            # The array consists of:
-            # [ the metric's value, if this value was repeated, the line of data,
-            #   the value's timestamp that it last changed ]
-            col.values[key] = (value, False, line, timestamp)
+            self.dedup.put(key, value, timestamp, timestamp, now)
 
         col.lines_sent += 1
-        if not self.readerq.nput(line):
+        if not self.readerq.nput(DataPoint(metric, timestamp, value, tags)):
             self.lines_dropped += 1
 
 
@@ -417,7 +754,8 @@ class SenderThread(threading.Thread):
 
     def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
                  reconnectinterval=0, http=False, http_username=None,
-                 http_password=None, ssl=False, maxtags=8):
+                 http_password=None, ssl=False, maxtags=8, compression='none',
+                 compression_level=6, compression_min_size=0):
         """Constructor.
 
         Args:
@@ -431,6 +769,8 @@ class SenderThread(threading.Thread):
           http: A boolean that controls whether or not the http endpoint is used.
           ssl: A boolean that controls whether or not the http endpoint uses ssl.
           tags: A dictionary of tags to append for every data point.
+          compression: 'gzip' or 'deflate' to compress http request bodies
+            of at least compression_min_size bytes, 'none' to send them as is.
         """
         super(SenderThread, self).__init__()
 
@@ -441,10 +781,14 @@ class SenderThread(threading.Thread):
         self.http_username = http_username
         self.http_password = http_password
         self.ssl = ssl
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
         self.hosts = hosts  # A list of (host, port) pairs.
         # Randomize hosts to help even out the load.
         random.shuffle(self.hosts)
-        self.blacklisted_hosts = set()  # The 'bad' (host, port) pairs.
+        # The 'bad' (host, port) pairs -> (time they may be tried again, interval).
+        self.blacklisted_hosts = {}
         self.current_tsd = -1  # Index in self.hosts where we're at.
         self.host = None  # The current TSD host we've selected.
         self.port = None  # The port of the current TSD.
@@ -457,32 +801,40 @@ class SenderThread(threading.Thread):
         self.maxtags = maxtags # The maximum number of tags TSD will accept.
 
     def pick_connection(self):
-        """Picks up a random host/port connection."""
-        # Try to get the next host from the list, until we find a host that
-        # isn't in the blacklist, or until we run out of hosts (i.e. they
-        # are all blacklisted, which typically happens when we lost our
-        # connectivity to the outside world).
-        for self.current_tsd in xrange(self.current_tsd + 1, len(self.hosts)):
-            hostport = self.hosts[self.current_tsd]
-            if hostport not in self.blacklisted_hosts:
+        """Picks up the next host/port connection."""
+        # Try the hosts in turn, skipping the blacklisted ones until their
+        # probe time has come.  If they are all blacklisted (which typically
+        # happens when we lost our connectivity to the outside world), probe
+        # the one due first.
+        now = time.time()
+        for i in xrange(1, len(self.hosts) + 1):
+            index = (self.current_tsd + i) % len(self.hosts)
+            hostport = self.hosts[index]
+            if self.blacklisted_hosts.get(hostport, (0, 0))[0] <= now:
                 break
         else:
-            LOG.info('No more healthy hosts, retry with previously blacklisted')
-            random.shuffle(self.hosts)
-            self.blacklisted_hosts.clear()
-            self.current_tsd = 0
-            hostport = self.hosts[self.current_tsd]
+            hostport = min(self.hosts, key=lambda hp: self.blacklisted_hosts[hp][0])
+            index = self.hosts.index(hostport)
+            LOG.info('No more healthy hosts, probing %s:%d', hostport[0], hostport[1])
+        self.current_tsd = index
         self.host, self.port = hostport
         LOG.info('Selected connection: %s:%d', self.host, self.port)
 
     def blacklist_connection(self):
         """Marks the current TSD host we're trying to use as blacklisted.
 
-           Blacklisted hosts will get another chance to be elected once there
-           will be no more healthy hosts."""
-        # FIXME: Enhance this naive strategy.
-        LOG.info('Blacklisting %s:%s for a while', self.host, self.port)
-        self.blacklisted_hosts.add((self.host, self.port))
+           Blacklisted hosts are skipped until their probe interval expired,
+           which doubles every time they fail again."""
+        hostport = (self.host, self.port)
+        _, interval = self.blacklisted_hosts.get(hostport, (0, TSD_PROBE_INTERVAL / 2))
+        interval = min(interval * 2, MAX_TSD_PROBE_INTERVAL)
+        LOG.info('Blacklisting %s:%s for %d seconds', self.host, self.port, interval)
+        self.blacklisted_hosts[hostport] = (time.time() + interval, interval)
+
+    def whitelist_connection(self):
+        """Marks the current TSD host as healthy again."""
+        if self.blacklisted_hosts.pop((self.host, self.port), None) is not None:
+            LOG.info('%s:%s is back', self.host, self.port)
 
     def run(self):
         """Main loop.  A simple scheduler.  Loop waiting for 5
@@ -598,6 +950,8 @@ class SenderThread(threading.Thread):
                         ('reader.lines_dropped',
                          '', self.reader.lines_dropped)
                        ]
+                strs.extend(self.reader.read_latency.stats())
+                strs.extend(self.reader.dedup.stats())
 
                 for col in all_living_collectors():
                     strs.append(('collector.lines_sent', 'collector='
@@ -608,14 +962,14 @@ class SenderThread(threading.Thread):
                                  + col.name, col.lines_invalid))
 
                 ts = int(time.time())
-                strout = ["tcollector.%s %d %d %s"
-                          % (x[0], ts, x[2], x[1]) for x in strs]
-                for string in strout:
-                    self.sendq.append(string)
+                for name, tags, value in strs:
+                    self.sendq.append(DataPoint('tcollector.' + name, ts,
+                                                str(value), tags and ' ' + tags))
 
             break  # TSD is alive.
 
         # if we get here, we assume the connection is good
+        self.whitelist_connection()
         self.last_verify = time.time()
         return True
 
@@ -674,9 +1028,15 @@ class SenderThread(threading.Thread):
                 LOG.error('Failed to connect to %s:%d', self.host, self.port)
                 self.blacklist_connection()
 
-    def add_tags_to_line(self, line):
+    def format_datapoint(self, dp):
+        """Returns the line to send for a datapoint, with our tags appended
+           unless the collector already set them."""
+        line = str(dp)
         for tag, value in self.tags:
-            if ' %s=' % tag not in line:
+            for key, _ in dp.tags:
+                if key == tag:
+                    break
+            else:
                 line += ' %s=%s' % (tag, value)
         return line
 
@@ -690,12 +1050,12 @@ class SenderThread(threading.Thread):
 
         # in case of logging we use less efficient variant
         if LOG.level == logging.DEBUG:
-            for line in self.sendq:
-                line = "put %s" % self.add_tags_to_line(line)
+            for dp in self.sendq:
+                line = "put %s" % self.format_datapoint(dp)
                 out += line + "\n"
                 LOG.debug('SENDING: %s', line)
         else:
-            out = "".join("put %s\n" % self.add_tags_to_line(line) for line in self.sendq)
+            out = "".join("put %s\n" % self.format_datapoint(dp) for dp in self.sendq)
 
         if not out:
             LOG.debug('send_data no data?')
@@ -724,31 +1084,18 @@ class SenderThread(threading.Thread):
     def send_data_via_http(self):
         """Sends outstanding data in self.sendq to TSD in one HTTP API call."""
         metrics = []
-        for line in self.sendq:
-            # print " %s" % line
-            parts = line.split(None, 3)
-            # not all metrics have metric-specific tags
-            if len(parts) == 4:
-              (metric, timestamp, value, raw_tags) = parts
-            else:
-              (metric, timestamp, value) = parts
-              raw_tags = ""
-            # process the tags
-            metric_tags = {}
-            for tag in raw_tags.strip().split():
-                (tag_key, tag_value) = tag.split("=", 1)
-                metric_tags[tag_key] = tag_value
+        room = max(self.maxtags - len(self.tags), 0)
+        for dp in self.sendq:
+            metric_tags = dp.tags
+            if len(metric_tags) > room:
+                LOG.error("Exceeding maximum permitted metric tags - removing %s for metric %s",
+                          str([key for key, _ in metric_tags[room:]]), dp.metric)
+                metric_tags = metric_tags[:room]
             metric_entry = {}
-            metric_entry["metric"] = metric
-            metric_entry["timestamp"] = long(timestamp)
-            metric_entry["value"] = float(value)
-            metric_entry["tags"] = dict(self.tags).copy()
-            if len(metric_tags) + len(metric_entry["tags"]) > self.maxtags:
-              metric_tags_orig = set(metric_tags)
-              subset_metric_keys = frozenset(metric_tags[:len(metric_tags[:self.maxtags-len(metric_entry["tags"])])])
-              metric_tags = dict((k, v) for k, v in metric_tags.iteritems() if k in subset_metric_keys)
-              LOG.error("Exceeding maximum permitted metric tags - removing %s for metric %s",
-                        str(metric_tags_orig - set(metric_tags)), metric)
+            metric_entry["metric"] = dp.metric
+            metric_entry["timestamp"] = long(dp.timestamp)
+            metric_entry["value"] = float(dp.value)
+            metric_entry["tags"] = dict(self.tags)
             metric_entry["tags"].update(metric_tags)
             metrics.append(metric_entry)
 
@@ -775,9 +1122,14 @@ class SenderThread(threading.Thread):
           req.add_header("Authorization", "Basic %s"
                          % base64.b64encode("%s:%s" % (self.http_username, self.http_password)))
         req.add_header("Content-Type", "application/json")
+        body, encoding = common_utils.compress_payload(
+            json.dumps(metrics), self.compression, self.compression_level, self.compression_min_size)
+        if encoding is not None:
+            req.add_header("Content-Encoding", encoding)
         try:
-            response = urllib2.urlopen(req, json.dumps(metrics))
+            response = urllib2.urlopen(req, body)
             LOG.debug("Received response %s", response.getcode())
+            self.whitelist_connection()
             # clear out the sendq
             self.sendq = []
             # print "Got response code: %s" % response.getcode()
@@ -789,6 +1141,10 @@ class SenderThread(threading.Thread):
             LOG.error("Got error %s", e)
             # for line in http_error:
             #   print line,
+        except urllib2.URLError, e:
+            # keep the sendq for the next TSD
+            LOG.error("Failed to send to %s:%d: %s", self.host, self.port, e)
+            self.blacklist_connection()
 
 
 def setup_logging(logfile=DEFAULT_LOG, max_bytes=None, backup_count=None):
@@ -821,6 +1177,7 @@ def parse_cmdline(argv):
             'no_tcollector_stats': False,
             'evictinterval': 6000,
             'dedupinterval': 300,
+            'dedup_max_entries': 200000,
             'allowed_inactivity_time': 600,
             'dryrun': False,
             'maxtags': 8,
@@ -838,8 +1195,12 @@ def parse_cmdline(argv):
             'logfile': '/var/log/tcollector.log',
             'cdir': default_cdir,
             'ssl': False,
+            'compression': 'none',
+            'compression_level': 6,
+            'compression_min_size': 1024,
             'stdin': False,
             'daemonize': False,
+            'host_collectors': False,
             'hosts': False
         }
     except:
@@ -899,6 +1260,13 @@ def parse_cmdline(argv):
                         help='Number of seconds after which to remove cached '
                            'values of old data points to save memory. '
                            'default=%default')
+    parser.add_option('--dedup-max-entries', dest='dedup_max_entries', type='int',
+                        default=defaults.get('dedup_max_entries', 200000),
+                        metavar='DEDUPMAXENTRIES',
+                        help='Maximum number of metric and tags combinations '
+                           'to remember for dedup, the least recently seen '
+                           'are forgotten first.  Use zero for no limit. '
+                           'default=%default')
     parser.add_option('--allowed-inactivity-time', dest='allowed_inactivity_time', type='int',
                         default=ALLOWED_INACTIVITY_TIME, metavar='ALLOWEDINACTIVITYTIME',
                             help='How long to wait for datapoints before assuming '
@@ -930,6 +1298,20 @@ def parse_cmdline(argv):
                       help='Password to use for HTTP Basic Auth when sending the data via HTTP')
     parser.add_option('--ssl', dest='ssl', action='store_true', default=defaults['ssl'],
                       help='Enable SSL - used in conjunction with http')
+    parser.add_option('--compression', dest='compression', type='choice',
+                      choices=common_utils.COMPRESSION_METHODS, default=defaults['compression'],
+                      help='Compress HTTP request bodies with gzip or deflate. default=%default')
+    parser.add_option('--compression-level', dest='compression_level', type='int',
+                      default=defaults['compression_level'],
+                      help='zlib compression level, 1 (fastest) to 9 (smallest). default=%default')
+    parser.add_option('--compression-min-size', dest='compression_min_size', type='int',
+                      default=defaults['compression_min_size'],
+                      help='Request bodies smaller than this many bytes are sent '
+                           'uncompressed. default=%default')
+    parser.add_option('--host-collectors', dest='host_collectors', action='store_true',
+                      default=defaults.get('host_collectors', False),
+                      help='Import interval Python collectors once into a host process '
+                           'and fork it for each run, instead of starting the script.')
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
         parser.error('--dedup-interval must be at least 0 seconds')
@@ -938,6 +1320,10 @@ def parse_cmdline(argv):
                      '--dedup-interval')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    if not 1 <= options.compression_level <= 9:
+        parser.error('--compression-level must be between 1 and 9')
+    if options.dedup_max_entries < 0:
+        parser.error('--dedup-max-entries must be at least 0')
     # We cannot write to stdout when we're a daemon.
     if (options.daemonize or options.max_bytes) and not options.backup_count:
         options.backup_count = 1
@@ -1024,6 +1410,8 @@ def main(argv):
     modules = load_etc_dir(options, tags)
 
     setup_python_path(options.cdir)
+    global HOST_COLLECTORS
+    HOST_COLLECTORS = options.host_collectors
 
     # gracefully handle death for normal termination paths and abnormal
     atexit.register(shutdown)
@@ -1032,7 +1420,8 @@ def main(argv):
 
     # at this point we're ready to start processing, so start the ReaderThread
     # so we can have it running and pulling in data for us
-    reader = ReaderThread(options.dedupinterval, options.evictinterval)
+    reader = ReaderThread(options.dedupinterval, options.evictinterval,
+                          not options.stdin, options.dedup_max_entries)
     reader.start()
 
     # prepare list of (host, port) of TSDs given on CLI
@@ -1057,7 +1446,9 @@ def main(argv):
     sender = SenderThread(reader, options.dryrun, options.hosts,
                           not options.no_tcollector_stats, tags, options.reconnectinterval,
                           options.http, options.http_username,
-                          options.http_password, options.ssl, options.maxtags)
+                          options.http_password, options.ssl, options.maxtags,
+                          options.compression, options.compression_level,
+                          options.compression_min_size)
     sender.start()
     LOG.info('SenderThread startup complete')
 
@@ -1096,13 +1487,21 @@ def main_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we're not in stdin mode."""
 
     next_heartbeat = int(time.time() + 600)
+    # the collector and etc directories are only rescanned after a change,
+    # or every 15 seconds without inotify
+    watcher = common_utils.DirectoryWatcher()
+    changed = True
     while ALIVE:
-        populate_collectors(options.cdir)
-        reload_changed_config_modules(modules, options, sender, tags)
-        reap_children()
+        if changed:
+            watch_collector_dirs(watcher, options.cdir)
+            populate_collectors(options.cdir)
+            reload_changed_config_modules(modules, options, sender, tags)
+        reap_children(sender.reader.readerq)
+        report_collector_usage(sender.reader.readerq)
         check_children(options)
         spawn_children()
-        time.sleep(15)
+        sender.reader.wakeup()
+        changed = watcher.wait(15)
         now = int(time.time())
         if now >= next_heartbeat:
             LOG.info('Heartbeat (%d collectors running)'
@@ -1110,6 +1509,18 @@ def main_loop(options, modules, sender, tags):
             next_heartbeat = now + 600
 
 
+def watch_collector_dirs(watcher, coldir):
+    """Watches the collector directory, its interval directories and the
+       etc directory for changes."""
+    if not watcher.available:
+        return
+    watcher.watch(coldir)
+    watcher.watch(os.path.join(coldir, 'etc'))
+    for interval in os.listdir(coldir):
+        if interval.isdigit():
+            watcher.watch(os.path.join(coldir, interval))
+
+
 def list_config_modules(etcdir):
     """Returns an iterator that yields the name of all the config modules."""
     if not os.path.isdir(etcdir):
@@ -1274,18 +1685,23 @@ def shutdown():
     sys.exit(1)
 
 
-def reap_children():
+def reap_children(readerq=None):
     """When a child process dies, we have to determine why it died and whether
-       or not we need to restart it.  This method manages that logic."""
+       or not we need to restart it.  This method manages that logic.  With a
+       readerq, the resources the child used are reported to it."""
 
     for col in all_living_collectors():
         now = int(time.time())
         # FIXME: this is not robust.  the asyncproc module joins on the
         # reader threads when you wait if that process has died.  this can cause
         # slow dying processes to hold up the main loop.  good for now though.
-        status = col.proc.poll()
+        status, rusage = poll_collector(col.proc)
         if status is None:
             continue
+        if readerq is not None and rusage is not None:
+            # what the reader didn't get to yet counts for the last run
+            col.read()
+            report_usage(readerq, col, rusage.ru_utime + rusage.ru_stime)
         col.proc = None
 
         # behavior based on status.  a code 0 is normal termination, code 13
@@ -1304,6 +1720,69 @@ def reap_children():
             register_collector(Collector(col.name, col.interval, col.filename,
                                          col.mtime, col.lastspawn))
 
+
+def poll_collector(proc):
+    """Like proc.poll(), but also returns the resource usage of the process
+       (and of the children it waited for) once it has exited, None before
+       that or if it was reaped elsewhere."""
+    if proc.returncode is not None:
+        return proc.returncode, None
+    try:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    except OSError, e:
+        if e.errno != errno.ECHILD:
+            raise
+        return proc.poll(), None
+    if pid != proc.pid:
+        return None, None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, rusage
+
+
+def process_cpu_time(pid):
+    """CPU seconds used by a process and the children it waited for, None
+       if that can't be read from /proc."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # the fields after the command, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, IndexError):
+        return None
+    # utime, stime, cutime and cstime are fields 14 to 17
+    return sum(int(field) for field in fields[11:15]) / float(CLOCK_TICKS)
+
+
+def report_usage(readerq, col, cpu):
+    """Queues the collector.self.* metrics of a collector process: its wall
+       and CPU time, and the lines and bytes it wrote, since the previous
+       report, as runner.py reports them for every run.  cpu is the CPU
+       seconds the process used so far."""
+    now = time.time()
+    lines = col.lines_read()
+    last, last_cpu, last_lines, last_bytes = col.reported or (col.started or now, 0.0, 0, 0)
+    col.reported = (now, cpu, lines, col.bytes_received)
+    tags = ' collector=%s' % col.name
+    for metric, value in (('collector.self.wall_ms', (now - last) * 1000),
+                          ('collector.self.cpu_ms', (cpu - last_cpu) * 1000),
+                          ('collector.self.lines', lines - last_lines),
+                          ('collector.self.bytes', col.bytes_received - last_bytes)):
+        readerq.nput(DataPoint(metric, int(now), str(int(value)), tags))
+
+
+def report_collector_usage(readerq):
+    """Reports the usage of the collector processes which run for long, the
+       others are reported when they get reaped."""
+    for col in all_living_collectors():
+        if col.interval and not col.hosted:
+            continue
+        cpu = process_cpu_time(col.proc.pid)
+        if cpu is not None:
+            report_usage(readerq, col, cpu)
+
+
 def check_children(options):
     """When a child process hasn't received a datapoint in a while,
        assume it's died in some fashion and restart it."""
@@ -1330,6 +1809,10 @@ def set_nonblocking(fd):
 def spawn_collector(col):
     """Takes a Collector object and creates a process for it."""
 
+    if col.hosted:
+        run_hosted_collector(col)
+        return
+
     LOG.info('%s (interval=%d) needs to be spawned', col.name, col.interval)
 
     # FIXME: do custom integration of Python scripts into memory/threads
@@ -1346,7 +1829,8 @@ def spawn_collector(col):
     # The following line needs to move below this line because it is used in
     # other logic and it makes no sense to update the last spawn time if the
     # collector didn't actually start.
-    col.lastspawn = int(time.time())
+    col.spawned()
+    col.lastspawn = int(col.started)
     # Without setting last_datapoint here, a long running check (>15s) will be 
     # killed by check_children() the first time check_children is called.
     col.last_datapoint = col.lastspawn
@@ -1360,6 +1844,39 @@ def spawn_collector(col):
     LOG.error('failed to spawn collector: %s', col.filename)
 
 
+def run_hosted_collector(col):
+    """Asks the collector_host.py of a collector for a run, starting the host
+       first if there is none.  The host has imported the script once and
+       forks a child for each run, which writes to the host's stdout."""
+
+    if col.proc is None:
+        LOG.info('%s (interval=%d) needs a host', col.name, col.interval)
+        try:
+            col.proc = subprocess.Popen([sys.executable, COLLECTOR_HOST, col.filename],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        close_fds=True,
+                                        preexec_fn=os.setsid)
+        except OSError, e:
+            LOG.error('Failed to start host for collector %s: %s' % (col.filename, e))
+            return
+        set_nonblocking(col.proc.stdout.fileno())
+        set_nonblocking(col.proc.stderr.fileno())
+        col.dead = False
+        col.spawned()
+        LOG.info('started host for %s (pid=%d)', col.name, col.proc.pid)
+    try:
+        col.proc.stdin.write('run\n')
+        col.proc.stdin.flush()
+    except IOError, e:
+        # the host is gone, reap_children() deals with it
+        LOG.warning('host of collector %s went away: %s', col.name, e)
+        return
+    col.lastspawn = int(time.time())
+    col.last_datapoint = col.lastspawn
+
+
 def spawn_children():
     """Iterates over our defined collectors and performs the logic to
        determine if we need to spawn, kill, or otherwise take some
@@ -1374,7 +1891,8 @@ def spawn_children():
             if col.proc is None:
                 spawn_collector(col)
         elif col.interval <= now - col.lastspawn:
-            if col.proc is None:
+            # a host deals with overstaying runs itself
+            if col.proc is None or col.hosted:
                 spawn_collector(col)
                 continue
 
@@ -1452,7 +1970,8 @@ def populate_collectors(coldir):
                     if col.mtime < mtime:
                         LOG.info('%s has been updated on disk', col.name)
                         col.mtime = mtime
-                        if not col.interval:
+                        # a hosted collector has to be imported again
+                        if not col.interval or col.hosted:
                             col.shutdown()
                             LOG.info('Respawning %s', col.name)
                             register_collector(Collector(colname, interval,
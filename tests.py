@@ -12,13 +12,32 @@
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 
+import BaseHTTPServer
+import errno
+import json
+import logging
 import os
+import shutil
+import socket
+import SocketServer
+import struct
+import subprocess
 import sys
-from stat import S_ISDIR, S_ISREG, ST_MODE
+import tempfile
+import threading
+import time
+from stat import S_ISDIR, S_ISREG, S_ISSOCK, ST_MODE
 import unittest
+import zlib
 
 import mocks
+import runner
 import tcollector
+from benchmarks import fixtures
+from collectors.lib import collectorbase
+from collectors.lib import procfs
+from collectors.lib import rates
+from collectors.lib import sock_diag
 
 
 class CollectorsTests(unittest.TestCase):
@@ -85,6 +104,25 @@ class TSDBlacklistingTests(unittest.TestCase):
         sender.pick_connection()
         self.assertEqual(tsd1, (sender.host, sender.port))
 
+    def test_blacklistedConnectionIsProbedLater(self):
+        tsd1 = ("localhost", 4242)
+        tsd2 = ("localhost", 4243)
+        sender = self.mkSenderThread([tsd1, tsd2])
+        sender.pick_connection()
+        sender.blacklist_connection()
+        sender.pick_connection()
+        self.assertEqual(tsd2, (sender.host, sender.port))
+        sender.pick_connection()
+        self.assertEqual(tsd2, (sender.host, sender.port))
+        sender.blacklisted_hosts[tsd1] = (time.time() - 1, tcollector.TSD_PROBE_INTERVAL)
+        sender.pick_connection()
+        self.assertEqual(tsd1, (sender.host, sender.port))
+        sender.blacklist_connection()
+        self.assertEqual(2 * tcollector.TSD_PROBE_INTERVAL, sender.blacklisted_hosts[tsd1][1])
+        sender.pick_connection()
+        sender.whitelist_connection()
+        self.assertEqual({tsd1: sender.blacklisted_hosts[tsd1]}, sender.blacklisted_hosts)
+
     def test_doublePickOneConnection(self):
         tsd = ("localhost", 4242)
         sender = self.mkSenderThread([tsd])
@@ -104,6 +142,1529 @@ class TSDBlacklistingTests(unittest.TestCase):
         sender.pick_connection()
         self.assertEqual(tsd1, (sender.host, sender.port))
 
+HOSTED_COLLECTOR = '''import os
+import time
+
+RUNS = 0
+with open(os.path.join(os.path.dirname(__file__), 'imports'), 'a') as f:
+    f.write('.')
+
+
+def main():
+    global RUNS
+    RUNS += 1
+    print 'hosted.run %d %d runs=%d' % (time.time(), os.getpid(), RUNS)
+
+
+if __name__ == '__main__':
+    main()
+'''
+
+
+class ReaderThreadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_collectors = tcollector.COLLECTORS
+        tcollector.COLLECTORS = {}
+
+    def tearDown(self):
+        for col in tcollector.all_living_collectors():
+            col.proc.wait()
+        tcollector.COLLECTORS = self.saved_collectors
+
+    def spawn(self, name, script):
+        col = tcollector.Collector(name, 0, '/bin/sh')
+        col.proc = subprocess.Popen(['/bin/sh', '-c', script],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        tcollector.set_nonblocking(col.proc.stdout.fileno())
+        tcollector.set_nonblocking(col.proc.stderr.fileno())
+        tcollector.register_collector(col)
+        return col
+
+    def hosted(self, script):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'hosted.py')
+        with open(filename, 'w') as f:
+            f.write(script)
+        self.imports = os.path.join(directory, 'imports')
+        saved = tcollector.HOST_COLLECTORS
+        tcollector.HOST_COLLECTORS = True
+        try:
+            col = tcollector.Collector('hosted.py', 30, filename)
+        finally:
+            tcollector.HOST_COLLECTORS = saved
+        self.addCleanup(col.shutdown)
+        return col
+
+    def lines(self, col, count):
+        lines = []
+        deadline = time.time() + 5
+        while len(lines) < count and time.time() < deadline:
+            lines.extend(col.collect())
+            time.sleep(0.01)
+        return lines
+
+    def test_hostedCollectorIsImportedOnce(self):
+        col = self.hosted(HOSTED_COLLECTOR)
+        self.assertTrue(col.hosted)
+        tcollector.spawn_collector(col)
+        first = self.lines(col, 1)
+        tcollector.spawn_collector(col)
+        second = self.lines(col, 1)
+        self.assertEqual(1, len(first))
+        self.assertEqual(1, len(second))
+        # a fresh child per run, which starts from the imported state
+        self.assertNotEqual(first[0].split()[2], second[0].split()[2])
+        self.assertTrue(first[0].endswith('runs=1') and second[0].endswith('runs=1'))
+        with open(self.imports) as f:
+            self.assertEqual(1, len(f.read()))
+
+    def test_failingHostedRunEndsHost(self):
+        col = self.hosted(HOSTED_COLLECTOR.replace('RUNS += 1', 'raise ValueError'))
+        tcollector.spawn_collector(col)
+        col.proc.wait()
+        self.assertEqual(1, col.proc.returncode)
+        col.proc = None
+
+    def test_onlyScriptsWithMainAreHosted(self):
+        col = self.hosted('print "foo.bar 1 1"\n')
+        self.assertFalse(col.hosted)
+        col = tcollector.Collector('hosted.py', 0, col.filename)
+        self.assertFalse(col.hosted)
+
+    def usage(self, readerq):
+        usage = {}
+        while not readerq.empty():
+            datapoint = readerq.get(False)
+            self.assertEqual(' collector=foo', datapoint.raw_tags)
+            usage[datapoint.metric] = int(datapoint.value)
+        return usage
+
+    def test_reapReportsUsage(self):
+        col = self.spawn('foo', 'echo "foo.bar 1400000000 1"; echo "foo.bar 1400000000 2"')
+        col.spawned()
+        readerq = tcollector.ReaderQueue(100)
+        deadline = time.time() + 5
+        # nothing reads the pipe before the collector is reaped
+        while col.proc is not None and time.time() < deadline:
+            tcollector.reap_children(readerq)
+            time.sleep(0.01)
+        usage = self.usage(readerq)
+        self.assertEqual(2 * len('foo.bar 1400000000 1\n'), usage['collector.self.bytes'])
+        self.assertEqual(2, usage['collector.self.lines'])
+        self.assertTrue(usage['collector.self.wall_ms'] >= 0)
+        self.assertTrue('collector.self.cpu_ms' in usage)
+
+    def test_longRunningUsageIsReportedAsDeltas(self):
+        col = tcollector.Collector('foo', 0, '/bin/sh')
+        col.spawned()
+        readerq = tcollector.ReaderQueue(100)
+        col.lines_received, col.bytes_received = 2, 40
+        tcollector.report_usage(readerq, col, 1.0)
+        usage = self.usage(readerq)
+        self.assertEqual((2, 40, 1000), (usage['collector.self.lines'], usage['collector.self.bytes'],
+                                         usage['collector.self.cpu_ms']))
+        col.lines_received, col.bytes_received = 5, 100
+        tcollector.report_usage(readerq, col, 1.5)
+        usage = self.usage(readerq)
+        self.assertEqual((3, 60, 500), (usage['collector.self.lines'], usage['collector.self.bytes'],
+                                        usage['collector.self.cpu_ms']))
+
+    def test_processCpuTime(self):
+        self.assertTrue(tcollector.process_cpu_time(os.getpid()) > 0)
+        self.assertEqual(None, tcollector.process_cpu_time(2 ** 22 + 1))
+
+    def test_epollPicksUpNewCollectors(self):
+        reader = tcollector.ReaderThread(0, 10)
+        if reader.poller is None:
+            self.skipTest('epoll is not available')
+        reader.wait_for_collectors(0)
+        col = self.spawn('foo', 'echo "foo.bar %d 1"' % time.time())
+        deadline = time.time() + 5
+        while reader.readerq.empty() and time.time() < deadline:
+            reader.wait_for_collectors(1)
+        self.assertEqual('foo.bar', reader.readerq.get(False).metric)
+        self.assertEqual(1, col.lines_sent)
+
+        # once the collector exits its pipes hang up and stop being polled
+        col.proc.wait()
+        reader.wait_for_collectors(0)
+        self.assertEqual(set(reader.registered), reader.hungup)
+        col.proc = None
+        reader.wait_for_collectors(0)
+        self.assertEqual({}, reader.registered)
+
+    def test_lineFramerKeepsPartialLines(self):
+        framer = tcollector.LineFramer()
+        self.assertEqual([], framer.feed('foo.bar 1 '))
+        self.assertEqual(['foo.bar 1 1', 'foo.baz 1 2'],
+                         framer.feed('1\n\n  foo.baz 1 2 \nfoo'))
+        self.assertEqual(3, len(framer))
+        self.assertEqual(['foo.qux 1 3'], framer.feed('.qux 1 3\n'))
+        self.assertEqual(0, len(framer))
+
+    def test_processLineQueuesDataPoints(self):
+        reader = tcollector.ReaderThread(300, 600, use_epoll=False)
+        col = tcollector.Collector('foo', 0, 'foo')
+        for line in ('foo.bar 1400000000 1 a=b c=d',
+                     'foo.bar 1400000010 1 a=b c=d',  # held back, replayed below
+                     'foo.bar 1400000020 2 a=b c=d',
+                     'foo.bar 1400000030 1.5',
+                     'foo.bar 14000.00030 1',
+                     'foo.bar not a datapoint'):
+            reader.process_line(col, line)
+        queued = []
+        while not reader.readerq.empty():
+            queued.append(reader.readerq.get(False))
+        self.assertEqual(['foo.bar 1400000000 1 a=b c=d',
+                          'foo.bar 1400000010 1 a=b c=d',
+                          'foo.bar 1400000020 2 a=b c=d',
+                          'foo.bar 1400000030 1.5'],
+                         [str(dp) for dp in queued])
+        self.assertEqual((('a', 'b'), ('c', 'd')), queued[0].tags)
+        self.assertEqual((), queued[3].tags)
+        self.assertEqual(2, col.lines_invalid)
+
+    def test_respawnedCollectorStartsWithoutDedupState(self):
+        reader = tcollector.ReaderThread(300, 600, use_epoll=False)
+        reader.process_line(tcollector.Collector('foo', 0, 'foo'), 'foo.bar 1400000010 1')
+        # the replacement's clock went back a little, and its value is held
+        # back only from the next point on
+        col = tcollector.Collector('foo', 0, 'foo')
+        for line in ('foo.bar 1400000005 1', 'foo.bar 1400000015 1'):
+            reader.process_line(col, line)
+        queued = []
+        while not reader.readerq.empty():
+            queued.append(str(reader.readerq.get(False)))
+        self.assertEqual(['foo.bar 1400000010 1', 'foo.bar 1400000005 1'], queued)
+        self.assertEqual(0, col.lines_invalid)
+
+    def test_senderAppendsMissingTags(self):
+        sender = tcollector.SenderThread(None, True, [('localhost', 4242)], False,
+                                         {'host': 'foo', 'a': 'x'})
+        dp = tcollector.DataPoint('foo.bar', 1400000000, '1', ' a=b')
+        self.assertEqual('foo.bar 1400000000 1 a=b host=foo',
+                         sender.format_datapoint(dp))
+
+    def test_readLatencyHistogram(self):
+        histogram = tcollector.ReadLatencyHistogram()
+        for latency in (0.05, 0.3, 0.3, 42):
+            histogram.observe(latency)
+        stats = dict((tags, value) for name, tags, value in histogram.stats()
+                     if name == 'reader.read_latency')
+        self.assertEqual(1, stats['le=0.1'])
+        self.assertEqual(3, stats['le=0.5'])
+        self.assertEqual(3, stats['le=10'])
+        self.assertEqual(4, stats['le=inf'])
+
+
+class DedupCacheTests(unittest.TestCase):
+
+    def test_evictsOldEntriesIncrementally(self):
+        cache = tcollector.DedupCache(160)  # 10 seconds buckets
+        for i in xrange(5):
+            cache.put(('col', 'old', ' i=%d' % i), '1', 100, 100, 1000)
+        cache.put(('col', 'new', ''), '1', 100, 100, 1100)
+        # seen again later, which leaves a stale filing in the first bucket
+        cache.put(('col', 'old', ' i=0'), '1', 200, 100, 1100)
+        # the stale filing of i=0 comes first and counts against the budget
+        cache.evict(1200, 2)
+        self.assertEqual(5, len(cache))
+        cache.evict(1200, 100)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(4, cache.evicted)
+        self.assertEqual(('1', 200, 100), cache.get(('col', 'old', ' i=0'))[:3])
+
+    def test_maxEntriesDropsLeastRecentlySeen(self):
+        cache = tcollector.DedupCache(160, max_entries=2)
+        cache.put(('col', 'a', ''), '1', 100, 100, 1000)
+        cache.put(('col', 'b', ''), '1', 100, 100, 1010)
+        cache.put(('col', 'a', ''), '1', 110, 100, 1020)
+        cache.put(('col', 'c', ''), '1', 100, 100, 1030)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get(('col', 'b', '')))
+        self.assertEqual(1, cache.overflowed)
+
+    def test_maxEntriesWithinOneBucket(self):
+        cache = tcollector.DedupCache(160, max_entries=3)
+        for i in xrange(10):
+            cache.put(('col', 'm%d' % i, ''), '1', 100, 100, 1000 + i % 5)
+        self.assertEqual(3, len(cache))
+        self.assertEqual(7, cache.overflowed)
+        # the oldest keys went first, the ones just put are kept
+        for i in xrange(7, 10):
+            self.assertNotEqual(None, cache.get(('col', 'm%d' % i, '')))
+
+    def test_keysAreInterned(self):
+        cache = tcollector.DedupCache(160)
+        cache.put(('col', ''.join(['foo', '.bar']), ''), '1', 100, 100, 1000)
+        key, = cache.entries.keys()
+        self.assertTrue(key[1] is intern('foo.bar'))
+
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive handler that records the bodies it was sent."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        self.server.requests.append((self.path, self.headers, body))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # keep-alive connections left open by a test don't hold up shutdown()
+    daemon_threads = True
+
+
+class LocalTsdTestCase(unittest.TestCase):
+    """Runs a RecordingHandler server on a free local port."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TsdConnectionTests(LocalTsdTestCase):
+
+    def test_connectionIsReused(self):
+        conn = runner.TsdConnection('127.0.0.1', self.port)
+        for i in xrange(3):
+            status, _, _ = conn.post('/api/put?details', '[%d]' % i,
+                                     {'Content-Type': 'application/json'})
+            self.assertEqual(204, status)
+        conn.close()
+        self.assertEqual(1, conn.connects)
+        self.assertEqual(2, conn.reused)
+        self.assertEqual(['[0]', '[1]', '[2]'], [r[2] for r in self.server.requests])
+
+    def stale_connection(self):
+        """Returns a connection whose socket was swapped for one end of a
+           socket pair, and the other end."""
+        conn = runner.TsdConnection('127.0.0.1', self.port)
+        conn.post('/api/put', '[]', {})
+        ours, theirs = socket.socketpair()
+        conn.conn.sock.close()
+        conn.conn.sock = ours
+        return conn, theirs
+
+    def test_reconnectsAfterServerClose(self):
+        conn, peer = self.stale_connection()
+        # the server dropped the idle connection
+        peer.close()
+        status, _, _ = conn.post('/api/put', '[1]', {})
+        self.assertEqual(204, status)
+        self.assertEqual(2, conn.connects)
+        self.assertEqual(['[]', '[1]'], [r[2] for r in self.server.requests])
+
+    def test_reconnectsAfterCloseWithoutResponse(self):
+        conn, peer = self.stale_connection()
+        peer.shutdown(socket.SHUT_WR)
+        status, _, _ = conn.post('/api/put', '[1]', {})
+        peer.close()
+        self.assertEqual(204, status)
+        self.assertEqual(2, conn.connects)
+
+    def test_timeoutIsNotRetried(self):
+        conn = runner.TsdConnection('127.0.0.1', self.port)
+        conn.post('/api/put', '[]', {})
+        # a TSD which takes requests and never answers
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        conn.conn.sock.close()
+        conn.conn.sock = socket.create_connection(silent.getsockname(), 0.1)
+        try:
+            # the request went out, the TSD may store it
+            self.assertRaises(runner.urllib2.URLError, conn.post, '/api/put', '[1]', {})
+        finally:
+            silent.close()
+        self.assertEqual(1, conn.connects)
+        self.assertEqual(['[]'], [r[2] for r in self.server.requests])
+
+    def test_connectFailureRaisesURLError(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()  # nobody listens on that port now
+        conn = runner.TsdConnection('127.0.0.1', port)
+        self.assertRaises(runner.urllib2.URLError, conn.post, '/api/put', '[]', {})
+
+
+class TsdPoolTests(LocalTsdTestCase):
+
+    def test_picksLeastLoaded(self):
+        a, b = ('a', 1), ('b', 1)
+        pool = runner.TsdPool([a, b])
+        # no latency known yet, concurrent requests are spread by their count
+        self.assertEqual([a, b, a, b], [pool.acquire() for _ in xrange(4)])
+        for hostport, latency in ((a, 0.1), (b, 0.25), (a, 0.1), (b, 0.25)):
+            pool.release(hostport, latency)
+        self.assertEqual(a, pool.acquire())
+        self.assertEqual(a, pool.acquire())  # 0.1 * 2 < 0.25
+        self.assertEqual(b, pool.acquire())  # 0.1 * 3 > 0.25
+
+    def test_failedHostIsProbedLater(self):
+        a, b = ('a', 1), ('b', 1)
+        pool = runner.TsdPool([a, b])
+        pool.release(pool.acquire())  # a failed
+        self.assertEqual(b, pool.acquire())
+        self.assertEqual(b, pool.acquire())
+        pool.probe_at[a] = time.time() - 1  # probe is due
+        self.assertEqual(a, pool.acquire())
+        self.assertEqual(b, pool.acquire())  # only one probe at a time
+        pool.release(a, 0.1)
+        self.assertFalse(a in pool.probe_at)
+
+    def test_allFailedUsesFirstDueProbe(self):
+        a, b = ('a', 1), ('b', 1)
+        pool = runner.TsdPool([a, b])
+        pool.release(pool.acquire())
+        pool.release(pool.acquire())
+        self.assertEqual(a, pool.acquire())
+        pool.release(a)
+        self.assertEqual(2 * runner.TSD_PROBE_INTERVAL, pool.probe_interval[a])
+
+    def test_senderFailsOverToHealthyTsd(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = ('127.0.0.1', sock.getsockname()[1])
+        sock.close()
+        options, _ = runner.parse_cmdline(['runner.py', '--spool-dir', ''])
+        options.hosts = [dead, ('127.0.0.1', self.port)]
+        sender = runner.Sender('token', None, options, {})
+        sender.pool.hosts = [dead, ('127.0.0.1', self.port)]
+        sender.send_data_via_http([{'metric': 'foo', 'timestamp': 1, 'value': 1, 'tags': {}}])
+        self.assertEqual(1, len(self.server.requests))
+        self.assertTrue(dead in sender.pool.probe_at)
+
+
+class SenderPipelineTests(LocalTsdTestCase):
+
+    def test_builderFeedsTransmitThreads(self):
+        options, _ = runner.parse_cmdline(['runner.py', '--spool-dir', '', '--max-inflight', '2'])
+        options.hosts = [('127.0.0.1', self.port)]
+        readq = runner.NonBlockingQueue(100)
+        for i in xrange(10):
+            readq.nput('foo.bar %d %d host=a' % (1500000000 + i, i))
+        sender = runner.Sender('token', readq, options, {})
+        sender.daemon = True
+        sender.start()
+        try:
+            deadline = time.time() + 5
+            while not self.server.requests and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            sender.shutdown()
+        self.assertEqual(1, len(self.server.requests))
+        metrics = json.loads(self.server.requests[0][2])['metrics']
+        self.assertEqual(range(10), [m['value'] for m in metrics])
+
+    def test_enqueueBlocksWhileBufferIsFull(self):
+        options, _ = runner.parse_cmdline(['runner.py', '--spool-dir', '', '--send-buffer', '1'])
+        options.hosts = [('127.0.0.1', self.port)]
+        sender = runner.Sender('token', None, options, {})
+        sender.enqueue([], ('', {}))
+        self.assertEqual(1, sender.batches.qsize())
+        threading.Timer(0.2, sender.batches.get).start()
+        sender.enqueue([], ('', {}))
+        self.assertTrue(sender.blocked_time >= 0.1)
+
+
+class BatchEmitTests(unittest.TestCase):
+
+    def test_queueCountsLinesOfBatches(self):
+        readq = runner.NonBlockingQueue(5)
+        dropped = runner.NonBlockingQueue.dropped
+        self.assertTrue(readq.nput('a 1 1'))
+        self.assertTrue(readq.nput_batch(['b 1 1', 'c 1 1']))
+        self.assertEqual(3, readq.qsize())
+        self.assertFalse(readq.nput_batch(['d 1 1', 'e 1 1', 'f 1 1']))
+        self.assertEqual(5, readq.qsize())
+        self.assertTrue(readq.full())
+        self.assertFalse(readq.nput('g 1 1'))
+        self.assertEqual(dropped + 2, runner.NonBlockingQueue.dropped)
+        self.assertEqual('a 1 1', readq.get(False))
+        self.assertEqual(['b 1 1', 'c 1 1'], readq.get(False))
+        self.assertEqual(['d 1 1', 'e 1 1'], readq.get(False))
+        self.assertEqual(0, readq.qsize())
+
+    def test_collectorLinesAreFlushedAsOneBatch(self):
+        readq = runner.NonBlockingQueue(100)
+        collector = collectorbase.CollectorBase(None, None, readq)
+        for i in xrange(3):
+            collector._readq.nput('foo %d %d' % (1500000000, i))
+        self.assertEqual(0, readq.qsize())
+        collector.flush()
+        self.assertEqual(['foo 1500000000 0', 'foo 1500000000 1', 'foo 1500000000 2'], readq.get(False))
+
+    def test_longRunsAreFlushedEveryMaxLines(self):
+        readq = runner.NonBlockingQueue(100)
+        batchq = collectorbase.BatchQueue(readq, max_lines=2)
+        for i in xrange(5):
+            batchq.nput('foo 1 %d' % i)
+        self.assertEqual(4, readq.qsize())
+        batchq.flush()
+        self.assertEqual(3, len(readq.queue))
+
+    def test_nputReportsLinesDroppedByFlush(self):
+        readq = runner.NonBlockingQueue(3)
+        batchq = collectorbase.BatchQueue(readq, max_lines=2)
+        self.assertTrue(batchq.nput('foo 1 0'))
+        self.assertTrue(batchq.nput('foo 1 1'))
+        self.assertTrue(batchq.nput('foo 1 2'))
+        # the second batch only half fits
+        self.assertFalse(batchq.nput('foo 1 3'))
+        self.assertTrue(batchq.nput('foo 1 4'))
+        self.assertFalse(batchq.flush())
+        self.assertTrue(batchq.flush())
+
+    def test_concurrentEmittersLoseNoLines(self):
+        readq = runner.NonBlockingQueue(100000)
+        batchq = collectorbase.BatchQueue(readq, max_lines=3)
+        errors = []
+
+        def emit(n):
+            try:
+                for i in xrange(2000):
+                    batchq.nput('foo 1 %d n=%d' % (i, n))
+                    batchq.flush()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=emit, args=(n,)) for n in xrange(8)]
+        # switch threads as often as possible
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(check_interval)
+        batchq.flush()
+        self.assertEqual([], errors)
+        lines = []
+        while not readq.empty():
+            item = readq.get(False)
+            lines.extend(item if isinstance(item, list) else [item])
+        self.assertEqual(16000, len(set(lines)))
+        self.assertEqual(16000, batchq.lines_emitted)
+
+    def test_flushesStaleLinesOnly(self):
+        readq = runner.NonBlockingQueue(100)
+        batchq = collectorbase.BatchQueue(readq, max_delay=5)
+        batchq.nput('foo 1 1')
+        batchq.flush_stale(batchq.oldest + 4)
+        self.assertEqual(0, readq.qsize())
+        batchq.flush_stale(batchq.oldest + 5)
+        self.assertEqual(['foo 1 1'], readq.get(False))
+
+    def test_senderTakesBatches(self):
+        options, _ = runner.parse_cmdline(['runner.py', '--spool-dir', ''])
+        options.hosts = [('localhost', 4242)]
+        sender = runner.Sender('token', None, options, {})
+        metrics = []
+        self.assertEqual(18, sender.add_lines(['foo 1 1 x=y', 'bar 1 2'], metrics))
+        self.assertEqual(['foo', 'bar'], [m['metric'] for m in metrics])
+
+
+class CountingCollector(collectorbase.CollectorBase):
+
+    def __init__(self, readq, duration=0):
+        super(CountingCollector, self).__init__(None, None, readq)
+        self.duration = duration
+        self.runs = 0
+        self.active = 0
+        self.overlapped = False
+        self.cleaned_up = False
+
+    def __call__(self):
+        self.active += 1
+        self.overlapped |= self.active > 1
+        self.runs += 1
+        time.sleep(self.duration)
+        self._readq.nput('counting.runs %d %d' % (1500000000, self.runs))
+        self.active -= 1
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.readq = runner.NonBlockingQueue(1000)
+        self.scheduler = runner.Scheduler(self.readq, 2)
+        self.scheduler.start()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_runsCollectorsOnInterval(self):
+        collector = CountingCollector(self.readq)
+        collector_exec = runner.CollectorExec('counting', collector, 0.05, self.scheduler)
+        self.wait_for(lambda: collector.runs >= 3)
+        collector_exec.shutdown()
+        self.assertTrue(collector.runs >= 3)
+        self.assertTrue(collector.cleaned_up)
+        lines = []
+        while not self.readq.empty():
+            item = self.readq.get(False)
+            lines.extend(item if isinstance(item, list) else [item])
+        self.assertTrue('counting.runs 1500000000 1' in lines)
+        self.assertTrue([l for l in lines if l.startswith('collector.schedule.lateness_ms ')
+                         and l.endswith(' collector=counting')])
+
+    def test_slowCollectorNeverOverlaps(self):
+        collector = CountingCollector(self.readq, duration=0.1)
+        collector_exec = runner.CollectorExec('slow', collector, 0.01, self.scheduler)
+        self.wait_for(lambda: collector.runs >= 3)
+        collector_exec.signal_shutdown()
+        collector_exec.wait_shutdown()
+        self.assertFalse(collector.overlapped)
+        self.assertTrue(collector.cleaned_up)
+
+    def test_accountsEachRun(self):
+        collector = CountingCollector(self.readq)
+        collector_exec = runner.CollectorExec('counting', collector, 60, self.scheduler)
+        self.wait_for(lambda: collector.runs >= 1 and self.readq.qsize() >= 6)
+        collector_exec.shutdown()
+        lines = []
+        while not self.readq.empty():
+            item = self.readq.get(False)
+            lines.extend(item if isinstance(item, list) else [item])
+        accounting = dict((l.split()[0], int(l.split()[2])) for l in lines
+                          if l.startswith('collector.self.') and l.endswith(' collector=counting'))
+        self.assertEqual(1, accounting['collector.self.lines'])
+        self.assertEqual(len('counting.runs 1500000000 1'), accounting['collector.self.bytes'])
+        self.assertTrue('collector.self.cpu_ms' in accounting)
+        self.assertTrue('collector.self.wall_ms' in accounting)
+        # one wall time and one CPU series, no duplicates
+        self.assertEqual(set(['collector.schedule.lateness_ms', 'collector.self.wall_ms', 'collector.self.cpu_ms',
+                              'collector.self.lines', 'collector.self.bytes']),
+                         set(l.split()[0] for l in lines if l.startswith('collector.')))
+
+    def test_flushesLinesOfLongRun(self):
+        watchdog_interval = runner.WATCHDOG_INTERVAL
+        runner.WATCHDOG_INTERVAL = 0.02
+        with self.scheduler.cond:
+            self.scheduler.next_watch = 0
+        release = threading.Event()
+
+        class Long(CountingCollector):
+            def __call__(self):
+                self._readq.nput('long.started 1500000000 1')
+                release.wait(5)
+        collector = Long(self.readq)
+        collector._readq.max_delay = 0.05
+        try:
+            collector_exec = runner.CollectorExec('long', collector, 60, self.scheduler)
+            self.wait_for(lambda: collector._readq.lines_emitted)
+            # handed over while the run still goes on
+            self.assertFalse(release.is_set())
+            self.assertEqual(1, collector._readq.lines_emitted)
+        finally:
+            runner.WATCHDOG_INTERVAL = watchdog_interval
+            release.set()
+        collector_exec.shutdown()
+
+    def test_watchdogRestartsStuckCollector(self):
+        watchdog_interval = runner.WATCHDOG_INTERVAL
+        runner.WATCHDOG_INTERVAL = 0.02
+        with self.scheduler.cond:
+            self.scheduler.next_watch = 0
+        release = threading.Event()
+        instances = []
+
+        class Stuck(CountingCollector):
+            def __call__(self):
+                CountingCollector.__call__(self)
+                if self is instances[0]:
+                    release.wait(5)
+
+        def factory():
+            instances.append(Stuck(self.readq))
+            return instances[-1]
+        try:
+            collector_exec = runner.CollectorExec('stuck', factory(), 0.05, self.scheduler,
+                                                  deadline=0.05, factory=factory)
+            self.wait_for(lambda: len(instances) > 1 and instances[1].runs >= 2)
+            self.assertEqual(1, instances[0].runs)
+            self.assertEqual(1, collector_exec.overruns)
+            self.assertEqual(1, collector_exec.quarantines)
+            self.assertEqual(3, len(self.scheduler.workers))
+            release.set()
+            self.wait_for(lambda: instances[0].cleaned_up)
+            self.assertTrue(instances[0].cleaned_up)
+            # the thread back from the stuck run was replaced, it retires
+            self.wait_for(lambda: len(self.scheduler.workers) == 2)
+            self.assertEqual(2, len(self.scheduler.workers))
+            collector_exec.shutdown()
+        finally:
+            runner.WATCHDOG_INTERVAL = watchdog_interval
+            release.set()
+        lines = []
+        while not self.readq.empty():
+            item = self.readq.get(False)
+            lines.extend(item if isinstance(item, list) else [item])
+        names = set(l.split()[0] for l in lines)
+        self.assertTrue(set(['collector.overrun', 'collector.quarantined', 'collector.self.wall_ms']) <= names)
+
+    def test_collectorAlwaysStuckIsDisabled(self):
+        watchdog_interval = runner.WATCHDOG_INTERVAL
+        runner.WATCHDOG_INTERVAL = 0.02
+        with self.scheduler.cond:
+            self.scheduler.next_watch = 0
+        release = threading.Event()
+
+        class Stuck(CountingCollector):
+            def __call__(self):
+                CountingCollector.__call__(self)
+                release.wait(5)
+
+        try:
+            collector_exec = runner.CollectorExec('stuck', Stuck(self.readq), 0.05, self.scheduler,
+                                                  deadline=0.05, factory=lambda: Stuck(self.readq))
+            self.wait_for(collector_exec._done.is_set)
+            self.assertEqual(runner.MAX_QUARANTINES, collector_exec.quarantines)
+            # two stuck threads were replaced, the third one wasn't
+            self.assertEqual(4, len(self.scheduler.workers))
+            self.assertEqual(3, self.scheduler.stuck)
+            release.set()
+            self.wait_for(lambda: self.scheduler.stuck == 0)
+            self.assertEqual(2, len(self.scheduler.workers))
+            self.assertEqual([], self.scheduler.heap)
+        finally:
+            runner.WATCHDOG_INTERVAL = watchdog_interval
+            release.set()
+
+    def test_hangingRestartDoesNotHoldUpScheduling(self):
+        watchdog_interval = runner.WATCHDOG_INTERVAL
+        runner.WATCHDOG_INTERVAL = 0.02
+        with self.scheduler.cond:
+            self.scheduler.next_watch = 0
+        release = threading.Event()
+
+        class Stuck(CountingCollector):
+            def __call__(self):
+                release.wait(5)
+
+        def factory():
+            release.wait(5)
+            return Stuck(self.readq)
+        try:
+            stuck_exec = runner.CollectorExec('stuck', Stuck(self.readq), 0.05, self.scheduler,
+                                              deadline=0.05, factory=factory)
+            self.wait_for(lambda: stuck_exec.quarantines >= 2)
+            # the restart hung as well, the scheduler kept going
+            counting = CountingCollector(self.readq)
+            counting_exec = runner.CollectorExec('counting', counting, 0.01, self.scheduler)
+            self.wait_for(lambda: counting.runs >= 3)
+            self.assertTrue(counting.runs >= 3)
+            counting_exec.shutdown()
+        finally:
+            runner.WATCHDOG_INTERVAL = watchdog_interval
+            release.set()
+        stuck_exec.shutdown()
+
+    def test_alignedRunsAreDueOnIntervalBoundaries(self):
+        scheduler = runner.Scheduler(self.readq, 1, align=True)
+        self.assertEqual(0, scheduler.first_due(60) % 60)
+        self.assertTrue(scheduler.first_due(60) > time.time())
+        self.assertEqual(1260, scheduler.next_due(60, 1200, 1210))
+        # the run overran two boundaries, skip to the next one
+        self.assertEqual(1380, scheduler.next_due(60, 1200, 1330))
+        self.assertEqual(1330, self.scheduler.next_due(60, 1200, 1330))
+
+    def test_moreCollectorsThanWorkers(self):
+        collectors = [CountingCollector(self.readq) for _ in xrange(5)]
+        execs = [runner.CollectorExec('c%d' % i, c, 0.05, self.scheduler)
+                 for i, c in enumerate(collectors)]
+        self.wait_for(lambda: all(c.runs >= 2 for c in collectors))
+        for collector_exec in execs:
+            collector_exec.shutdown()
+        self.assertTrue(all(c.runs >= 2 and c.cleaned_up for c in collectors))
+        self.assertEqual([], self.scheduler.heap)
+
+
+ISOLATED_COLLECTOR = '''
+import os
+from collectors.lib.collectorbase import CollectorBase
+
+
+class Isolated(CollectorBase):
+    def __call__(self):
+        if os.path.exists(self.get_config('crash_file')):
+            os.remove(self.get_config('crash_file'))
+            os.write(2, 'crashing\\n')
+            os._exit(1)
+        self._logger.info('running in %d', os.getpid())
+        for i in xrange(3):
+            self._readq.nput('isolated.value 1500000000 %d pid=%d' % (i, os.getpid()))
+'''
+
+
+SLOW_COLLECTOR = '''
+import time
+from collectors.lib.collectorbase import CollectorBase
+
+
+class %s(CollectorBase):
+    def __init__(self, config, logger, readq):
+        super(%s, self).__init__(config, logger, readq)
+        time.sleep(float(self.get_config('init_time')))
+
+    def __call__(self):
+        pass
+'''
+
+
+class CollectorInitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.coldir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.coldir, 'builtin'))
+        self.readq = runner.NonBlockingQueue(1000)
+        self.saved_scheduler = runner.SCHEDULER
+        runner.SCHEDULER = runner.Scheduler(self.readq, 1)
+        self.collectors = {}
+
+    def tearDown(self):
+        for name in self.collectors.keys():
+            runner.close_single_collector(self.collectors, name)
+        runner.SCHEDULER = self.saved_scheduler
+        shutil.rmtree(self.coldir)
+
+    def addCollector(self, name, init_time, import_time=0):
+        class_name = name.title()
+        path = os.path.join(self.coldir, 'builtin', name + '.py')
+        with open(path, 'w') as f:
+            f.write(SLOW_COLLECTOR % (class_name, class_name))
+            f.write('time.sleep(%s)\n' % import_time)
+        os.chmod(path, 0755)
+        conf_path = os.path.join(self.coldir, name + '.conf')
+        with open(conf_path, 'w') as f:
+            f.write('[base]\nenabled: True\ninterval: 3600\ncollectorclass: %s\ninit_time: %s\n'
+                    % (class_name, init_time))
+        conf = runner.ConfigParser.SafeConfigParser(runner.default_config())
+        conf.read(conf_path)
+        return name + '.conf', (conf_path, conf, 0)
+
+    def test_initializesConcurrentlyWithTimeout(self):
+        configs = dict([self.addCollector('slowa', 0.5), self.addCollector('slowb', 0.5),
+                        self.addCollector('stuck', 10)])
+        start = time.time()
+        runner.load_collectors(self.coldir, configs, self.collectors, self.readq, 3, 1)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(['slowa', 'slowb'], sorted(self.collectors))
+        self.assertEqual('ok', runner.STARTUP_TIMELINE['slowa'][2])
+        self.assertTrue(runner.STARTUP_TIMELINE['slowa'][1] >= 500)
+        self.assertEqual('timeout', runner.STARTUP_TIMELINE['stuck'][2])
+        lines = []
+        while not self.readq.empty():
+            lines.append(self.readq.get(False))
+        self.assertTrue([l for l in lines if l.startswith('collector.startup.init_ms ')
+                         and l.endswith('collector=stuck status=timeout')])
+        self.assertTrue([l for l in lines if l.startswith('collector.startup.loaded_ms ')])
+
+    def test_reloadIsTimedFromItsStart(self):
+        start_time = runner.START_TIME
+        runner.START_TIME = time.time() - 3600
+        try:
+            runner.load_collectors(self.coldir, dict([self.addCollector('first', 0)]), self.collectors, self.readq)
+            runner.load_collectors(self.coldir, dict([self.addCollector('second', 0)]), self.collectors, self.readq)
+        finally:
+            runner.START_TIME = start_time
+        lines = []
+        while not self.readq.empty():
+            lines.append(self.readq.get(False))
+        loaded = [l.split() for l in lines if l.startswith('collector.startup.loaded_ms ')]
+        self.assertEqual('phase=reload', loaded[-1][3])
+        self.assertTrue(int(loaded[-1][2]) < 3600 * 1000)
+
+    def test_hangingImportHoldsUpNoOtherImport(self):
+        configs = dict([self.addCollector('hung', 0, import_time=3), self.addCollector('quick', 0)])
+        start = time.time()
+        runner.load_collectors(self.coldir, configs, self.collectors, self.readq, 2, 1)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(['quick'], sorted(self.collectors))
+        self.assertEqual('timeout', runner.STARTUP_TIMELINE['hung'][2])
+
+    def test_lazyImport(self):
+        from collectors.lib import utils
+        module = utils.LazyModule('colorsys')
+        sys.modules.pop('colorsys', None)
+        self.assertFalse('colorsys' in sys.modules)
+        self.assertEqual((0.0, 0.0, 0.0), module.rgb_to_hsv(0, 0, 0))
+        self.assertTrue('colorsys' in sys.modules)
+        self.assertTrue(utils.lazy_import('colorsys') is sys.modules['colorsys'])
+
+
+class ProcessCollectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.coldir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.coldir, 'builtin'))
+        with open(os.path.join(self.coldir, 'builtin', 'isolated.py'), 'w') as f:
+            f.write(ISOLATED_COLLECTOR)
+        self.crash_file = os.path.join(self.coldir, 'crash')
+        self.conf = os.path.join(self.coldir, 'isolated.conf')
+        with open(self.conf, 'w') as f:
+            f.write('[base]\nenabled: True\ncollectorclass: Isolated\n'
+                    'isolation: process\ncrash_file: %s\n' % self.crash_file)
+        self.readq = runner.NonBlockingQueue(1000)
+        self.collector = runner.ProcessCollector('isolated', self.coldir, self.conf, self.readq)
+
+    def tearDown(self):
+        self.collector.cleanup()
+        shutil.rmtree(self.coldir)
+
+    def lines(self):
+        lines = []
+        while not self.readq.empty():
+            lines.extend(self.readq.get(False))
+        return lines
+
+    def test_runsInWorkerProcess(self):
+        self.collector()
+        self.collector()
+        lines = self.lines()
+        values = [l for l in lines if l.startswith('isolated.value')]
+        self.assertEqual(6, len(values))
+        self.assertTrue(all(l.endswith('pid=%d' % self.collector.proc.pid) for l in values))
+        self.assertNotEqual(os.getpid(), self.collector.proc.pid)
+        self.assertEqual(2, len([l for l in lines if l.startswith('collector.worker.rss_kb ')]))
+
+    def test_restartsCrashedWorker(self):
+        self.collector()
+        first = self.collector.proc.pid
+        open(self.crash_file, 'w').close()
+        self.collector()
+        self.assertEqual(None, self.collector.proc)
+        self.collector()
+        self.assertNotEqual(first, self.collector.proc.pid)
+        self.assertEqual(2, self.collector.starts)
+        self.assertTrue('collector.worker.restarts' in ' '.join(self.lines()))
+
+    def test_forwardsWorkerStderrToLog(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        level = runner.LOG.level
+        runner.LOG.addHandler(handler)
+        runner.LOG.setLevel(logging.INFO)
+        try:
+            self.collector()
+            pid = self.collector.proc.pid
+            open(self.crash_file, 'w').close()
+            self.collector()
+            deadline = time.time() + 5
+            while (not [r for r in records if r.getMessage().endswith('crashing')]
+                   and time.time() < deadline):
+                time.sleep(0.01)
+        finally:
+            runner.LOG.removeHandler(handler)
+            runner.LOG.setLevel(level)
+        forwarded = [(r.levelno, r.getMessage()) for r in records
+                     if r.getMessage().startswith('collector isolated: ')]
+        self.assertEqual([(logging.INFO, 'collector isolated: running in %d' % pid),
+                          (logging.WARNING, 'collector isolated: crashing')], forwarded)
+
+
+class SendSpreadTests(unittest.TestCase):
+
+    def mkSender(self, host):
+        options, _ = runner.parse_cmdline(['runner.py', '--spool-dir', '', '--send-interval', '10'])
+        options.hosts = [('localhost', 4242)]
+        return runner.Sender('token', None, options, {'host': host})
+
+    def test_offsetIsDeterministicPerHost(self):
+        a = self.mkSender('host-a')
+        self.assertEqual(a.send_offset, self.mkSender('host-a').send_offset)
+        self.assertNotEqual(a.send_offset, self.mkSender('host-b').send_offset)
+        self.assertTrue(0 <= a.send_offset < 10)
+
+    def test_waitsForSendSlot(self):
+        sender = self.mkSender('host-a')
+        sender.send_interval = 0.2
+        sender.send_offset = 0.1
+        sender.wait_for_send_slot()
+        self.assertTrue(abs((time.time() - 0.1) % 0.2) < 0.05)
+
+
+class CompressionTests(LocalTsdTestCase):
+
+    def test_compressPayload(self):
+        payload = json.dumps([{'metric': 'foo.bar', 'value': 1}] * 100)
+        self.assertEqual((payload, None), runner.common_utils.compress_payload(payload, 'gzip', 6, len(payload) + 1))
+        for method in ('gzip', 'deflate'):
+            body, encoding = runner.common_utils.compress_payload(payload, method, 6, 0)
+            self.assertEqual(method, encoding)
+            self.assertTrue(len(body) < len(payload))
+
+    def test_runnerSenderRoundTrip(self):
+        options, _ = runner.parse_cmdline(['runner.py', '--compression', 'gzip',
+                                           '--compression-min-size', '0', '--spool-dir', ''])
+        options.hosts = [('127.0.0.1', self.port)]
+        sender = runner.Sender('token', None, options, {})
+        metrics = [{'metric': 'foo.bar', 'timestamp': 1500000000 + i,
+                    'value': i, 'tags': {'host': 'a'}} for i in xrange(100)]
+        sender.send_data_via_http(metrics)
+        path, headers, body = self.server.requests[0]
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        self.assertEqual({'token': 'token', 'metrics': metrics}, json.loads(body))
+        self.assertTrue(sender.compression_ratio > 1)
+
+    def test_tcollectorSenderRoundTrip(self):
+        sender = tcollector.SenderThread(None, False, [('127.0.0.1', self.port)], False,
+                                         {'host': 'a'}, http=True, compression='deflate')
+        sender.sendq = [tcollector.DataPoint('foo.bar', 1500000000, '1', ' x=y')]
+        sender.send_data_via_http()
+        path, headers, body = self.server.requests[0]
+        self.assertEqual('deflate', headers['Content-Encoding'])
+        self.assertEqual([{'metric': 'foo.bar', 'timestamp': 1500000000, 'value': 1.0,
+                           'tags': {'host': 'a', 'x': 'y'}}], json.loads(body))
+        self.assertEqual([], sender.sendq)
+
+
+class DiskSpoolTests(LocalTsdTestCase):
+
+    def setUp(self):
+        super(DiskSpoolTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(DiskSpoolTests, self).tearDown()
+
+    def test_replaysOldestFirstAcrossRestarts(self):
+        spool = runner.DiskSpool(self.directory, 1024 * 1024, segment_size=30)
+        for i in xrange(5):
+            spool.append([{'metric': 'm%d' % i}])
+        self.assertEqual([{'metric': 'm0'}], spool.peek())
+        spool.commit()
+        self.assertEqual([{'metric': 'm1'}], spool.peek())
+        spool.close()  # m1 was never committed
+
+        spool = runner.DiskSpool(self.directory, 1024 * 1024, segment_size=30)
+        replayed = []
+        while True:
+            batch = spool.peek()
+            if batch is None:
+                break
+            replayed.append(batch[0]['metric'])
+            spool.commit()
+        self.assertEqual(['m1', 'm2', 'm3', 'm4'], replayed)
+        self.assertEqual(0, len(spool))
+
+    def test_dropsOldestSegmentsBeyondMaxBytes(self):
+        spool = runner.DiskSpool(self.directory, 100, segment_size=30)
+        for i in xrange(10):
+            spool.append([{'metric': 'm%d' % i}])
+        self.assertTrue(sum(spool.sizes.values()) <= 100)
+        self.assertTrue(spool.evicted_bytes > 0)
+        self.assertEqual([{'metric': 'm6'}], spool.peek())
+
+    def test_senderSpoolsWhileDownAndReplays(self):
+        options, _ = runner.parse_cmdline(['runner.py', '--spool-dir', self.directory])
+        options.hosts = [('127.0.0.1', self.port)]
+        sender = runner.Sender('token', None, options, {})
+        sender.spool.append([{'metric': 'spooled', 'timestamp': 1, 'value': 1, 'tags': {}}])
+        sender.replay_credit = 1
+        sender.replay_spool()
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual('spooled', json.loads(self.server.requests[0][2])['metrics'][0]['metric'])
+        self.assertEqual(None, sender.spool.peek())
+        # no credit left, so nothing else goes out
+        sender.spool.append([{'metric': 'later', 'timestamp': 1, 'value': 1, 'tags': {}}])
+        sender.replay_spool()
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_senderDropsWhenSpoolIsReadOnly(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = ('127.0.0.1', sock.getsockname()[1])
+        sock.close()
+        options, _ = runner.parse_cmdline(['runner.py', '--spool-dir', self.directory])
+        options.hosts = [dead]
+        sender = runner.Sender('token', runner.NonBlockingQueue(100), options, {})
+        os.chmod(self.directory, 0500)
+        if os.access(self.directory, os.W_OK):
+            # root writes anyway, a spool directory that's gone fails for all
+            os.rmdir(self.directory)
+        retry_interval = runner.SEND_RETRY_INTERVAL
+        runner.SEND_RETRY_INTERVAL = 0
+        transmit = threading.Thread(target=sender.transmit)
+        transmit.daemon = True
+        transmit.start()
+        try:
+            for i in xrange(2):
+                metrics = [{'metric': 'm%d' % i, 'timestamp': 1, 'value': 1, 'tags': {}}]
+                sender.batches.put((metrics, sender.build_request(metrics)))
+            deadline = time.time() + 5
+            while not sender.batches.empty() and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            # both batches were dropped and the thread is still running
+            self.assertTrue(sender.batches.empty())
+            self.assertTrue(transmit.is_alive())
+            self.assertEqual(0, sender.spool.spooled)
+        finally:
+            sender.shutdown()
+            runner.SEND_RETRY_INTERVAL = retry_interval
+            if not os.path.isdir(self.directory):
+                os.mkdir(self.directory)
+            os.chmod(self.directory, 0700)
+        transmit.join(5)
+
+
+class DirectoryWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reportsChangesOnly(self):
+        watcher = runner.common_utils.DirectoryWatcher([self.directory])
+        if not watcher.available:
+            self.skipTest('inotify not available')
+        try:
+            self.assertFalse(watcher.wait(0))
+            with open(os.path.join(self.directory, 'new.conf'), 'w') as f:
+                f.write('[base]\n')
+            start = time.time()
+            self.assertTrue(watcher.wait(5))
+            self.assertTrue(time.time() - start < 1)
+            # the whole burst of events was consumed
+            self.assertFalse(watcher.wait(0))
+        finally:
+            watcher.close()
+
+    def test_pollsWithoutInotify(self):
+        watcher = runner.common_utils.DirectoryWatcher()
+        watcher.close()
+        watcher.watch(self.directory)
+        self.assertEqual({}, watcher.watches)
+        self.assertTrue(watcher.wait(0))
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+        shutil.rmtree(self.directory)
+
+    def busy_waiting(self):
+        while not self.stop.is_set():
+            time.sleep(0.001)
+
+    def test_writesCollapsedStacks(self):
+        thread = threading.Thread(target=self.busy_waiting, name='busy')
+        thread.start()
+        profiler = runner.common_utils.SamplingProfiler(self.directory, rate=200)
+        path = profiler.start(0.2)
+        self.assertEqual(None, profiler.start(0.2))
+        profiler.wait()
+        with open(path) as f:
+            stacks = [line.rsplit(' ', 1) for line in f]
+        busy = [(stack, int(count)) for stack, count in stacks if stack.startswith('busy;')]
+        self.assertTrue(busy)
+        # samples taken inside stop.is_set() go deeper than busy_waiting
+        frame = ';busy_waiting (tests.py:%d)' % ProfilerTests.busy_waiting.im_func.func_code.co_firstlineno
+        self.assertTrue([stack for stack, _ in busy if stack.endswith(frame)])
+        self.assertTrue(sum(count for _, count in busy) > 10)
+        self.assertFalse([stack for stack, _ in stacks if stack.startswith('profiler;')])
+
+    def test_controlSocket(self):
+        path = os.path.join(self.directory, 'control')
+        profiler = runner.common_utils.SamplingProfiler(self.directory)
+        runner.ControlServer(path, profiler).start()
+        self.assertEqual(0600, os.stat(path).st_mode & 0777)
+
+        def command(line):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.sendall(line + '\n')
+            answer = sock.makefile().readline().strip()
+            sock.close()
+            return answer
+
+        self.assertTrue(command('nonsense').startswith('error:'))
+        self.assertTrue(command('profile -5').startswith('error:'))
+        self.assertTrue(command('profile 0').startswith('error:'))
+        self.assertTrue(command('profile %d' % (runner.MAX_PROFILE_DURATION + 1)).startswith('error:'))
+        # answered right away, the control socket stays responsive meanwhile
+        profile = command('profile 1')
+        self.assertEqual(self.directory, os.path.dirname(profile))
+        self.assertFalse(os.path.exists(profile))
+        self.assertEqual('error: a profile is already running', command('profile 1'))
+        profiler.wait()
+        self.assertTrue(os.path.exists(profile))
+
+    def test_controlSocketReplacesOnlySockets(self):
+        path = os.path.join(self.directory, 'control')
+        profiler = runner.common_utils.SamplingProfiler(self.directory)
+        with open(path, 'w') as f:
+            f.write('precious')
+        try:
+            runner.ControlServer(path, profiler)
+            self.fail('replaced a regular file')
+        except OSError, e:
+            self.assertEqual(errno.EEXIST, e.errno)
+        with open(path) as f:
+            self.assertEqual('precious', f.read())
+        os.remove(path)
+        # the socket of an earlier agent
+        runner.ControlServer(path, profiler).sock.close()
+        runner.ControlServer(path, profiler).start()
+        self.assertTrue(S_ISSOCK(os.lstat(path).st_mode))
+
+    def test_controlServerSurvivesInterruptedAccept(self):
+        path = os.path.join(self.directory, 'control')
+        server = runner.ControlServer(path, runner.common_utils.SamplingProfiler(self.directory))
+        sock = server.sock
+
+        class Interrupted(object):
+            interrupted = False
+
+            def accept(self):
+                if not self.interrupted:
+                    self.interrupted = True
+                    raise socket.error(errno.EINTR, 'Interrupted system call')
+                return sock.accept()
+        server.sock = Interrupted()
+        server.start()
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall('nonsense\n')
+        self.assertTrue(client.makefile().readline().startswith('error:'))
+        client.close()
+
+    def test_writesPrivateFilesWithoutFollowingLinks(self):
+        directory = os.path.join(self.directory, 'profiles')
+        victim = os.path.join(self.directory, 'victim')
+        with open(victim, 'w') as f:
+            f.write('keep')
+        profiler = runner.common_utils.SamplingProfiler(directory, rate=100)
+        path = profiler.start(0.2)
+        self.assertEqual(0700, os.stat(directory).st_mode & 0777)
+        os.symlink(victim, path)
+        profiler.wait()
+        self.assertFalse(os.path.islink(path))
+        self.assertEqual(0600, os.stat(path).st_mode & 0777)
+        with open(victim) as f:
+            self.assertEqual('keep', f.read())
+
+
+class ProcfsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'stat')
+
+    def tearDown(self):
+        procfs.close_all()
+        shutil.rmtree(self.directory)
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+    def test_sharesSnapshots(self):
+        self.write('cpu 1 2 3\n')
+        self.assertEqual('cpu 1 2 3\n', procfs.read(self.path))
+        self.write('cpu 4 5 6\n')
+        # still the same tick
+        self.assertEqual(['cpu 1 2 3'], procfs.read_lines(self.path))
+        self.assertEqual('cpu 4 5 6\n', procfs.read(self.path, max_age=0))
+
+    def test_growsBuffer(self):
+        content = 'x' * (procfs.BUFFER_SIZE * 3 + 5)
+        self.write(content)
+        self.assertEqual(content, procfs.read(self.path))
+
+    def test_missingFiles(self):
+        self.assertFalse(procfs.exists(self.path))
+        self.assertRaises(IOError, procfs.read, self.path)
+        self.write('1\n')
+        self.assertTrue(procfs.exists(self.path))
+
+
+class RateEngineTests(unittest.TestCase):
+
+    def test_deltasAndRates(self):
+        engine = rates.RateEngine()
+        self.assertEqual(([None, None], [None, None]), engine.update(['a', 'b'], [10, 100], now=1000))
+        self.assertEqual(([5, 50], [0.5, 5]), engine.update(['a', 'b'], [15, 150], now=1010))
+        # b was reset, c is new
+        self.assertEqual(([5, None, None], [1, None, None]),
+                         engine.update(['a', 'b', 'c'], [20, 3, 7], now=1015))
+        self.assertEqual(([3], [3]), engine.update(['b'], [6], now=1016))
+
+    def test_wraparound(self):
+        engine = rates.RateEngine(wrap=2 ** 32)
+        engine.update(['a', 'b'], [2 ** 32 - 10, 2 ** 31], now=0)
+        # a wrapped, b going back by half the range was reset
+        self.assertEqual([15, None], engine.update(['a', 'b'], [5, 5], now=1)[0])
+
+    def test_expiresIdleSeries(self):
+        engine = rates.RateEngine(max_idle=10)
+        now = time.time()
+        engine.update(['a', 'b'], [1, 1], now=now)
+        engine.forget(['b'])
+        engine.update(['c'], [1], now=now + 5)
+        engine.update(['c'], [2], now=now + 11)
+        self.assertEqual(1, len(engine))
+        self.assertEqual(1, len(engine.values))
+        self.assertEqual([1], engine.update(['c'], [3], now=now + 12)[0])
+
+    def test_outlivesCollectors(self):
+        self.assertTrue(rates.engine('tests') is rates.engine('tests'))
+
+
+class BuiltinCollectorTestCase(unittest.TestCase):
+    """Runs a builtin collector against a /proc tree written by the test."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        procfs.close_all()
+        self.snapshot_age = procfs.SNAPSHOT_AGE
+        procfs.SNAPSHOT_AGE = 0
+        self.readq = runner.NonBlockingQueue(100000)
+
+    def tearDown(self):
+        procfs.close_all()
+        procfs.SNAPSHOT_AGE = self.snapshot_age
+        shutil.rmtree(self.root)
+
+    def write(self, path, content):
+        fixtures.write(self.root, path, content)
+
+    def collector(self, module, class_name, engine=None, config=None, root=None):
+        """Loads and constructs a builtin collector, against the test's tree
+           or the given root."""
+        if engine is not None:
+            rates._engines.pop(engine, None)
+        builtin = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'collectors', 'builtin')
+        with fixtures.FixtureRoot(root or self.root):
+            return runner.load_collector_module(module, builtin, class_name)(config, None, self.readq)
+
+    def run_collector(self, collector):
+        """Runs collector once, returns {(metric, tags): value} of its lines."""
+        with fixtures.FixtureRoot(self.root):
+            collector()
+        collector.flush()
+        values = {}
+        while not self.readq.empty():
+            for line in self.readq.get(False):
+                metric, _, value, tags = (line.split(None, 3) + [''])[:4]
+                values[(metric, tags)] = value
+        return values
+
+
+class CpusPctusageTests(BuiltinCollectorTestCase):
+
+    def test_percentagesFromDeltas(self):
+        self.write('/proc/stat', 'cpu  300 0 300 900 0 0 0 0 0 0\n'
+                                 'cpu0 100 0 200 600 50 0 0 10 0 0\n'
+                                 'cpu1 200 0 100 300 20 0 0\n'
+                                 'intr 12345\n')
+        collector = self.collector('cpus_pctusage', 'CpusPctusage', engine='cpus_pctusage')
+        self.assertEqual({('cpu.state', ''): '0'}, self.run_collector(collector))
+        # cpu0's iowait goes back, cpu1 has no steal column
+        self.write('/proc/stat', 'cpu  400 0 400 1000 0 0 0 0 0 0\n'
+                                 'cpu0 150 10 220 700 40 10 0 20 0 0\n'
+                                 'cpu1 230 0 120 350 20 0 0\n'
+                                 'intr 12346\n')
+        values = self.run_collector(collector)
+        # cpu0: 50 + 10 + 20 + 100 + 10 + 10 = 200 ticks
+        self.assertEqual('25.0', values[('cpu.usr', 'cpu=0')])
+        self.assertEqual('5.0', values[('cpu.nice', 'cpu=0')])
+        self.assertEqual('10.0', values[('cpu.sys', 'cpu=0')])
+        self.assertEqual('50.0', values[('cpu.idle', 'cpu=0')])
+        self.assertEqual('0.0', values[('cpu.iowait', 'cpu=0')])
+        self.assertEqual('5.0', values[('cpu.irq', 'cpu=0')])
+        self.assertEqual('5.0', values[('cpu.steal', 'cpu=0')])
+        # cpu1: 30 + 20 + 50 = 100 ticks
+        self.assertEqual('30.0', values[('cpu.usr', 'cpu=1')])
+        self.assertEqual('20.0', values[('cpu.sys', 'cpu=1')])
+        self.assertEqual('50.0', values[('cpu.idle', 'cpu=1')])
+        self.assertEqual('0.0', values[('cpu.steal', 'cpu=1')])
+        self.assertFalse([key for key in values if key[1] == 'cpu='])
+
+
+class TopNTests(BuiltinCollectorTestCase):
+
+    def process(self, pid, comm, ticks, starttime, rss, io=None, cmdline=''):
+        # utime and stime are fields 14 and 15 of proc(5), starttime 22, rss 24
+        self.write('/proc/%d/stat' % pid, '%d (%s) S 1 %d %d 0 -1 4194560 0 0 0 0 %d %d 0 0 20 0 1 0 %d 1000 %d 0\n'
+                   % (pid, comm, pid, pid, ticks - ticks / 2, ticks / 2, starttime, rss))
+        if io is not None:
+            self.write('/proc/%d/io' % pid, 'rchar: 1\nwchar: 2\nsyscr: 0\nsyscw: 0\nread_bytes: %d\n'
+                       'write_bytes: %d\ncancelled_write_bytes: 0\n' % (io - io / 2, io / 2))
+        self.write('/proc/%d/cmdline' % pid, cmdline)
+
+    def top(self, values, metric):
+        return dict((tags, float(value)) for (name, tags), value in values.iteritems() if name == metric)
+
+    def test_topProcessesOfOneScan(self):
+        config = runner.ConfigParser.SafeConfigParser()
+        config.add_section('base')
+        config.set('base', 'N', '2')
+        self.write('/proc/meminfo', 'MemTotal: 1000000 kB\nMemFree: 1000 kB\n')
+        self.process(1, 'init', 100, 10, 50, io=5000, cmdline='/sbin/init\0')
+        self.process(2, 'a b) c', 100, 20, 500, io=0)
+        self.process(3, 'kworker/0:1', 0, 30, 10, io=0)
+        # /proc/4/io can't be read
+        self.process(4, 'busy', 100, 40, 100)
+        self.process(5, 'old', 100, 50, 20, io=0)
+        collector = self.collector('top_n', 'TopN', config=config)
+        values = self.run_collector(collector)
+        mem = self.top(values, 'mem.topN')
+        percent = 100.0 * os.sysconf('SC_PAGE_SIZE') / 1024000000
+        # the tag of a process without a command line is its name in brackets
+        self.assertEqual({'pid_cmd=2__a_b__c_': round(500 * percent, 2), 'pid_cmd=4__busy_': round(100 * percent, 2)},
+                         mem)
+        self.assertEqual({}, self.top(values, 'cpu.topN'))
+        self.assertEqual({}, self.top(values, 'io.topN'))
+
+        self.process(1, 'init', 150, 10, 50, io=6000, cmdline='/sbin/init\0')
+        self.process(2, 'a b) c', 110, 20, 500, io=0)
+        self.process(4, 'busy', 300, 40, 100)
+        # pid 5 was reused, its ticks aren't the old process'
+        self.process(5, 'new', 5000, 60, 20, io=10 ** 6)
+        collector.prev_time = time.time() - 10
+        values = self.run_collector(collector)
+        scale = 100.0 / (os.sysconf('SC_CLK_TCK') * 10 * os.sysconf('SC_NPROCESSORS_ONLN'))
+        cpu = self.top(values, 'cpu.topN')
+        self.assertEqual(['pid_cmd=1_/sbin/init', 'pid_cmd=4__busy_'], sorted(cpu))
+        self.assertAlmostEqual(200 * scale, cpu['pid_cmd=4__busy_'], delta=0.02)
+        self.assertAlmostEqual(50 * scale, cpu['pid_cmd=1_/sbin/init'], delta=0.02)
+        io = self.top(values, 'io.topN')
+        self.assertEqual(['pid_cmd=1_/sbin/init'], io.keys())
+        self.assertAlmostEqual(100, io['pid_cmd=1_/sbin/init'], delta=0.1)
+
+
+class SockDiagTests(unittest.TestCase):
+
+    @staticmethod
+    def message(msg_type, payload):
+        return struct.pack('=IHHII', 16 + len(payload), msg_type, 2, 1, 0) + payload
+
+    def diag_msg(self, family, state, sport, dport, src, dst, uid):
+        """A packed inet_diag_msg, addresses padded to 16 bytes."""
+        return self.message(sock_diag.SOCK_DIAG_BY_FAMILY, struct.pack(
+            '=BBBBHH16s16sIIIIIIII', family, state, 0, 0, socket.htons(sport), socket.htons(dport),
+            src, dst, 0, 0, 0, 0, 0, 0, uid, 12345))
+
+    def test_parsesIPv4Reply(self):
+        data = (self.diag_msg(socket.AF_INET, 1, 22, 50000, socket.inet_aton('10.1.2.3'),
+                              socket.inet_aton('8.8.4.4'), 1000) +
+                self.diag_msg(socket.AF_INET, 10, 80, 0, socket.inet_aton('192.168.0.1'),
+                              socket.inet_aton('0.0.0.0'), 0))
+        self.assertEqual(([(1, 22, 50000, 10, 1, 8, 8, 1000), (10, 80, 0, 192, 168, 0, 0, 0)], False),
+                         sock_diag.parse_reply(data, socket.AF_INET))
+
+    def test_parsesIPv6Reply(self):
+        src = socket.inet_pton(socket.AF_INET6, '::ffff:172.17.0.2')
+        dst = socket.inet_pton(socket.AF_INET6, '2001:db8::1:2')
+        data = self.diag_msg(socket.AF_INET6, 6, 443, 40000, src, dst, 33)
+        data += self.message(sock_diag.NLMSG_DONE, struct.pack('=i', 0))
+        # bytes 12 and 13 of the addresses, where IPv4 mapped ones keep theirs
+        self.assertEqual(([(6, 443, 40000, 172, 17, 0, 1, 33)], True),
+                         sock_diag.parse_reply(data, socket.AF_INET6))
+
+    def test_doneAndError(self):
+        self.assertEqual(([], True), sock_diag.parse_reply(
+            self.message(sock_diag.NLMSG_DONE, struct.pack('=i', 0)), socket.AF_INET))
+        error = self.message(sock_diag.NLMSG_ERROR, struct.pack('=i', -errno.EPERM) + '\0' * 16)
+        self.assertRaises(sock_diag.NetlinkError, sock_diag.parse_reply, error, socket.AF_INET)
+        self.assertRaises(sock_diag.NetlinkError, sock_diag.parse_reply,
+                          struct.pack('=IHHII', 4, 20, 0, 0, 0), socket.AF_INET)
+
+
+class ProcnettcpTests(BuiltinCollectorTestCase):
+
+    def procnettcp(self, backend, root=None):
+        config = runner.ConfigParser.SafeConfigParser()
+        config.add_section('base')
+        config.set('base', 'backend', backend)
+        nice = os.nice
+        os.nice = lambda increment: 0  # don't renice the tests
+        try:
+            return self.collector('procnettcp', 'Procnettcp', config=config, root=root)
+        finally:
+            os.nice = nice
+
+    def test_countsPerStateAndService(self):
+        line = '%4d: %s %s %s 00000000:00000000 00:00000000 00000000  %4d        0 %d 1 0 100 0 0 10 0\n'
+        self.write('/proc/net/tcp', '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+                                    'retrnsmt   uid  timeout inode\n' +
+                   line % (0, '0100007F:0050', '0100007F:C350', '01', 0, 1) +
+                   line % (1, '0100007F:C351', '08080808:0050', '01', 33, 2) +
+                   line % (2, '00000000:0CEA', '00000000:0000', '0A', 0, 3))
+        values = self.run_collector(self.procnettcp('procfs'))
+        self.assertEqual('2', values[('proc.net.tcp', 'state=established service=http')])
+        self.assertEqual('1', values[('proc.net.tcp', 'state=listen service=mysql')])
+        self.assertEqual('0', values[('proc.net.tcp', 'state=established service=other')])
+        self.assertEqual('0', values[('procnettcp.state', '')])
+
+    def test_backendsAgree(self):
+        if not sock_diag.available():
+            self.skipTest('netlink sock_diag is not available')
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server = listener.accept()[0]
+        # the host's live socket table
+        collector = self.procnettcp('netlink', root='/')
+        try:
+            # other sockets of the host may come and go in between
+            for _ in xrange(5):
+                from_procfs, from_netlink = {}, {}
+                collector.count_procfs(from_procfs)
+                collector.count_netlink(from_netlink)
+                if from_procfs == from_netlink:
+                    break
+            self.assertEqual(from_procfs, from_netlink)
+            established = sum(count for (state, _), count in from_netlink.iteritems() if state == 'established')
+            self.assertTrue(established >= 2)
+        finally:
+            for sock in (client, server, listener):
+                sock.close()
+
+
 class UDPCollectorTests(unittest.TestCase):
 
     def setUp(self):